@@ -7,7 +7,9 @@ from colorama import Back
 from colorama import Style
 import os
 import collections
+import functools
 import itertools
+import math
 
 #http://codereview.stackexchange.com/questions/88912/create-a-list-of-all-strings-within-hamming-distance-of-a-reference-string-with
 def hamming_circle(s, n, alphabet):
@@ -22,18 +24,126 @@ def hamming_circle(s, n, alphabet):
             yield ''.join(cousin)
 
 
+def getSegmentBounds(length, segmentCount):
+    """Split a sequence of length in segmentCount (nearly) equally sized segments, returns a list of (start, end)"""
+    return [ ( (segment*length)//segmentCount, ((segment+1)*length)//segmentCount ) for segment in range(segmentCount) ]
+
+
+def getHammingCircleSize(length, hammingDistance, alphabetSize=5):
+    """Amount of sequences generated by hamming_circle for a sequence of length at hammingDistance"""
+    return math.comb(length, hammingDistance)*(alphabetSize-1)**hammingDistance
+
+
+class BarcodeCorrectionIndex():
+    """Hamming distance correction of sequences to barcodes at query time, without expanding the barcodes (see BarcodeParser.expand).
+
+    A sequence within maxDistance of a barcode is equal to the barcode in at least one of maxDistance+1 segments (pigeonhole principle).
+    The barcodes are indexed by their segments, a sequence is only compared to the barcodes which share a segment with it.
+    The memory used is proportional to the amount of barcodes, the corrections of the last cacheSize queried sequences are cached.
+    The collision rules of expand apply: the nearest barcode is assigned, a sequence equally near to barcodes with a different
+    index is a collision. Like in the hamming_circle expansion over ACTGN, the substituted bases of the sequence are in ACTGN,
+    and only barcode bases in ACTGN are substituted by N.
+    """
+    def __init__(self, barcodes, maxDistance, cacheSize=100000):
+        # barcodes: barcode -> index
+        self.maxDistance = maxDistance
+        self.barcodes = list(barcodes.items()) # [(barcode, index), ...]
+        self.segments = {} # barcode length -> [(start, end, segment -> [position of the barcode in self.barcodes, ...]), ...]
+        for position, (barcode, index) in enumerate(self.barcodes):
+            if not len(barcode) in self.segments:
+                self.segments[len(barcode)] = [ (start, end, {}) for start, end in getSegmentBounds(len(barcode), maxDistance+1) ]
+            for start, end, table in self.segments[len(barcode)]:
+                table.setdefault(barcode[start:end], []).append(position)
+        self.irregularBarcodes = { position for position, (barcode, index) in enumerate(self.barcodes) if not all(base in 'ACTGN' for base in barcode) }
+        self.findNearest = functools.lru_cache(maxsize=cacheSize)(self.findNearest)
+
+    def findNearest(self, sequence):
+        """Obtain the hamming distance to and the positions of the nearest barcodes within maxDistance of the sequence, (None, ()) when there are none"""
+        nearestDistance = self.maxDistance
+        nearest = []
+        regularSequence = all(base in 'ACTGN' for base in sequence)
+        candidates = set()
+        for start, end, table in self.segments.get(len(sequence), ()):
+            candidates.update(table.get(sequence[start:end], ()))
+        for position in sorted(candidates):
+            barcode = self.barcodes[position][0]
+            hammingDistance = sum(map(str.__ne__, sequence, barcode))
+            if hammingDistance>nearestDistance:
+                continue
+            if not regularSequence or position in self.irregularBarcodes:
+                # Only substitutions which are generated by hamming_circle over ACTGN are accepted
+                if any( base!=barcodeBase and (not base in 'ACTGN' or (base=='N' and not barcodeBase in 'ACTGN')) for base, barcodeBase in zip(sequence, barcode) ):
+                    continue
+            if hammingDistance<nearestDistance:
+                nearestDistance = hammingDistance
+                nearest = []
+            nearest.append(position)
+        if len(nearest)==0:
+            return (None, ())
+        return (nearestDistance, tuple(nearest))
+
+    def correct(self, sequence):
+        """Obtain (index, barcode, hammingDistance) of the nearest barcode, (None, None, None) when there is none or the sequence is a collision"""
+        hammingDistance, nearest = self.findNearest(sequence)
+        if len(nearest)==0 or len({ self.barcodes[position][1] for position in nearest })>1:
+            return (None, None, None)
+        barcode, index = self.barcodes[nearest[0]]
+        return (index, barcode, hammingDistance)
+
+    def isCollision(self, sequence):
+        """Check if the sequence is equally near to barcodes with a different index"""
+        hammingDistance, nearest = self.findNearest(sequence)
+        return len({ self.barcodes[position][1] for position in nearest })>1
+
+    def getCollidingBarcodes(self, sequence):
+        """Obtain the hamming distance to and the [(index, barcode), ...] of the nearest barcodes when the sequence is a collision, (None, []) otherwise"""
+        if not self.isCollision(sequence):
+            return (None, [])
+        hammingDistance, nearest = self.findNearest(sequence)
+        return (hammingDistance, [ (self.barcodes[position][1], self.barcodes[position][0]) for position in nearest ])
+
+
+class AliasDictionary(dict):
+    """Dictionary alias -> barcodes, the barcodes of an alias are loaded by calling load(alias) when the alias is first looked up"""
+    def __init__(self, load):
+        dict.__init__(self)
+        self.load = load
+
+    def __missing__(self, alias):
+        self.load(alias)
+        return dict.__getitem__(self, alias)
+
+
 class BarcodeParser():
 
-    def __init__(self, barcodeDirectory='barcodes', hammingDistanceExpansion=0,spaceFill=False ):
+    # correction: how barcodes within hammingDistanceExpansion are corrected, 'expand': all sequences within the distance are generated
+    # when the barcodes are loaded, 'index': the sequences are corrected when they are looked up (BarcodeCorrectionIndex),
+    # 'auto': index is used for aliases of which the expansion would generate more than maxExpandedBarcodes sequences
+    def __init__(self, barcodeDirectory='barcodes', hammingDistanceExpansion=0,spaceFill=False, correction='auto', maxExpandedBarcodes=1000000 ):
 
         barcodeDirectory= os.path.join( os.path.dirname(os.path.realpath(__file__)), barcodeDirectory)
         self.spaceFill = spaceFill
         self.hammingDistanceExpansion = hammingDistanceExpansion
-        self.barcodes = collections.defaultdict(dict) # alias -> barcode -> index
-        self.extendedBarcodes = collections.defaultdict(dict) # alias -> barcode -> (index, hammingDistance)
+        if not correction in ('auto', 'expand', 'index'):
+            raise ValueError(f'Unknown barcode correction {correction}, use auto, expand or index')
+        self.correction = correction
+        self.maxExpandedBarcodes = maxExpandedBarcodes
+        self.correctionIndices = {} # alias -> BarcodeCorrectionIndex, for the aliases which are corrected at query time
+        # The barcode files are parsed and expanded when the alias is first looked up, see load
+        self.barcodeFiles = collections.defaultdict(list) # alias -> paths of the barcode files
+        self.loadedAliases = [] # aliases which were looked up, in the order in which they were loaded
+        self.barcodes = AliasDictionary(self.load) # alias -> barcode -> index
+        self.extendedBarcodes = AliasDictionary(self.load) # alias -> barcode -> (index, hammingDistance)
+        self.barcodeCollisions = AliasDictionary(self.load) # alias -> barcode -> [(index, barcode), ...] barcodes at the same distance
+        self.barcodeIdentifiers = {} # alias -> (identifiers, identifier -> position), see getBarcodeIdentifiers
 
         for barcodeFile in glob.glob(f'{barcodeDirectory}/*'):
-            barcodeFileAlias  = os.path.splitext(os.path.basename(barcodeFile))[0]
+            self.barcodeFiles[os.path.splitext(os.path.basename(barcodeFile))[0]].append(barcodeFile)
+
+    def readBarcodeFiles(self, barcodeFileAlias):
+        """Parse the barcode file(s) of the alias, returns a list of (barcode, index)"""
+        barcodes = []
+        for barcodeFile in self.barcodeFiles.get(barcodeFileAlias, []):
             logging.info(f"Parsing {barcodeFile}, alias {barcodeFileAlias}")
 
             # Decide the file type (index first or name first)
@@ -57,29 +167,70 @@ class BarcodeParser():
                     if len(parts)==1 and ' ' in line:
                         parts = line.strip().split(' ')
                     if len(parts)==1:
-                        self.addBarcode( barcodeFileAlias, barcode=parts[0], index=i)
-                        #self.barcodes[barcodeFileAlias][parts[0]] = i
+                        barcodes.append( (parts[0], i) )
                         logging.info(f"\t{parts[0]}:{i} (No index specified in file)")
                     elif len(parts)==2:
                         if indexNotFirst:
                             barcode, index = parts
                         else:
                             index,barcode  = parts
-                        #self.barcodes[barcodeFileAlias][barcode] = index
-                        self.addBarcode( barcodeFileAlias, barcode=barcode, index=index)
+                        barcodes.append( (barcode, index) )
                         logging.info(f"\t{barcode}:{index} (index was specified in file, {'index' if indexFirst else 'barcode'} on first column)")
                     else:
                         e = f'The barcode file {barcodeFile} contains more than two columns. Failed to parse!'
                         logging.error(e)
                         raise ValueError(e)
+        return barcodes
 
-        if hammingDistanceExpansion>0:
-            for alias in list(self.barcodes.keys()):
-                #print(alias)
-                self.expand(hammingDistanceExpansion, alias=alias)
+    def load(self, alias):
+        """Parse and hamming distance expand the barcodes of the alias, when this was not done yet.
+        Raises a KeyError when there is no barcode file for the alias"""
+        if alias in self.loadedAliases:
+            return
+        if not alias in self.barcodeFiles:
+            raise KeyError(f'No barcode file found for alias {alias}')
+        self.loadedAliases.append(alias)
+        self.barcodes[alias] = {}
+        self.extendedBarcodes[alias] = {}
+        self.barcodeCollisions[alias] = {}
+        for barcode, index in self.readBarcodeFiles(alias):
+            self.addBarcode( alias, barcode=barcode, index=index)
+        if self.hammingDistanceExpansion>0:
+            if self.getCorrection(alias)=='index':
+                self.correctionIndices[alias] = BarcodeCorrectionIndex(self.barcodes[alias], self.hammingDistanceExpansion)
+            else:
+                self.expand(self.hammingDistanceExpansion, alias=alias)
+
+    def getCorrection(self, alias):
+        """Decide how the barcodes of the (loaded) alias are hamming distance corrected, 'expand' or 'index'"""
+        # Space fill assigns every sequence in the expansion, this is only implemented by expand
+        if self.spaceFill:
+            return 'expand'
+        if self.correction!='auto':
+            return self.correction
+        expandedBarcodes = sum( getHammingCircleSize(len(barcode), hammingDistance)
+            for barcode in self.barcodes[alias] for hammingDistance in range(1, self.hammingDistanceExpansion+1) )
+        return 'index' if expandedBarcodes>self.maxExpandedBarcodes else 'expand'
+
+    def usesCorrectionIndex(self, alias):
+        """Check if the barcodes of the alias are corrected at query time (the alias has no extended barcodes)"""
+        self.load(alias)
+        return alias in self.correctionIndices
+
+    def getBarcodeIdentifiers(self, alias):
+        """Obtain the identifiers (indices) of the barcodes in the order of the barcode file, and a dictionary identifier -> position in this list"""
+        if not alias in self.barcodeIdentifiers:
+            identifiers = list(dict.fromkeys(self.barcodes[alias].values()))
+            self.barcodeIdentifiers[alias] = (identifiers, {identifier:position for position, identifier in enumerate(identifiers)})
+        return self.barcodeIdentifiers[alias]
 
     def getTargetCount(self, barcodeFileAlias):
-        return( len(self.barcodes[barcodeFileAlias] ), len(self.extendedBarcodes[barcodeFileAlias]) )
+        """Amount of barcodes and hamming extended barcodes of the alias. The alias is not loaded, when it was not loaded yet
+        the amount of extended barcodes is only known without hamming distance expansion (None otherwise).
+        The amount of extended barcodes is None for aliases which are corrected at query time"""
+        if barcodeFileAlias in self.loadedAliases:
+            return( len(self.barcodes[barcodeFileAlias] ), None if barcodeFileAlias in self.correctionIndices else len(self.extendedBarcodes[barcodeFileAlias]) )
+        return( len(dict(self.readBarcodeFiles(barcodeFileAlias))), 0 if self.hammingDistanceExpansion==0 else None )
 
 
     def expand(self,hammingDistanceExpansion, alias, reportCollisions=True, spaceFill=None ): # Space fill fills all hamming instances, even if they are not resolvable
@@ -142,6 +293,9 @@ class BarcodeParser():
         if not spaceFill:
             mapping = {} # @todo: we don't need this variable anymore
             for sequence in hammingMatrix:
+                if hammingMatrix[sequence][0] is None:
+                    # Collision, remember the barcodes to be able to report why the sequence is not assigned
+                    self.barcodeCollisions[alias][sequence] = hammingMatrix[sequence][2]
                 if hammingMatrix[sequence][0]!=None:
                     mapping[sequence] = hammingMatrix[sequence][0]
                     self.addBarcode( alias, barcode=sequence, index=hammingMatrix[sequence][0], hammingDistance=hammingMatrix[sequence][1], originBarcode=hammingMatrix[sequence][3])
@@ -171,11 +325,31 @@ class BarcodeParser():
             return (self.barcodes[alias][barcode], barcode, 0)
         if barcode in self.extendedBarcodes[alias]:
             return self.extendedBarcodes[alias][barcode]
+        if alias in self.correctionIndices:
+            return self.correctionIndices[alias].correct(barcode)
         return (None,None,None)
 
 
+    def isCollision(self, barcode, alias):
+        """Check if the barcode could not be assigned because it is equally close to multiple barcodes"""
+        if self.usesCorrectionIndex(alias):
+            return self.correctionIndices[alias].isCollision(barcode)
+        return barcode in self.barcodeCollisions[alias]
+
+    def getCollidingBarcodes(self, barcode, alias):
+        """Obtain the hamming distance to and the [(index, barcode), ...] of the nearest barcodes when the barcode is a collision, (None, []) otherwise"""
+        if self.usesCorrectionIndex(alias):
+            return self.correctionIndices[alias].getCollidingBarcodes(barcode)
+        if not barcode in self.barcodeCollisions[alias]:
+            return (None, [])
+        # The collisions contain all barcodes within the hamming distance, only the nearest barcodes collide
+        distances = [ (sum(map(str.__ne__, barcode, origin)), index, origin) for index, origin in self.barcodeCollisions[alias][barcode] ]
+        hammingDistance = min( distance for distance, index, origin in distances )
+        return (hammingDistance, [ (index, origin) for distance, index, origin in distances if distance==hammingDistance ])
+
     def list(self, showBarcodes=5):
-        for barcodeAlias,mapping in self.barcodes.items():
+        for barcodeAlias in self.barcodeFiles:
+            mapping = self.barcodes[barcodeAlias]
             print( f'{len(mapping)} barcodes{Style.DIM} obtained from {Style.RESET_ALL}{barcodeAlias}')
             if len(mapping):
                 for bcId in list(mapping.keys())[:showBarcodes]:
@@ -1,8 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import re
+import os
+import json
 import fastqIterator
 import string
+import collections
+try:
+    import numpy as np
+except ImportError:
+    # The batch (vectorized) demultiplexing is not available without numpy
+    np = None
 complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
 
 class SamTag:
@@ -114,10 +122,13 @@ def fqSafe(string):
 illuminaHeaderSplitRegex = re.compile(':| ', re.UNICODE)
 
 class TaggedRecord():
-    def __init__(self, tagDefinitions, rawRecord=False, library=None, **kwargs):
+    def __init__(self, tagDefinitions, rawRecord=False, library=None, headerTags=None, **kwargs):
         self.tags = {} # 2 character Key -> value
         self.tagDefinitions = tagDefinitions
-        if rawRecord is not False:
+        if headerTags is not None:
+            # Tags already obtained from the raw record, see ReadPairContext
+            self.tags.update(headerTags)
+        elif rawRecord is not False:
             try:
                 self.fromRawFastq(rawRecord, **kwargs)
             except NonMultiplexable:
@@ -243,9 +254,21 @@ class TaggedRecord():
         if read.has_tag('QM') and len(read.get_tag('QM'))!=len(read.get_tag('MI')):
             raise ValueError('QM and MI tag length not matching')
 
-    def fromTaggedFastq(self, fastqRecord ):
+    def fromTaggedFastq(self, fastqRecord, manifest=None ):
+        """Obtain the tags from the header of a tagged fastq record.
+
+        manifest: tags of the header manifest when the record has a compact header (see HeaderCompactor and readHeaderManifest),
+        the tags of the manifest are restored, tags with an empty value in the header are not present
+        """
+        if manifest is not None:
+            self.tags.update(manifest)
         for keyValue in fastqRecord.header.replace('@','').strip().split(';'):
+            if len(keyValue)==0:
+                continue
             key, value = keyValue.split(':')
+            if manifest is not None and len(value)==0:
+                self.tags.pop(key, None)
+                continue
             self.addTagByTag(key, value, decodePhred=True)
 
     def fromTaggedBamRecord(self, pysamRecord):
@@ -254,6 +277,64 @@ class TaggedRecord():
             self.addTagByTag(key, value, isPhred=False)
 
 
+# Tags which are (nearly) the same for all reads of a library, in compact headers these are stored once in the header manifest
+compactHeaderTags = ['Is', 'RN', 'Fc', 'La', 'Fi', 'CN', 'LY', 'MX']
+# The header manifest is shared by the tagged fastq files in the same directory
+headerManifestName = 'headers.manifest'
+
+class HeaderCompactor():
+    """Writes compact headers: the tags which have the value stored in the header manifest are removed from tagged fastq records.
+
+    Tags with a different value are kept, tags of the manifest which are not present in a record get an empty value.
+    """
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.manifestKeyValues = set( f'{tag}:{value}' for tag, value in manifest.items() )
+
+    def compact(self, record):
+        header, remainder = record.split('\n', 1)
+        keyValues = header[1:].split(';')
+        kept = [ keyValue for keyValue in keyValues if not keyValue in self.manifestKeyValues ]
+        if len(keyValues)-len(kept)!=len(self.manifest):
+            present = set( keyValue[:2] for keyValue in keyValues )
+            kept += [ f'{tag}:' for tag in self.manifest if not tag in present ]
+        return f"@{';'.join(kept)}\n{remainder}"
+
+
+def writeHeaderManifest(directory, manifest):
+    """Store the header manifest in directory, the manifest is replaced at once, this way multiple processes can write the same manifest"""
+    path = os.path.join(directory, headerManifestName)
+    with open(f'{path}.{os.getpid()}', 'w') as f:
+        json.dump({'tags':manifest}, f)
+    os.replace(f'{path}.{os.getpid()}', path)
+
+def readHeaderManifest(fastqPath):
+    """Obtain the header manifest tags of the fastq file at fastqPath, returns None when the headers of the file are not compact"""
+    path = os.path.join(os.path.dirname(fastqPath), headerManifestName)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)['tags']
+
+
+class ReadPairContext():
+    """Information about a read pair which is shared by all demultiplexing strategies.
+
+    The illumina header of every mate is parsed (and the index corrected) once per
+    index file parser and alias, instead of once for every strategy.
+    """
+    def __init__(self, records):
+        self.records = records
+        self.headerTags = {} # (mate index, index file parser, index alias) -> tags obtained from the header
+        self.cellBarcodes = {} # strategy short name -> (barcode identifier, hamming distance) of the cell barcode
+
+    def getHeaderTags(self, mateIndex, indexFileParser=None, indexFileAlias=None):
+        key = (mateIndex, id(indexFileParser), indexFileAlias)
+        if not key in self.headerTags:
+            self.headerTags[key] = TaggedRecord(rawRecord=self.records[mateIndex], tagDefinitions=TagDefinitions, indexFileParser=indexFileParser, indexFileAlias=indexFileAlias).tags
+        return self.headerTags[key]
+
+
 def reverseComplement(seq):
     global complement
     return( "".join(complement.get(base, base) for base in reversed(seq)) )
@@ -274,6 +355,18 @@ def fastqHeaderSafeQualitiesToPhred(phred, method=3):
     return "".join(( chr(string.ascii_letters.index(v)+33) for v in phred ))
 
 
+# Code of every nucleotide for the vectorized barcode lookup, other characters are encoded as 7
+if np is not None:
+    nucleotideCodes = np.full(256, 7, dtype=np.int64)
+    for code, base in enumerate('ACGTN'):
+        nucleotideCodes[ord(base)] = code
+
+def encodeSequences(sequences):
+    """Encode a 2D uint8 numpy array of sequences (one sequence per row, at most 21 bases) into int64, 3 bits per base"""
+    codes = nucleotideCodes[sequences]
+    return (codes << (3*np.arange(sequences.shape[1], dtype=np.int64))).sum(axis=1)
+
+
 class NonMultiplexable(Exception):
     pass
 
@@ -302,9 +395,28 @@ class DemultiplexingStrategy(object):
         self.indexSummary = ''
         self.barcodeSummary = ''
 
-    def demultiplex(self, records):
+    # context: ReadPairContext of the records, shared between strategies
+    def demultiplex(self, records, library=None, context=None):
         raise NotImplementedError()
 
+    # Batch entry point, chunk is a tuple of fastq record blocks (one block of bytes per mate)
+    # as yielded by fastqIterator.FastqBatchIterator.
+    # Returns a tuple (mask, cellIndices) or None when the strategy can not process the chunk as a whole.
+    # The mask is False for read pairs which are not multiplexable by this strategy, the read pairs for which
+    # the mask is True still need to be supplied to demultiplex to obtain the output records
+    def demultiplexBatch(self, chunk):
+        return None
+
+    # Reason why the records are not multiplexable by this strategy, used when the records were rejected by demultiplexBatch
+    def getRejectReason(self, records):
+        return 'not multiplexable'
+
+    # The barcode window used to prefilter read pairs during autodetection, see BarcodePrefilterIndex.
+    # Returns a tuple (read, start, length, barcodes), barcodes contains all sequences in the window which are accepted by demultiplex.
+    # None when the strategy can not be prefiltered.
+    def getPrefilterWindow(self):
+        return None
+
     def __repr__(self):
         return f'{self.longName} {self.shortName} {self.description} DemultiplexingStrategy'
 
@@ -324,14 +436,16 @@ class IlluminaBaseDemultiplexer(DemultiplexingStrategy):
         self.description = 'Demultiplex as a bulk sample'
         self.indexSummary = f'sequencing indices: {illuminaIndicesAlias}'
 
-    def demultiplex(self, records, inherited=False, library=None):
+    def demultiplex(self, records, inherited=False, library=None, context=None):
         global TagDefinitions
 
+        if context is None:
+            context = ReadPairContext(records)
         try:
             if inherited:
-                return [ TaggedRecord(rawRecord=record,tagDefinitions=TagDefinitions, indexFileParser=self.indexFileParser, indexFileAlias=self.illuminaIndicesAlias, library=library) for record in records ]
+                return [ TaggedRecord(headerTags=context.getHeaderTags(mateIndex, self.indexFileParser, self.illuminaIndicesAlias),tagDefinitions=TagDefinitions, library=library) for mateIndex in range(len(records)) ]
             else:
-                return [TaggedRecord(rawRecord=record,tagDefinitions=TagDefinitions,indexFileParser=self.indexFileParser, indexFileAlias=self.illuminaIndicesAlias, library=library).asFastq(record.sequence, record.plus, record.qual) for record in records]
+                return [TaggedRecord(headerTags=context.getHeaderTags(mateIndex, self.indexFileParser, self.illuminaIndicesAlias),tagDefinitions=TagDefinitions, library=library).asFastq(record.sequence, record.plus, record.qual) for mateIndex, record in enumerate(records)]
         except NonMultiplexable:
             raise
 
@@ -355,6 +469,8 @@ class UmiBarcodeDemuxMethod(IlluminaBaseDemultiplexer):
         self.barcodeStart = barcodeStart
         self.barcodeLength = barcodeLength
         self.autoDetectable = False
+        self.batchBarcodeTable = None # Built on the first call to demultiplexBatch
+        self.batchBarcodePositions = None # barcode -> position of the exact barcode entry, when the barcodes are corrected at query time
 
         self.sequenceCapture = [slice(None) , slice(None) ] # ranges
         if umiLength==0:
@@ -372,7 +488,98 @@ class UmiBarcodeDemuxMethod(IlluminaBaseDemultiplexer):
     def __repr__(self):
         return f'{self.longName} bc: {self.barcodeStart}:{self.barcodeLength}, umi: {self.umiStart}:{self.umiLength} {self.description}'
 
-    def demultiplex(self, records, **kwargs):
+    def getBatchBarcodeTable(self):
+        """Obtain the barcode table used by demultiplexBatch.
+
+        Returns a tuple (sorted encoded barcodes, barcode entries) where barcode entries contains
+        (barcodeIdentifier, barcode, hammingDistance) for every encoded barcode.
+        When the barcodes are corrected at query time (see BarcodeParser.usesCorrectionIndex) only the exact barcodes are encoded,
+        the entry of a barcode corrected at hamming distance d is appended at the position of the exact entry + d * the amount of barcodes.
+        Returns False when the barcodes can not be encoded.
+        """
+        if self.batchBarcodeTable is None:
+            barcodes = self.barcodeFileParser.barcodes[self.barcodeFileAlias]
+            extendedBarcodes = self.barcodeFileParser.extendedBarcodes[self.barcodeFileAlias]
+            # Exact barcodes take precedence over the hamming extended barcodes
+            entries = dict(extendedBarcodes)
+            entries.update( {barcode:(index, barcode, 0) for barcode, index in barcodes.items()} )
+            if np is None or self.barcodeLength>21 or not all( len(barcode)==self.barcodeLength and all(base in 'ACGTN' for base in barcode) for barcode in entries ):
+                self.batchBarcodeTable = False
+            else:
+                sequences = sorted(entries)
+                encoded = encodeSequences( np.frombuffer(''.join(sequences).encode('ascii'), dtype=np.uint8).reshape(len(sequences), self.barcodeLength) )
+                order = np.argsort(encoded, kind='stable')
+                self.batchBarcodeTable = ( encoded[order], [ entries[sequences[i]] for i in order ] )
+                if self.barcodeFileParser.usesCorrectionIndex(self.barcodeFileAlias):
+                    exactEntries = list(self.batchBarcodeTable[1])
+                    self.batchBarcodePositions = { barcode:position for position, (index, barcode, hammingDistance) in enumerate(exactEntries) }
+                    for hammingDistance in range(1, self.barcodeFileParser.hammingDistanceExpansion+1):
+                        self.batchBarcodeTable[1].extend( (index, barcode, hammingDistance) for index, barcode, _ in exactEntries )
+        return self.batchBarcodeTable
+
+    def demultiplexBatch(self, chunk):
+        """Resolve the barcodes of all read pairs in chunk at once.
+
+        Returns a tuple (mask, cellIndices), mask is True for the read pairs with a (hamming corrected) barcode.
+        cellIndices contains the index of the barcode entry in getBatchBarcodeTable()[1], -1 for unassigned read pairs.
+        Returns None when numpy is not available or the chunk can not be processed as a whole.
+        """
+        table = self.getBatchBarcodeTable()
+        if table is False:
+            return None
+        encodedBarcodes, entries = table
+        if len(chunk)!=2:
+            # Not mate pair, nothing is multiplexable
+            readPairCount = chunk[0].count(b'\n')//4 if len(chunk) else 0
+            return np.zeros(readPairCount, dtype=bool), np.full(readPairCount, -1, dtype=np.int64)
+
+        block = chunk[self.barcodeRead]
+        if b'\r' in block:
+            return None
+        data = np.frombuffer(block, dtype=np.uint8)
+        newlines = np.flatnonzero(data==10)
+        sequenceStarts = newlines[0::4]+1
+        sequenceLengths = newlines[1::4]-sequenceStarts
+        # Gather the barcode window of every read, reads which are too short are masked afterwards
+        windows = data[ np.minimum( sequenceStarts[:,None]+np.arange(self.barcodeStart, self.barcodeStart+self.barcodeLength), len(data)-1 ) ]
+        encoded = encodeSequences(windows)
+
+        positions = np.minimum( np.searchsorted(encodedBarcodes, encoded), max(0, len(encodedBarcodes)-1) )
+        if len(encodedBarcodes):
+            mask = (encodedBarcodes[positions]==encoded) & (sequenceLengths>=self.barcodeStart+self.barcodeLength)
+        else:
+            mask = np.zeros(len(encoded), dtype=bool)
+        cellIndices = np.where(mask, positions, -1)
+        if self.batchBarcodePositions is not None:
+            # Correct the barcodes which are not exact at query time
+            misses = np.flatnonzero( ~mask & (sequenceLengths>=self.barcodeStart+self.barcodeLength) )
+            missedBarcodes = windows[misses].tobytes().decode('latin-1')
+            for i, readPair in enumerate(misses.tolist()):
+                index, barcode, hammingDistance = self.barcodeFileParser.getIndexCorrectedBarcodeAndHammingDistance(
+                    alias=self.barcodeFileAlias, barcode=missedBarcodes[i*self.barcodeLength:(i+1)*self.barcodeLength])
+                if index is not None:
+                    mask[readPair] = True
+                    cellIndices[readPair] = self.batchBarcodePositions[barcode]+hammingDistance*len(self.batchBarcodePositions)
+        return mask, cellIndices
+
+    def getRejectReason(self, records):
+        if len(records)!=2:
+            return 'Not mate pair'
+        rawBarcode = records[self.barcodeRead].sequence[self.barcodeStart:self.barcodeStart+self.barcodeLength]
+        hammingDistance, collidingBarcodes = self.barcodeFileParser.getCollidingBarcodes(rawBarcode, self.barcodeFileAlias)
+        if len(collidingBarcodes):
+            return f'barcode collision at hamming distance {hammingDistance}: ' + ', '.join( f'{index} ({barcode})' for index, barcode in collidingBarcodes )
+        return 'barcode not found'
+
+    def getPrefilterWindow(self):
+        if self.barcodeFileParser.usesCorrectionIndex(self.barcodeFileAlias):
+            # The corrected barcodes are not enumerated, the strategy is demultiplexed instead
+            return None
+        return (self.barcodeRead, self.barcodeStart, self.barcodeLength,
+            set(self.barcodeFileParser.barcodes[self.barcodeFileAlias]).union(self.barcodeFileParser.extendedBarcodes[self.barcodeFileAlias]) )
+
+    def demultiplex(self, records, batchBarcode=None, **kwargs):
+        """Demultiplex a read pair, batchBarcode is the barcode entry of the read pair as resolved by demultiplexBatch"""
 
         # Check if the supplied reads are mate-pair:
         if len(records)!=2:
@@ -386,10 +593,15 @@ class UmiBarcodeDemuxMethod(IlluminaBaseDemultiplexer):
         rawBarcode = records[self.barcodeRead].sequence[self.barcodeStart:self.barcodeStart+self.barcodeLength]
         barcodeQual =  records[self.barcodeRead].qual[self.barcodeStart:self.barcodeStart+self.barcodeLength]
 
-        barcodeIdentifier, barcode, hammingDistance = self.barcodeFileParser.getIndexCorrectedBarcodeAndHammingDistance(alias=self.barcodeFileAlias, barcode=rawBarcode)
+        if batchBarcode is not None:
+            barcodeIdentifier, barcode, hammingDistance = batchBarcode
+        else:
+            barcodeIdentifier, barcode, hammingDistance = self.barcodeFileParser.getIndexCorrectedBarcodeAndHammingDistance(alias=self.barcodeFileAlias, barcode=rawBarcode)
         #print(barcodeIdentifier, barcode, hammingDistance)
         if barcodeIdentifier is None:
-            raise NonMultiplexable('barcode not set')
+            raise NonMultiplexable(self.getRejectReason(records))
+        if kwargs.get('context') is not None:
+            kwargs['context'].cellBarcodes[self.shortName] = (barcodeIdentifier, hammingDistance)
 
         if self.umiLength!=0:
             umi = records[self.umiRead].sequence[self.umiStart:self.umiStart+self.umiLength]
@@ -427,3 +639,43 @@ class UmiBarcodeDemuxMethod(IlluminaBaseDemultiplexer):
 
 
         #return fastqIterator.FastqRecord(header, records[1].sequence, records[1].plus,  records[1].qual )
+
+
+class BarcodePrefilterIndex():
+    """Combined barcode index of multiple demultiplexing strategies.
+
+    Maps every barcode window (read, start, length) and the barcode found in the window to the strategies which accept the barcode.
+    The yield of all indexed strategies is obtained with one lookup per window, without demultiplexing the read pairs.
+    """
+    def __init__(self, strategies):
+        self.windows = collections.defaultdict(dict) # (read, start, length) -> barcode -> tuple of strategy short names
+        self.unindexedStrategies = [] # Strategies without prefilter window, these need to be demultiplexed
+        for strategy in strategies:
+            window = strategy.getPrefilterWindow()
+            if window is None:
+                self.unindexedStrategies.append(strategy)
+                continue
+            read, start, length, barcodes = window
+            table = self.windows[(read, start, length)]
+            for barcode in barcodes:
+                key = barcode.encode('ascii')
+                table[key] = table.get(key, ()) + (strategy.shortName,)
+
+    def scoreChunk(self, chunk):
+        """Determine the yield of the indexed strategies for a chunk of fastq record blocks (one block per mate).
+
+        Returns the amount of read pairs in the chunk and a Counter with the yield per strategy short name
+        """
+        strategyYields = collections.Counter()
+        if len(chunk)==0:
+            return 0, strategyYields
+        sequences = [ (block.replace(b'\r', b'') if b'\r' in block else block).split(b'\n')[1::4] for block in chunk ]
+        if len(chunk)!=2:
+            # The strategies require mate pairs
+            return len(sequences[0]), strategyYields
+        for (read, start, length), table in self.windows.items():
+            end = start+length
+            for barcode, count in collections.Counter( sequence[start:end] for sequence in sequences[read] ).items():
+                for shortName in table.get(barcode, ()):
+                    strategyYields[shortName] += count
+        return len(sequences[0]), strategyYields
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Micro-benchmarks of the stages of demultiplexing on synthetic read pairs, Buys de Barbanson
+import argparse
+import glob
+import gzip
+import importlib
+import inspect
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from colorama import Fore
+from colorama import Style
+import barcodeFileParser
+import fastqIterator
+import bgzf
+import unalignedBam
+from baseDemultiplexMethods import TaggedRecord,TagDefinitions,UmiBarcodeDemuxMethod,ReadPairContext,NonMultiplexable,phredToFastqHeaderSafeQualities
+
+def loadStrategies(barcodeParser, indexParser, ignoreMethods=()):
+	"""Instantiate the demultiplexing strategies of all modules in demultiplexModules, like demux.py does"""
+	strategies = []
+	moduleSearchPath = os.path.join( os.path.dirname(os.path.realpath(__file__)), 'demultiplexModules')
+	for modulePath in sorted(glob.glob(f'{moduleSearchPath}/*.py')):
+		module = os.path.basename(modulePath).replace('.py','')
+		if module in ignoreMethods or module=='__init__':
+			continue
+		try:
+			loadedModule = importlib.import_module(f'demultiplexModules.{module}')
+		except Exception as e:
+			print(f'{Fore.RED}Failed loading {module}: {e}{Style.RESET_ALL}')
+			continue
+		for className, class_ in inspect.getmembers(loadedModule, lambda member: inspect.isclass(member) and member.__module__==loadedModule.__name__):
+			strategies.append( class_(barcodeFileParser=barcodeParser, indexFileParser=indexParser) )
+	return strategies
+
+
+def generateReadPairs(strategy, count, barcodeParser, indexParser, seed=0, readLength=75, errorRate=0.1, foreignRate=0.1):
+	"""Generate deterministic synthetic read pairs (tuples of FastqRecords) in the layout of strategy.
+
+	The cell barcodes are taken from the barcode file of the strategy, errorRate of the barcodes contain a substitution,
+	foreignRate of the barcodes are random sequences. The sequencing indices are taken from the index file of the strategy
+	"""
+	rng = random.Random(seed)
+	indices = sorted(indexParser.barcodes[strategy.illuminaIndicesAlias] if getattr(strategy, 'illuminaIndicesAlias', None) is not None else {}) or ['N']
+	barcodes = None
+	if isinstance(strategy, UmiBarcodeDemuxMethod):
+		barcodes = sorted(barcodeParser.barcodes[strategy.barcodeFileAlias])
+
+	def substitute(sequence):
+		position = rng.randrange(len(sequence))
+		return sequence[:position] + rng.choice('ACGTN'.replace(sequence[position], '')) + sequence[position+1:]
+
+	readPairs = []
+	for readPairIndex in range(count):
+		header = f'NS500413:32:H14TKBGXX:{1+readPairIndex%4}:{11101+readPairIndex%12}:{rng.randint(1,25000)}:{rng.randint(1,25000)}'
+		index = indices[rng.randrange(len(indices))]
+		if rng.random()<errorRate:
+			index = substitute(index)
+		sequences = [ ''.join(rng.choices('ACGT', k=readLength)) for mate in range(2) ]
+		if barcodes is not None:
+			if rng.random()<foreignRate:
+				barcode = ''.join(rng.choices('ACGT', k=strategy.barcodeLength))
+			else:
+				barcode = barcodes[rng.randrange(len(barcodes))]
+				if rng.random()<errorRate:
+					barcode = substitute(barcode)
+			sequence = sequences[strategy.barcodeRead]
+			sequences[strategy.barcodeRead] = sequence[:strategy.barcodeStart] + barcode + sequence[strategy.barcodeStart+len(barcode):]
+		qualities = [ ''.join(rng.choices('#<AEF', weights=(1,2,4,8,16), k=readLength)) for mate in range(2) ]
+		readPairs.append( tuple( fastqIterator.FastqRecord(f'{header} {mate+1}:N:0:{index}', sequences[mate], '+', qualities[mate]) for mate in range(2) ) )
+	return readPairs
+
+
+def toFastq(records):
+	return ''.join( f'@{record.header}\n{record.sequence}\n{record.plus}\n{record.qual}\n' for record in records )
+
+
+def measure(function, repeats=3):
+	"""Execute function repeats times, returns the amount of processed items and the lowest time"""
+	best = None
+	for repeat in range(repeats):
+		start = time.perf_counter()
+		items = function()
+		duration = time.perf_counter()-start
+		best = duration if best is None else min(best, duration)
+	return items, best
+
+
+def benchmarkParsing(readPairs, directory, repeats):
+	"""Parsing of fastq files, plain and gzipped, per record and per batch"""
+	paths = {}
+	for compressed in (False, True):
+		paths[compressed] = [ f'{directory}/R{mate+1}.fastq{".gz" if compressed else ""}' for mate in range(2) ]
+		for mate, path in enumerate(paths[compressed]):
+			with (gzip.open(path, 'wt', compresslevel=1) if compressed else open(path, 'w')) as f:
+				f.write(toFastq( readPair[mate] for readPair in readPairs ))
+
+	def iterateRecords(paths):
+		return 2*sum( 1 for readPair in fastqIterator.FastqIterator(*paths) )
+
+	def iterateBatches(paths):
+		records = 0
+		batches = fastqIterator.FastqBatchIterator(*paths)
+		for batch in batches:
+			records += 2*len(fastqIterator.blocksToReadPairs(batch))
+		batches.close()
+		return records
+
+	results = {}
+	for compressed in (False, True):
+		suffix = 'Gzip' if compressed else ''
+		results[f'FastqIterator{suffix}'] = measure(lambda: iterateRecords(paths[compressed]), repeats) + ('records',)
+		results[f'FastqBatchIterator{suffix}'] = measure(lambda: iterateBatches(paths[compressed]), repeats) + ('records',)
+	return results
+
+
+def benchmarkComponents(readPairs, indexParser, indexAlias, repeats):
+	"""The tagging functions called for every record"""
+	def correctIndices():
+		for reads in readPairs:
+			indexParser.getIndexCorrectedBarcodeAndHammingDistance(barcode=reads[0].header.rsplit(':',1)[1], alias=indexAlias)
+		return len(readPairs)
+
+	def tagRecords():
+		calls = 0
+		for reads in readPairs:
+			record = TaggedRecord(TagDefinitions)
+			record.fromRawFastq(reads[0])
+			record.addTagByTag('RX', reads[0].sequence[:6])
+			record.addTagByTag('RQ', reads[0].qual[:6])
+			record.addTagByTag('BC', reads[0].sequence[6:14])
+			record.addTagByTag('QT', reads[0].qual[6:14])
+			calls += 15 # fromRawFastq adds 11 tags
+		return calls
+
+	def encodeQualities():
+		for reads in readPairs:
+			phredToFastqHeaderSafeQualities(reads[0].qual[:14])
+		return len(readPairs)
+
+	return {
+		'getIndexCorrectedBarcodeAndHammingDistance':measure(correctIndices, repeats) + ('lookups',),
+		'TaggedRecord.addTagByTag':measure(tagRecords, repeats) + ('tags',),
+		'phredToFastqHeaderSafeQualities':measure(encodeQualities, repeats) + ('quality strings',),
+	}
+
+
+def benchmarkStrategy(strategy, readPairs, barcodeParser, repeats):
+	"""Demultiplexing of the read pairs by strategy, per read pair and (when supported) per batch.
+
+	Returns the results and the demultiplexed records
+	"""
+	demultiplexedRecords = []
+	def demultiplex():
+		demultiplexedRecords.clear()
+		for reads in readPairs:
+			try:
+				demultiplexedRecords.append( strategy.demultiplex(reads, library='benchmark', context=ReadPairContext(reads)) )
+			except NonMultiplexable:
+				pass
+		return len(readPairs)
+	results = {f'demultiplex:{strategy.shortName}':measure(demultiplex, repeats) + ('read pairs',)}
+
+	if isinstance(strategy, UmiBarcodeDemuxMethod):
+		def lookupBarcodes():
+			for reads in readPairs:
+				sequence = reads[strategy.barcodeRead].sequence
+				barcodeParser.getIndexCorrectedBarcodeAndHammingDistance(barcode=sequence[strategy.barcodeStart:strategy.barcodeStart+strategy.barcodeLength], alias=strategy.barcodeFileAlias)
+			return len(readPairs)
+		results[f'getIndexCorrectedBarcodeAndHammingDistance:{strategy.shortName}'] = measure(lookupBarcodes, repeats) + ('lookups',)
+
+	chunkSize = 5000
+	chunks = [ (readPairs[start:start+chunkSize], tuple( toFastq( readPair[mate] for readPair in readPairs[start:start+chunkSize] ).encode() for mate in range(2) )) for start in range(0, len(readPairs), chunkSize) ]
+	if strategy.demultiplexBatch(chunks[0][1]) is not None:
+		def demultiplexBatches():
+			for chunkReadPairs, blocks in chunks:
+				mask, cellIndices = strategy.demultiplexBatch(blocks)
+				entries = strategy.getBatchBarcodeTable()[1]
+				for reads, cellIndex in zip(chunkReadPairs, cellIndices.tolist()):
+					if cellIndex>=0:
+						strategy.demultiplex(reads, library='benchmark', context=ReadPairContext(reads), batchBarcode=entries[cellIndex])
+			return len(readPairs)
+		results[f'demultiplexBatch:{strategy.shortName}'] = measure(demultiplexBatches, repeats) + ('read pairs',)
+	return results, demultiplexedRecords
+
+
+def benchmarkWriting(demultiplexedRecords, repeats, threads=1, compressionLevel=6):
+	"""Writing of demultiplexed records, as done by the output handles of demux.py"""
+	def writeFastq():
+		with open(os.devnull, 'wb') as rawHandle:
+			writer = bgzf.BgzfWriter(rawHandle, level=compressionLevel, threads=threads)
+			for records in demultiplexedRecords:
+				for record in records:
+					writer.write(record.encode())
+			writer.close()
+		return 2*len(demultiplexedRecords)
+
+	def writeBam():
+		with open(os.devnull, 'wb') as rawHandle:
+			writer = bgzf.BgzfWriter(rawHandle, level=compressionLevel, threads=threads)
+			for records in demultiplexedRecords:
+				writer.write(unalignedBam.encodeReadPair(records))
+			writer.close()
+		return 2*len(demultiplexedRecords)
+
+	return {
+		'FastqHandle.write':measure(writeFastq, repeats) + ('records',),
+		'UnalignedBamHandle.write':measure(writeBam, repeats) + ('records',),
+	}
+
+
+def getCommit():
+	try:
+		return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.realpath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+if __name__ == '__main__':
+	argparser = argparse.ArgumentParser(
+	 formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+	 description='Measure the throughput of the stages of demultiplexing on deterministic synthetic read pairs, generated for the layout of every demultiplexing strategy. The results can be stored as JSON and compared to the results of another commit')
+	argparser.add_argument('-n', help="Amount of read pairs generated for every strategy", type=int, default=20000)
+	argparser.add_argument('-repeats', help="Every measurement is repeated this amount of times, the fastest repeat is reported", type=int, default=3)
+	argparser.add_argument('-seed', help="Seed of the synthetic read pair generator", type=int, default=0)
+	argparser.add_argument('-use', help="Only benchmark these strategies (comma separated short names), by default all strategies are benchmarked", type=str, default=None)
+	argparser.add_argument('-hd', help="Hamming distance barcode expansion, see demux.py", type=int, default=0)
+	argparser.add_argument('-hdi', help="Hamming distance index expansion, see demux.py", type=int, default=1)
+	argparser.add_argument('-barcodeCorrection', choices=['auto', 'expand', 'index'], default='auto', help="How barcodes and indices are corrected, see demux.py")
+	argparser.add_argument('-threads', help="Amount of compression threads used when writing", type=int, default=1)
+	argparser.add_argument('-compressionLevel', help="Compression level used when writing", type=int, default=6)
+	argparser.add_argument('-o', help="Store the results as JSON at this path", type=str, default=None)
+	argparser.add_argument('-compare', help="Compare the results to results stored using -o", type=str, default=None)
+	args = argparser.parse_args()
+
+	barcodeParser = barcodeFileParser.BarcodeParser(hammingDistanceExpansion=args.hd, correction=args.barcodeCorrection)
+	indexParser = barcodeFileParser.BarcodeParser(hammingDistanceExpansion=args.hdi, barcodeDirectory='indices', correction=args.barcodeCorrection)
+	strategies = loadStrategies(barcodeParser, indexParser, ignoreMethods=('restriction-bisulfite','scarsMiSeq'))
+	# The stages which do not depend on the strategy are measured on read pairs in the CELSeq2 layout
+	referenceStrategy = next( (strategy for strategy in strategies if strategy.shortName=='CS2C8U6'), strategies[0] )
+	if args.use is not None:
+		strategies = [ strategy for strategy in strategies if strategy.shortName in args.use.split(',') ]
+
+	measurements = {}
+	directory = tempfile.mkdtemp(prefix='demux_benchmark_')
+	try:
+		readPairs = generateReadPairs(referenceStrategy, args.n, barcodeParser, indexParser, seed=args.seed)
+		measurements.update( benchmarkParsing(readPairs, directory, args.repeats) )
+		measurements.update( benchmarkComponents(readPairs, indexParser, referenceStrategy.illuminaIndicesAlias, args.repeats) )
+		for strategy in strategies:
+			strategyMeasurements, _ = benchmarkStrategy(strategy, generateReadPairs(strategy, args.n, barcodeParser, indexParser, seed=args.seed), barcodeParser, args.repeats)
+			measurements.update(strategyMeasurements)
+		_, writtenRecords = benchmarkStrategy(referenceStrategy, readPairs, barcodeParser, repeats=1)
+		measurements.update( benchmarkWriting(writtenRecords, args.repeats, threads=args.threads, compressionLevel=args.compressionLevel) )
+	finally:
+		shutil.rmtree(directory)
+
+	results = {
+		'commit':getCommit(),
+		'python':platform.python_version(),
+		'settings':{ 'n':args.n, 'repeats':args.repeats, 'seed':args.seed, 'hd':args.hd, 'hdi':args.hdi, 'barcodeCorrection':args.barcodeCorrection, 'threads':args.threads, 'compressionLevel':args.compressionLevel },
+		'stages':{ stage:{ 'items':items, 'unit':unit, 'seconds':seconds, 'perSecond':items/seconds } for stage, (items, seconds, unit) in measurements.items() }
+	}
+	previous = None
+	if args.compare is not None:
+		with open(args.compare) as f:
+			previous = json.load(f)
+
+	print(f'{Style.BRIGHT}{"Stage":<64}{"per second":>14}{"":>10}{Style.RESET_ALL}')
+	for stage, result in results['stages'].items():
+		change = ''
+		if previous is not None and stage in previous['stages']:
+			ratio = result['perSecond']/previous['stages'][stage]['perSecond']
+			change = f'{Fore.GREEN if ratio>=1 else Fore.RED}{100*(ratio-1):+.1f}%{Style.RESET_ALL}'
+		print(f'{stage:<64}{result["perSecond"]:>14.0f} {Style.DIM}{result["unit"]}{Style.RESET_ALL} {change}')
+	if args.o is not None:
+		with open(args.o, 'w') as f:
+			json.dump(results, f, indent=1)
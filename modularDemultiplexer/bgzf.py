@@ -0,0 +1,200 @@
+# BGZF (blocked gzip) reading and writing, Buys de Barbanson
+import collections
+import concurrent.futures
+import io
+import os
+import struct
+import zlib
+
+# A BGZF block is a gzip member with the FEXTRA flag set, containing a 'BC' subfield with the block size
+bgzfMagic = b'\x1f\x8b\x08\x04'
+# An empty block marks the end of a BGZF file
+bgzfEofMarker = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+# Amount of uncompressed bytes in a block, the compressed block has to fit in 64KB
+bgzfBlockSize = 65280
+
+def isBgzf(path):
+	"""Check if the file at path starts with a BGZF block"""
+	with open(path, 'rb') as f:
+		header = f.read(18)
+	if len(header)<18 or header[:4]!=bgzfMagic:
+		return False
+	xlen = struct.unpack('<H', header[10:12])[0]
+	return xlen>=6 and header[12:14]==b'BC' and struct.unpack('<H', header[14:16])[0]==2
+
+
+def readBgzfBlock(handle):
+	"""Read one compressed BGZF block from handle
+
+	Returns a tuple (compressed data, crc32, uncompressed size) or None when the end of the file is reached
+	"""
+	header = handle.read(12)
+	if len(header)==0:
+		return None
+	if len(header)<12 or header[:4]!=bgzfMagic:
+		raise ValueError(f'Invalid BGZF block header in {getattr(handle, "name", handle)}')
+	xlen = struct.unpack('<H', header[10:12])[0]
+	extra = handle.read(xlen)
+	blockSize = None
+	position = 0
+	while position+4<=len(extra):
+		si1, si2, slen = struct.unpack('<BBH', extra[position:position+4])
+		if si1==66 and si2==67 and slen==2:
+			blockSize = struct.unpack('<H', extra[position+4:position+6])[0]+1
+		position += 4+slen
+	if blockSize is None:
+		raise ValueError(f'BGZF block without block size in {getattr(handle, "name", handle)}')
+	remainder = handle.read(blockSize-12-xlen)
+	if len(remainder)!=blockSize-12-xlen:
+		raise ValueError(f'Truncated BGZF block in {getattr(handle, "name", handle)}')
+	crc, uncompressedSize = struct.unpack('<II', remainder[-8:])
+	return remainder[:-8], crc, uncompressedSize
+
+
+def inflateBgzfBlock(compressedData, crc, uncompressedSize):
+	data = zlib.decompress(compressedData, -15)
+	if len(data)!=uncompressedSize or zlib.crc32(data)!=crc:
+		raise ValueError('BGZF block is corrupt, the size or checksum does not match')
+	return data
+
+
+class BgzfReader(io.RawIOBase):
+	"""Decompresses a BGZF file, the blocks are inflated in parallel on a thread pool.
+
+	The threads are only started when the first data is read.
+	Decompression starts at the block at byte offset.
+	Wrap in an io.BufferedReader to read fixed amounts of bytes.
+	"""
+
+	def __init__(self, path, threads=4, blocksPerThread=8, offset=0):
+		io.RawIOBase.__init__(self)
+		self.name = path
+		self.handle = open(path, 'rb')
+		self.handle.seek(offset)
+		self.threads = threads
+		self.maxPendingBlocks = threads*blocksPerThread
+		self.pool = None
+		self.pending = collections.deque()
+		self.buffer = memoryview(b'')
+		self.eof = False
+
+	def readable(self):
+		return True
+
+	def _submitBlocks(self):
+		while not self.eof and len(self.pending)<self.maxPendingBlocks:
+			block = readBgzfBlock(self.handle)
+			if block is None:
+				self.eof = True
+				break
+			self.pending.append( self.pool.submit(inflateBgzfBlock, *block) )
+
+	def readinto(self, b):
+		if self.pool is None:
+			self.pool = concurrent.futures.ThreadPoolExecutor(self.threads)
+		while len(self.buffer)==0:
+			self._submitBlocks()
+			if len(self.pending)==0:
+				return 0
+			self.buffer = memoryview(self.pending.popleft().result())
+		n = min(len(b), len(self.buffer))
+		b[:n] = self.buffer[:n]
+		self.buffer = self.buffer[n:]
+		return n
+
+	def close(self):
+		if self.pool is not None:
+			for future in self.pending:
+				future.cancel()
+			self.pool.shutdown()
+			self.pool = None
+		self.handle.close()
+		io.RawIOBase.close(self)
+
+
+def deflateBgzfBlock(data, level=6):
+	"""Compress data (at most bgzfBlockSize bytes) into a complete BGZF block"""
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+	compressedData = compressor.compress(data)+compressor.flush()
+	header = bgzfMagic + struct.pack('<IBBHBBHH', 0, 0, 255, 6, 66, 67, 2, 18+len(compressedData)+8-1)
+	return header + compressedData + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+class BgzfWriter(io.RawIOBase):
+	"""Compresses the written data into BGZF blocks, the blocks are deflated in parallel on a thread pool.
+
+	The blocks are written to handle (an opened binary file) in the order the data was written.
+	When threads is 1 the blocks are compressed in the calling thread. Multiple writers can share
+	one thread pool by supplying pool. Closing the writer adds the end of file marker, the handle
+	is not closed.
+	"""
+
+	def __init__(self, handle, level=6, threads=4, blocksPerThread=8, pool=None):
+		io.RawIOBase.__init__(self)
+		self.handle = handle
+		self.level = level
+		self.threads = threads
+		self.maxPendingBlocks = threads*blocksPerThread
+		self.pool = pool
+		self.ownsPool = pool is None
+		self.pending = collections.deque()
+		self.buffer = bytearray()
+
+	def writable(self):
+		return True
+
+	def _submitBlock(self, data):
+		if self.threads<=1 and self.ownsPool:
+			self.handle.write(deflateBgzfBlock(data, self.level))
+			return
+		if self.pool is None:
+			self.pool = concurrent.futures.ThreadPoolExecutor(self.threads)
+		self.pending.append( self.pool.submit(deflateBgzfBlock, data, self.level) )
+		while len(self.pending)>self.maxPendingBlocks:
+			self.handle.write(self.pending.popleft().result())
+
+	def write(self, b):
+		self.buffer += b
+		if len(self.buffer)>=bgzfBlockSize:
+			data = bytes(self.buffer)
+			end = len(data)-len(data)%bgzfBlockSize
+			for start in range(0, end, bgzfBlockSize):
+				self._submitBlock(data[start:start+bgzfBlockSize])
+			del self.buffer[:end]
+		return len(b)
+
+	def flush(self):
+		"""Compress the buffered data into a (smaller) block and write all pending blocks to the handle"""
+		if self.closed:
+			return
+		if len(self.buffer):
+			self._submitBlock(bytes(self.buffer))
+			self.buffer.clear()
+		while len(self.pending):
+			self.handle.write(self.pending.popleft().result())
+		self.handle.flush()
+
+	def close(self):
+		if self.closed:
+			return
+		self.flush()
+		self.handle.write(bgzfEofMarker)
+		self.handle.flush()
+		if self.ownsPool and self.pool is not None:
+			self.pool.shutdown()
+			self.pool = None
+		io.RawIOBase.close(self)
+
+
+def openBgzfForAppending(path):
+	"""Open the BGZF file at path to write more blocks to it, the end of file marker is removed. The file is created when it does not exist"""
+	if not os.path.exists(path):
+		return open(path, 'wb')
+	handle = open(path, 'r+b')
+	handle.seek(0, os.SEEK_END)
+	if handle.tell()>=len(bgzfEofMarker):
+		handle.seek(-len(bgzfEofMarker), os.SEEK_END)
+		if handle.read()==bgzfEofMarker:
+			handle.seek(-len(bgzfEofMarker), os.SEEK_END)
+			handle.truncate()
+	return handle
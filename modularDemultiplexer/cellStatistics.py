@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Counters of the demultiplexed read pairs per cell and sequencing index, Buys de Barbanson
+import collections
+import json
+import os
+
+def createRows(barcodeCount, hammingDistanceExpansion):
+	return [ [0]*(hammingDistanceExpansion+1) for position in range(barcodeCount) ]
+
+
+class CellStatistics():
+	"""Counters of the demultiplexed read pairs, accumulated while demultiplexing.
+
+	For every strategy the read pairs per cell barcode, for every sequencing index alias the read pairs per index.
+	The counters are rows indexed by the position of the barcode in the barcode file (see BarcodeParser.getBarcodeIdentifiers),
+	every row contains the amount of read pairs at hamming distance 0, 1, ... of the barcode
+	"""
+	def __init__(self):
+		self.cells = {} # strategy short name -> rows
+		self.cellAliases = {} # strategy short name -> barcode alias
+		self.indices = {} # index alias -> rows
+		self.indicesNotFound = collections.Counter() # index alias -> read pairs of which the index could not be resolved
+
+	def addCell(self, strategy, barcodeIdentifier, hammingDistance):
+		identifiers, positions = strategy.barcodeFileParser.getBarcodeIdentifiers(strategy.barcodeFileAlias)
+		if not strategy.shortName in self.cells:
+			self.cells[strategy.shortName] = createRows(len(identifiers), strategy.barcodeFileParser.hammingDistanceExpansion)
+			self.cellAliases[strategy.shortName] = strategy.barcodeFileAlias
+		self.cells[strategy.shortName][positions[barcodeIdentifier]][hammingDistance] += 1
+
+	def addIndex(self, indexParser, alias, index):
+		"""Count the sequencing index (as read) of a read pair"""
+		identifier, _, hammingDistance = indexParser.getIndexCorrectedBarcodeAndHammingDistance(barcode=index, alias=alias)
+		if identifier is None:
+			self.indicesNotFound[alias] += 1
+			return
+		identifiers, positions = indexParser.getBarcodeIdentifiers(alias)
+		if not alias in self.indices:
+			self.indices[alias] = createRows(len(identifiers), indexParser.hammingDistanceExpansion)
+		self.indices[alias][positions[identifier]][hammingDistance] += 1
+
+	def add(self, other):
+		for table, otherTable in ((self.cells, other.cells), (self.indices, other.indices)):
+			for key, rows in otherTable.items():
+				if not key in table:
+					table[key] = [ list(row) for row in rows ]
+					continue
+				for row, otherRow in zip(table[key], rows):
+					for hammingDistance, count in enumerate(otherRow):
+						row[hammingDistance] += count
+		self.cellAliases.update(other.cellAliases)
+		self.indicesNotFound.update(other.indicesNotFound)
+
+	def asDict(self):
+		return {'cells':self.cells, 'cellAliases':self.cellAliases, 'indices':self.indices, 'indicesNotFound':dict(self.indicesNotFound)}
+
+	@staticmethod
+	def fromDict(values):
+		statistics = CellStatistics()
+		statistics.cells = values['cells']
+		statistics.cellAliases = values['cellAliases']
+		statistics.indices = values['indices']
+		statistics.indicesNotFound = collections.Counter(values['indicesNotFound'])
+		return statistics
+
+
+def summariseRows(rows, barcodeParser, alias):
+	"""Obtain the read pairs per barcode identifier and the hamming distance histogram of rows"""
+	identifiers, _ = barcodeParser.getBarcodeIdentifiers(alias)
+	return {
+		'readPairs':sum( sum(row) for row in rows ),
+		'hammingDistances':[ sum(counts) for counts in zip(*rows) ],
+		'barcodes':{ str(identifier):row for identifier, row in zip(identifiers, rows) if sum(row) }
+	}
+
+
+def writeCellStatistics(directory, statistics, strategyYields, barcodeParser, indexParser):
+	"""Write the read pairs per cell to cells.tsv and the yields and barcode and index statistics to cellStatistics.json in directory"""
+	hammingDistances = barcodeParser.hammingDistanceExpansion+1
+	with open(f'{directory}/cells.tsv.{os.getpid()}.tmp', 'w') as f:
+		f.write('\t'.join(['strategy', 'barcodeIdentifier', 'barcode', 'readPairs'] + [ f'hammingDistance{hammingDistance}' for hammingDistance in range(hammingDistances) ]) + '\n')
+		for strategy, rows in sorted(statistics.cells.items()):
+			alias = statistics.cellAliases[strategy]
+			identifiers, _ = barcodeParser.getBarcodeIdentifiers(alias)
+			barcodes = { identifier:barcode for barcode, identifier in barcodeParser.barcodes[alias].items() }
+			for identifier, row in zip(identifiers, rows):
+				f.write('\t'.join(map(str, [strategy, identifier, barcodes[identifier], sum(row)] + row)) + '\n')
+	os.replace(f'{directory}/cells.tsv.{os.getpid()}.tmp', f'{directory}/cells.tsv')
+
+	with open(f'{directory}/cellStatistics.json.{os.getpid()}.tmp', 'w') as f:
+		json.dump({
+			'strategyYields':dict(strategyYields),
+			'cells':{ strategy:dict(summariseRows(rows, barcodeParser, statistics.cellAliases[strategy]), barcodeAlias=statistics.cellAliases[strategy], cells=sum( 1 for row in rows if sum(row) ))
+				for strategy, rows in statistics.cells.items() },
+			'indices':{ alias:dict(summariseRows(statistics.indices.get(alias, []), indexParser, alias), notFound=statistics.indicesNotFound[alias])
+				for alias in set(statistics.indices).union(statistics.indicesNotFound) },
+		}, f, indent=1)
+	os.replace(f'{directory}/cellStatistics.json.{os.getpid()}.tmp', f'{directory}/cellStatistics.json')
@@ -3,6 +3,7 @@ from baseDemultiplexMethods import DemultiplexingStrategy
 from baseDemultiplexMethods import NonMultiplexable
 from baseDemultiplexMethods import TaggedRecord
 from baseDemultiplexMethods import TagDefinitions
+from baseDemultiplexMethods import ReadPairContext
 import barcodeFileParser
 
 
@@ -21,11 +22,13 @@ class IlluminaBaseDemultiplexer(DemultiplexingStrategy):
 		self.barcodeSummary='Bulk, no cell barcodes'
 		self.indexSummary = f'sequencing indices: {illuminaIndicesAlias}'
 
-	def demultiplex(self, records, library=None):
+	def demultiplex(self, records, library=None, context=None):
 		global TagDefinitions
 
+		if context is None:
+			context = ReadPairContext(records)
 		try:
-			return [TaggedRecord(rawRecord=record,tagDefinitions=TagDefinitions,indexFileParser=self.indexFileParser, indexFileAlias=self.illuminaIndicesAlias, library=library).asFastq(record.sequence, record.plus, record.qual) for record in records]
+			return [TaggedRecord(headerTags=context.getHeaderTags(mateIndex, self.indexFileParser, self.illuminaIndicesAlias),tagDefinitions=TagDefinitions, library=library).asFastq(record.sequence, record.plus, record.qual) for mateIndex, record in enumerate(records)]
 		except NonMultiplexable:
 			raise
 		except Exception as e:
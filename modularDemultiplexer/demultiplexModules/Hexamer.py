@@ -2,6 +2,7 @@ from baseDemultiplexMethods import DemultiplexingStrategy
 from baseDemultiplexMethods import NonMultiplexable
 from baseDemultiplexMethods import TaggedRecord
 from baseDemultiplexMethods import TagDefinitions
+from baseDemultiplexMethods import ReadPairContext
 
 # ask buys or annaa about it
 
@@ -20,9 +21,11 @@ class HexamerBaseDemultiplexer(DemultiplexingStrategy):
         self.barcodeSummary='Bulk, no cell barcodes'
         self.indexSummary = f'sequencing indices: {illuminaIndicesAlias}'
 
-    def demultiplex(self, records, library=None):
+    def demultiplex(self, records, library=None, context=None):
         global TagDefinitions
 
+        if context is None:
+            context = ReadPairContext(records)
         try:
             h0 = records[0].sequence[:self.hexLength]
             h1 = records[0].qual[:self.hexLength]
@@ -30,8 +33,8 @@ class HexamerBaseDemultiplexer(DemultiplexingStrategy):
                 h2 = records[1].sequence[:self.hexLength]
                 h3 = records[1].qual[:self.hexLength]
             trs = []
-            for record in records:
-                t = TaggedRecord(rawRecord=record,tagDefinitions=TagDefinitions,indexFileParser=self.indexFileParser, indexFileAlias=self.illuminaIndicesAlias, library=library)
+            for mateIndex, record in enumerate(records):
+                t = TaggedRecord(headerTags=context.getHeaderTags(mateIndex, self.indexFileParser, self.illuminaIndicesAlias),tagDefinitions=TagDefinitions, library=library)
                 t.addTagByTag('H0', h0, isPhred=False)
                 t.addTagByTag('H1', h1, isPhred=True)
                 if len(records)>1:
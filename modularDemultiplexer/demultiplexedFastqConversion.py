@@ -28,10 +28,12 @@ if len(seqfeatures)!=len(qualityfeatures):
 
 
 TagDefinitions = baseDemultiplexMethods.TagDefinitions
+# Files with compact headers have a header manifest (see demux.py --compactHeaders)
+manifests = [ baseDemultiplexMethods.readHeaderManifest(path) for path in args.fastqfiles ]
 for reads in FastqIterator(*args.fastqfiles):
     for readIndex, record in enumerate(reads):
         tr = baseDemultiplexMethods.TaggedRecord(TagDefinitions)
-        tr.fromTaggedFastq(record)
+        tr.fromTaggedFastq(record, manifest=manifests[readIndex])
         sequence = ''.join((record.sequence if tag=='SEQ' else tr.tags.get(tag) for tag in seqfeatures))
         qualities = ''.join((record.qual if tag=='QUAL' else tr.tags.get(tag) for tag in qualityfeatures))
         if len(sequence)!=len(qualities):
@@ -3,7 +3,6 @@
 import os
 import sys
 import re
-import gzip
 from colorama import Fore
 from colorama import Back
 from colorama import Style
@@ -16,8 +15,25 @@ import traceback
 import collections
 import fastqIterator
 import glob
+import multiprocessing
+import shutil
+import math
+import random
+import time
+import json
+import io
+import tempfile
+import resource
+import cProfile
+import fastqIndex
+import bgzf
+import unalignedBam
+import libraryScheduler
+from outputHandles import FastqHandle,RejectSampleHandle,UnalignedBamHandle,CellFastqHandle,InterleavedStreamHandle
+from stageStatistics import StageStatistics,writeRunReport
+from cellStatistics import CellStatistics,writeCellStatistics
 from colorama import init
-from baseDemultiplexMethods import NonMultiplexable,IlluminaBaseDemultiplexer
+from baseDemultiplexMethods import NonMultiplexable,IlluminaBaseDemultiplexer,ReadPairContext,BarcodePrefilterIndex,TaggedRecord,TagDefinitions,compactHeaderTags,writeHeaderManifest,headerManifestName
 import demultiplexModules
 init()
 import logging
@@ -42,6 +58,7 @@ argparser.add_argument('-experimentName', '-e', help="Name of the experiment, se
 inputArgs = argparser.add_argument_group('Input', '')
 inputArgs.add_argument('-n', help="Only get the first n properly demultiplexable reads from a library", type=int)
 inputArgs.add_argument('-r', help="Only get the first n reads from a library, then demultiplex", type=int)
+inputArgs.add_argument('--interleaved', help="The input files contain both mates, the records of mate 1 and mate 2 alternate. Every input file is treated as a lane of its own library, named after the file or -slib. Use - to read from stdin, named pipes are supported as well (use -use for streams, these can not be autodetected). Not sharded", action='store_true')
 inputArgs.add_argument('-slib', help="Assume all files belong to the same library, this flag supplies the name", type=str )
 inputArgs.add_argument('-replace', action='append', default=None, help="""Replace part of the library name by another string, [SEARCH,REPLACEMENT]. For example if you want to remove FOO from the library name use "-replace FOO," if you want to replace FOO by BAR use "-replace FOO,BAR" """)
 
@@ -50,11 +67,15 @@ Options:None, delimiter[position], examples, given the samplename 'library_a_b':
 inputArgs.add_argument('--ignore', action='store_true', help="Ignore non-demultiplexable read files")
 #inputArgs.add_argument('-bfsp', help="Barcode file searchpaths", type=str, default='/media/sf_data/references,/hpc/hub_oudenaarden/bdebarbanson/ref')
 outputArgs = argparser.add_argument_group('Output', '')
-argparser.add_argument('--norejects', help="Do not store rejected reads",  action='store_true')
+argparser.add_argument('--norejects', help="Do not store rejected reads, the same as -rejects none",  action='store_true')
+outputArgs.add_argument('-rejects', help="How rejected read pairs are stored. tagged: with the tags obtained from the illumina header, raw: as they were read, sample: a random sample of -rejectSample raw read pairs, none: not stored. The reasons of rejection are counted in all modes", choices=['tagged','raw','sample','none'], default='tagged')
+outputArgs.add_argument('-rejectSample', help="Amount of read pairs stored when using -rejects sample", type=int, default=10000)
 
-outputArgs.add_argument('-o', help="Output (cell) file directory, when not supplied the current directory/raw_demultiplexed is used", type=str, default='./raw_demultiplexed')
+outputArgs.add_argument('-o', help="Output (cell) file directory, when not supplied the current directory/raw_demultiplexed is used. Use - to write the demultiplexed read pairs as uncompressed interleaved fastq to stdout (for example to pipe into bwa mem -p), the rejects are not stored and all messages are written to stderr", type=str, default='./raw_demultiplexed')
 
-#outputArgs.add_argument('--nosepf', help="If this flag is not set every cell gets a separate FQ file, otherwise all cells are put in the same file", action='store_true' )
+outputArgs.add_argument('--sepf', help="Every cell gets a separate fastq file pair in the cells directory of the library, named after the strategy (MX tag) and cell (BI tag, or SM tag). Otherwise all cells are put in the same file", action='store_true' )
+outputArgs.add_argument('-outputFormat', help="Format of the demultiplexed read pairs. fastq: a gzipped fastq file for every mate, with the tags in the read names. bam: one unaligned BAM file (demultiplexed.bam), every mate is stored with typed tags and pairing flags. The rejects are always stored as fastq, bam can not be combined with --sepf or -o -", choices=['fastq','bam'], default='fastq')
+outputArgs.add_argument('--compactHeaders', help="Tags which are the same for nearly all reads of a library (instrument, run, flow cell, lane, library, strategy, ...) are stored once in headers.manifest next to the fastq files, the read headers only contain the other tags. Use baseDemultiplexMethods.readHeaderManifest and TaggedRecord.fromTaggedFastq to restore all tags", action='store_true')
 #outputArgs.add_argument('--nogz', help="Output files are not gzipped", action='store_true' )
 #outputArgs.add_argument('-submit', default=None, type=str, help="Create cluster submission file")
 
@@ -63,6 +84,7 @@ bcArgs = argparser.add_argument_group('Barcode', '')
 bcArgs.add_argument('-hd', help="Hamming distance barcode expansion; accept cells with barcodes N distances away from the provided barcodes. Collisions are dealt with automatically. ", type=int, default=0)
 bcArgs.add_argument('--lbi', help="Summarize the barcodes being used for cell demultuplexing and sequencing indices.", action='store_true')
 bcArgs.add_argument('-barcodeDir', default='barcodes', help="Directory from which to obtain the barcodes")
+bcArgs.add_argument('-barcodeCorrection', choices=['auto', 'expand', 'index'], default='auto', help="How barcodes and indices are corrected within the hamming distance (-hd, -hdi). expand: all sequences within the distance are generated when the barcodes are loaded. index: sequences are corrected when they are looked up, using a segment index of the barcodes, the memory used is proportional to the amount of barcodes. auto: index is used for barcode files of which the expansion would generate more than 1 million sequences")
 
 bcArgs = argparser.add_argument_group('Index', '')
 bcArgs.add_argument('-hdi', help="Hamming distance INDEX sequence expansion, the hamming distance used for resolving the sequencing INDEX. For cell barcode hamming distance see -hd", type=int, default=1)
@@ -75,9 +97,23 @@ fragArgs = argparser.add_argument_group('Fragment configuration', '')
 fragArgs.add_argument('--se', help="Allow single end reads",  action='store_true')
 
 techArgs = argparser.add_argument_group('Technical', '')
-#techArgs.add_argument('-t', help="Amount of demultiplexing threads used" , type=int, default=8)
-#techArgs.add_argument('-fh', help="When demultiplexing to mutliple cell files in multiple threads, the amount of opened files can exceed the limit imposed by your operating system. The amount of open handles per thread is kept below this parameter to prevent this from happening.", default=32, type=int)
-techArgs.add_argument('-dsize', help="Amount of reads used to determine barcode type" , type=int, default=10000)
+techArgs.add_argument('-t', help="Amount of demultiplexing processes used. Read pairs are read by the main process and demultiplexed in chunks by the worker processes, the output is written in the original read order" , type=int, default=1)
+techArgs.add_argument('-chunkSize', help="Amount of read pairs sent to a demultiplexing process at once" , type=int, default=5000)
+techArgs.add_argument('-cores', help="Core budget, libraries and lanes are demultiplexed at the same time by separate processes (every process uses -t cores) as long as the budget allows it. Largest lanes are started first. By default all shards of a lane can run at the same time (-shards times -t cores). Not used when -n is supplied" , type=int, default=None)
+techArgs.add_argument('-memory', help="Memory budget (GB) for demultiplexing libraries and lanes at the same time, by default only the core budget is used" , type=float, default=None)
+techArgs.add_argument('-jobMemory', help="Expected amount of memory (GB) used for demultiplexing one lane, used for the memory budget" , type=float, default=1.0)
+techArgs.add_argument('-shards', help="Split every lane in this amount of read pair ranges, which are demultiplexed at the same time by separate processes (see -cores) and concatenated afterwards. The ranges start at checkpoints of the random access index of the input files, build it beforehand using fastqIndex.py. Lanes without an index with multiple checkpoints (single member gzip files) are demultiplexed as one shard. Not used when -n is supplied" , type=int, default=1)
+techArgs.add_argument('-prefetch', help="Amount of batches of read pairs read ahead for every input file by a background reader thread, 0 disables read-ahead" , type=int, default=4)
+techArgs.add_argument('-it', help="Amount of threads used to decompress every input file. BGZF files are decompressed in parallel, other gzip files are decompressed by pigz when available or in a background thread. Use 1 to decompress in the main thread" , type=int, default=2)
+techArgs.add_argument('-ot', help="Amount of threads used to compress the output files of every demultiplexing process. The output is written as BGZF, the blocks are compressed in parallel. Use 1 to compress in the main thread" , type=int, default=2)
+techArgs.add_argument('-compressionLevel', help="Gzip compression level of the output files, 1 is the fastest, 9 gives the smallest files" , type=int, default=6, choices=range(0,10), metavar='[0-9]')
+techArgs.add_argument('-fh', help="When demultiplexing to mutliple cell files (--sepf), the amount of opened files can exceed the limit imposed by your operating system. The amount of open cell files per process (one file per mate of a cell) is kept at or below this parameter to prevent this from happening, the files of the least recently used cell are closed first.", default=32, type=int)
+techArgs.add_argument('-checkpoint', help="Store the progress every this amount of seconds, a demultiplexing run which was interrupted can be continued from the last checkpoint using --resume. 0 disables checkpoints" , type=float, default=600)
+techArgs.add_argument('--resume', help="Continue an interrupted demultiplexing run from the last checkpoint, libraries which were finished are skipped", action='store_true')
+techArgs.add_argument('-estimateReads', help="When --y is not supplied, this amount of read pairs of every library is demultiplexed (into a temporary directory) to estimate the time, memory and disk space required by the run, the resources requested from the cluster are based on this estimate. This takes as long as demultiplexing the read pairs, for example 20000. By default (0) only the amount of read pairs is obtained, from the random access index or the size of the input files, and the default resources are requested" , type=int, default=0)
+techArgs.add_argument('-timingSample', help="Reading, demultiplexing and writing are timed for every chunk of read pairs, the stages of demultiplexing (record parsing, header parsing, barcode lookup, fastq formatting, tagging) are timed for one of every this amount of chunks. The timings, record and byte counters are stored in report.json in the output directory of every library. 0 disables timing the stages of demultiplexing" , type=int, default=16)
+techArgs.add_argument('-profileChunk', help="Profile the demultiplexing of this chunk (counted from 0) of the first lane of every library using cProfile, the profile is stored as profile.prof in the output directory of the library. Inspect the profile using python3 -m pstats" , type=int, default=None)
+techArgs.add_argument('-dsize', help="Maximum amount of reads used to determine barcode type. The reads are sampled from all lanes, sampling stops earlier when the selection of the strategies is settled" , type=int, default=100000)
 
 argparser.add_argument('-use',default=None, help='use these demultplexing strategies, comma separate to select multiple. For example for cellseq 2 data with 6 basepair umi: -use CS2C8U6 , for combined mspji and Celseq2: MSPJIC8U3,CS2C8U6 if nothing is specified, the best scoring method is selected' )
 
@@ -89,13 +125,21 @@ argparser.add_argument('-minAutoDetectPct','-mia', help='When --use is not speci
 args = argparser.parse_args()
 verbosity = 1
 
+if args.outputFormat=='bam' and (args.sepf or args.o=='-'):
+	argparser.error('-outputFormat bam can not be combined with --sepf or -o -')
+
+if args.o=='-':
+	# The demultiplexed read pairs are written to stdout, all messages are written to stderr
+	outputStream = sys.stdout
+	sys.stdout = sys.stderr
+
 ignoreMethods = args.ignoreMethods.split(',')
 
 if len(set(args.fastqfiles))!=len(args.fastqfiles):
 	print(f'{Fore.RED}{Style.BRIGHT}Some fastq files are supplied multiple times! Pruning those!{Style.RESET_ALL}')
 	args.fastqfiles = set(args.fastqfiles)
 
-if len(args.fastqfiles)==1:
+if len(args.fastqfiles)==1 and not args.interleaved:
 	if not args.fastqfiles[0].endswith('.gz') and not args.fastqfiles[0].endswith('.fastq')  and not args.fastqfiles[0].endswith('.fq'):
 		# File list:
 		print('Input is interpreted as a list of files..')
@@ -107,25 +151,76 @@ if len(args.fastqfiles)==1:
 
 
 
-class FastqHandle:
-
-	def __init__(self, path, pairedEnd=False ):
-		self.pe = pairedEnd
-		if pairedEnd:
-			self.handles = [ gzip.open(path+'R1.fastq.gz', 'wt'),   gzip.open(path+'R2.fastq.gz', 'wt') ]
-		else:
-			self.handles = [ gzip.open(path+'reads.fastq.gz', 'wt') ]
-
-
-	def write(self, records ):
-		for handle, record in zip(self.handles, records):
-			handle.write(record)
+def createOutputHandle(outputPrefix, resumeState=None, headerManifest=None):
+	"""Create the handle to store the demultiplexed read pairs in, either one file pair, a file pair per cell (--sepf) or an unaligned BAM file (-outputFormat bam)"""
+	if args.outputFormat=='bam':
+		return UnalignedBamHandle(f'{outputPrefix}demultiplexed', resumeState=resumeState, compressionLevel=args.compressionLevel, threads=args.ot)
+	if args.sepf:
+		return CellFastqHandle(f'{outputPrefix}cells/', True, maxHandles=args.fh, resumeState=resumeState, compressionLevel=args.compressionLevel, threads=args.ot, headerManifest=headerManifest)
+	return FastqHandle(f'{outputPrefix}demultiplexed', True, resumeState=resumeState, compressionLevel=args.compressionLevel, threads=args.ot, headerManifest=headerManifest)
+
+def createRejectHandle(path, rejectMode, pairedEnd=True, sampleSize=10000, resumeState=None, headerManifest=None):
+	"""Create the handle to store rejected read pairs in, None when rejects are not stored. Only tagged rejects are written with compact headers"""
+	if rejectMode=='none':
+		return None
+	if rejectMode=='sample':
+		return RejectSampleHandle(path, pairedEnd, sampleSize=sampleSize, resumeState=resumeState, compressionLevel=args.compressionLevel, threads=args.ot)
+	return FastqHandle(path, pairedEnd, resumeState=resumeState, compressionLevel=args.compressionLevel, threads=args.ot, headerManifest=headerManifest if rejectMode=='tagged' else None)
+
+def getHeaderManifest(library, fastqfile, selectedStrategies):
+	"""Obtain the tags of the header manifest of a library (see --compactHeaders).
+
+	The tags of the illumina header of the first read of fastqfile (not available for streams), the library and the first strategy
+	"""
+	taggedRecord = TaggedRecord(TagDefinitions, library=library)
+	if not fastqIterator.isStream(fastqfile):
+		with io.TextIOWrapper(fastqIterator.openFastq(fastqfile)) as handle:
+			record = fastqIterator.FastqRecord(*(handle.readline().rstrip() for i in range(4)))
+		try:
+			taggedRecord.fromRawFastq(record)
+		except ValueError:
+			pass
+	if len(selectedStrategies):
+		taggedRecord.addTagByTag('MX', selectedStrategies[0].shortName)
+	return { tag:taggedRecord.tags[tag] for tag in compactHeaderTags if tag in taggedRecord.tags }
+
+def rawFastq(record):
+	return f'{record.header}\n{record.sequence}\n{record.plus}\n{record.qual}\n'
+
+
+# State of a demultiplexing worker process, set by initialiseDemultiplexingWorker
+demultiplexingWorker = None
+
+def yieldConfidenceInterval(successes, trials, z=3.0):
+	"""Wilson score interval of the fraction successes/trials"""
+	if trials==0:
+		return 0.0, 1.0
+	fraction = successes/trials
+	denominator = 1+z*z/trials
+	centre = (fraction + z*z/(2*trials))/denominator
+	margin = z*math.sqrt( fraction*(1-fraction)/trials + z*z/(4*trials*trials) )/denominator
+	return max(0.0, centre-margin), min(1.0, centre+margin)
+
+def initialiseDemultiplexingWorker(strategyLoader, useStrategies, library, rejectMode):
+	global demultiplexingWorker
+	demultiplexingWorker = (strategyLoader, useStrategies, library, rejectMode)
+
+def demultiplexChunkInWorker(chunk, sampled=False, profilePath=None):
+	strategyLoader, useStrategies, library, rejectMode = demultiplexingWorker
+	return strategyLoader.demultiplexChunk(chunk, useStrategies, library=library, rejectMode=rejectMode, sampled=sampled, profilePath=profilePath)
+
+# The methods timed in sampled chunks (class, method name, stage), see StageStatistics.instrument
+sampledStageMethods = [
+	(TaggedRecord, 'fromRawFastq', 'demultiplexing.headerParsing'),
+	(barcodeFileParser.BarcodeParser, 'getIndexCorrectedBarcodeAndHammingDistance', 'demultiplexing.barcodeLookup'),
+	(TaggedRecord, 'asFastq', 'demultiplexing.fastqFormatting')
+]
 
 
 # Load barcodes
-barcodeParser = barcodeFileParser.BarcodeParser(hammingDistanceExpansion=args.hd, barcodeDirectory=args.barcodeDir)
+barcodeParser = barcodeFileParser.BarcodeParser(hammingDistanceExpansion=args.hd, barcodeDirectory=args.barcodeDir, correction=args.barcodeCorrection)
 
-indexParser =  barcodeFileParser.BarcodeParser(hammingDistanceExpansion=args.hdi, barcodeDirectory='indices')
+indexParser =  barcodeFileParser.BarcodeParser(hammingDistanceExpansion=args.hdi, barcodeDirectory='indices', correction=args.barcodeCorrection)
 if args.lbi:
 	barcodeParser.list()
 	indexParser.list()
@@ -219,6 +314,15 @@ class DemultiplexingStrategyLoader:
 				except Exception as e:
 					pass
 
+	def loadBarcodes(self, strategies):
+		"""Load the barcodes and sequencing indices used by the strategies, these are otherwise loaded when first looked up.
+		Used before forking processes, this way the barcodes are parsed and expanded once"""
+		for strategy in strategies:
+			if getattr(strategy, 'barcodeFileAlias', None) is not None and strategy.barcodeFileParser is not None:
+				strategy.barcodeFileParser.load(strategy.barcodeFileAlias)
+			if getattr(strategy, 'illuminaIndicesAlias', None) is not None and getattr(strategy, 'indexFileParser', None) is not None:
+				strategy.indexFileParser.load(strategy.illuminaIndicesAlias)
+
 	def getAutodetectStrategies(self):
 		return [strategy for strategy in self.demultiplexingStrategies if  strategy.autoDetectable ]
 
@@ -227,31 +331,56 @@ class DemultiplexingStrategyLoader:
 			raise ValueError('No strategies selected')
 		return self.selectedStrategies
 
-	def demultiplex(self, fastqfiles, maxReadPairs=None, strategies=None, library=None, targetFile=None, rejectHandle=None):
+	def demultiplexReadPairs(self, readPairs, useStrategies, library=None, rejectMode='tagged', batchResults=None):
+		"""Demultiplex a chunk of read pairs.
 
-		useStrategies = strategies if strategies is not None else self.getAutodetectStrategies()
+		batchResults contains for every strategy the result of strategy.demultiplexBatch for the chunk (or None)
+		rejectMode: tagged: the rejected records are tagged using the illumina header, raw: the rejected records are returned as they were read,
+		none: rejected records are not returned
+
+		Returns the demultiplexed records, the rejected records, the yield per strategy, the amount of rejected read pairs
+		per (strategy, reason of rejection) and the CellStatistics, the records are in the order in which they should be written
+		"""
+		demultiplexedRecords = []
+		rejectedRecords = []
 		strategyYields = collections.Counter()
-		processedReadPairs=0
+		rejectReasons = collections.Counter()
+		cellStatistics = CellStatistics()
 		baseDemux = IlluminaBaseDemultiplexer(indexFileParser=self.indexParser, barcodeParser=self.barcodeParser)
 
-		for processedReadPairs, reads in enumerate(fastqIterator.FastqIterator(*fastqfiles)):
+		# Convert the batch results into lists, which are cheap to index for every read pair:
+		batchCells = {}
+		if batchResults is not None:
+			for strategy, batchResult in batchResults.items():
+				if batchResult is not None:
+					mask, cellIndices = batchResult
+					batchCells[strategy] = ( cellIndices.tolist(), strategy.getBatchBarcodeTable()[1] )
+
+		for readPairIndex, reads in enumerate(readPairs):
+			# The headers of the reads are parsed once and shared by all strategies:
+			context = ReadPairContext(reads)
+			# Every read pair is written once: the records of the first strategy which demultiplexes the read pair are written,
+			# the read pair is only rejected when no strategy could demultiplex it. All strategies are evaluated to obtain their yields.
+			resolvedRecords = None
+			pairRejectReasons = []
 			for strategy in useStrategies:
 				try:
-
-					recodedRecords = strategy.demultiplex(reads, library=library)
-
-					if targetFile is not None:
-						targetFile.write( recodedRecords )
-
-				except NonMultiplexable:
-					#print('NonMultiplexable')
-
-					if rejectHandle is not None:
-						try:
-							rejectHandle.write( baseDemux.demultiplex(reads, library=library) )
-						except NonMultiplexable as e:
-							print(e)
-
+					if strategy in batchCells:
+						cellIndices, barcodeEntries = batchCells[strategy]
+						cellIndex = cellIndices[readPairIndex]
+						if cellIndex<0:
+							raise NonMultiplexable(strategy.getRejectReason(reads))
+						# The barcode is resolved, demultiplex still applies the other checks of the strategy
+						records = strategy.demultiplex(reads, library=library, context=context, batchBarcode=barcodeEntries[cellIndex])
+					else:
+						records = strategy.demultiplex(reads, library=library, context=context)
+					if resolvedRecords is None:
+						resolvedRecords = records
+					if strategy.shortName in context.cellBarcodes:
+						cellStatistics.addCell(strategy, *context.cellBarcodes[strategy.shortName])
+
+				except NonMultiplexable as e:
+					pairRejectReasons.append( (strategy.shortName, str(e)) )
 					continue
 				except Exception as e:
 					print( traceback.format_exc() )
@@ -262,30 +391,254 @@ class DemultiplexingStrategyLoader:
 					print(Style.RESET_ALL)
 				#print(recodedRecord)
 				strategyYields[strategy.shortName]+=1
-			if ( maxReadPairs is not None and (1+processedReadPairs)>=maxReadPairs):
-				break
-		return processedReadPairs+1,strategyYields
-
 
+			if resolvedRecords is not None:
+				demultiplexedRecords.append( resolvedRecords )
+				# The sequencing index of the first mate, as read, for every index alias used
+				for (mateIndex, _, indexAlias), tags in context.headerTags.items():
+					if mateIndex==0 and 'aa' in tags:
+						cellStatistics.addIndex(self.indexParser, indexAlias, tags['aa'])
+				continue
+			rejectReasons.update(pairRejectReasons)
+			if rejectMode=='raw':
+				rejectedRecords.append( [ rawFastq(record) for record in reads ] )
+			elif rejectMode=='tagged':
+				try:
+					rejectedRecords.append( baseDemux.demultiplex(reads, library=library, context=context) )
+				except NonMultiplexable as e:
+					print(e)
+		return demultiplexedRecords, rejectedRecords, strategyYields, rejectReasons, cellStatistics
+
+	def demultiplexChunk(self, chunk, useStrategies, library=None, rejectMode='tagged', sampled=False, profilePath=None):
+		"""Demultiplex a chunk of fastq record blocks, as obtained from fastqIterator.FastqBatchIterator
+
+		sampled: time the stages of demultiplexing the chunk
+		profilePath: profile demultiplexing the chunk using cProfile, the profile is stored at this path
+		Returns the amount of read pairs in the chunk followed by the result of demultiplexReadPairs and the
+		StageStatistics of the chunk (None when the chunk is not sampled)
+		"""
+		if profilePath is not None:
+			profile = cProfile.Profile()
+			try:
+				return profile.runcall(self.demultiplexChunk, chunk, useStrategies, library=library, rejectMode=rejectMode, sampled=sampled)
+			finally:
+				profile.dump_stats(profilePath)
+
+		if not sampled:
+			readPairs = fastqIterator.blocksToReadPairs(chunk)
+			# The barcodes of the strategies which support it are resolved for the whole chunk at once
+			batchResults = { strategy:strategy.demultiplexBatch(chunk) for strategy in useStrategies }
+			return (len(readPairs),) + self.demultiplexReadPairs(readPairs, useStrategies, library=library, rejectMode=rejectMode, batchResults=batchResults) + (None,)
+
+		# The time which is not spent in one of the timed stages is spent tagging the records
+		statistics = StageStatistics()
+		with statistics.instrument(sampledStageMethods), statistics.timer('demultiplexing.tagging'):
+			readPairs = statistics.time('demultiplexing.recordParsing', fastqIterator.blocksToReadPairs, chunk)
+			batchResults = { strategy:statistics.time('demultiplexing.barcodeLookup', strategy.demultiplexBatch, chunk) for strategy in useStrategies }
+			result = (len(readPairs),) + self.demultiplexReadPairs(readPairs, useStrategies, library=library, rejectMode=rejectMode, batchResults=batchResults)
+		return result + (statistics,)
+
+	def readPairChunks(self, fastqfiles, maxReadPairs=None, chunkSize=5000, decompressionThreads=1, prefetch=0, startReadPair=0, interleaved=False):
+		"""Obtain chunks of at most chunkSize read pairs from the supplied fastq files, or from one interleaved fastq file.
+		The chunks contain the undecoded records, which are cheap to send to a worker process"""
+		if interleaved:
+			return fastqIterator.InterleavedBatchIterator(fastqfiles[0], batchSize=chunkSize, maxRecords=maxReadPairs, threads=decompressionThreads, prefetch=prefetch, start=startReadPair)
+		return fastqIterator.FastqBatchIterator(*fastqfiles, batchSize=chunkSize, maxRecords=maxReadPairs, threads=decompressionThreads, prefetch=prefetch, start=startReadPair)
+
+	def demultiplexChunks(self, chunks, useStrategies, library=None, rejectMode='tagged', processes=1, sampleInterval=0, profileChunk=None, profilePath=None):
+		"""Demultiplex chunks of read pairs, using processes worker processes.
+
+		The results are yielded in the same order as the chunks were supplied,
+		at most two chunks per worker are in flight at the same time.
+		sampleInterval: the stages of one of every this amount of chunks are timed, see demultiplexChunk
+		profileChunk: index of the chunk which is profiled, the profile is stored at profilePath. The profiled chunk is not timed
+		"""
+		def getChunkArguments(chunkIndex):
+			if profilePath is not None and chunkIndex==profileChunk:
+				return (False, profilePath)
+			return (sampleInterval>0 and chunkIndex%sampleInterval==0, None)
+
+		if processes<=1:
+			for chunkIndex, chunk in enumerate(chunks):
+				sampled, chunkProfilePath = getChunkArguments(chunkIndex)
+				yield self.demultiplexChunk(chunk, useStrategies, library=library, rejectMode=rejectMode, sampled=sampled, profilePath=chunkProfilePath)
+			return
+
+		# The workers are forked, this way the strategies and barcode tables do not need to be pickled
+		self.loadBarcodes(useStrategies)
+		pool = multiprocessing.get_context('fork').Pool(processes, initializer=initialiseDemultiplexingWorker, initargs=(self, useStrategies, library, rejectMode))
+		try:
+			pending = collections.deque()
+			for chunkIndex, chunk in enumerate(chunks):
+				pending.append( pool.apply_async(demultiplexChunkInWorker, (chunk,)+getChunkArguments(chunkIndex)) )
+				if len(pending)>=2*processes:
+					yield pending.popleft().get()
+			while len(pending)>0:
+				yield pending.popleft().get()
+			pool.close()
+		finally:
+			pool.terminate()
+			pool.join()
+
+	def demultiplex(self, fastqfiles, maxReadPairs=None, strategies=None, library=None, targetFile=None, rejectHandle=None, processes=1, chunkSize=5000, decompressionThreads=1, prefetch=0, startReadPair=0, rejectMode='tagged', checkpointInterval=None, onCheckpoint=None, interleaved=False, statistics=None, sampleInterval=0, profileChunk=None, profilePath=None, cellStatistics=None):
+		"""Demultiplex the read pairs in the supplied mate files.
+
+		rejectMode: format of the records written to rejectHandle (tagged or raw), see demultiplexReadPairs
+		interleaved: fastqfiles contains one interleaved fastq file
+		onCheckpoint: called every checkpointInterval seconds with the amount of read pairs written so far, the strategy yields and reject reasons
+		statistics: StageStatistics to which the timers and counters of reading, demultiplexing and writing are added,
+		the stages of demultiplexing are timed for one of every sampleInterval chunks
+		profileChunk: index of the chunk of which demultiplexing is profiled, the profile is stored at profilePath
+		cellStatistics: CellStatistics to which the counters of the demultiplexed read pairs per cell and index are added
+		Returns the amount of processed read pairs, the yield per strategy and the amount of rejected read pairs per (strategy, reason)
+		"""
 
-	def detectLibYields(self, libraries, strategies=None, testReads=100000,maxAutoDetectMethods=1,minAutoDetectPct=5):
+		useStrategies = strategies if strategies is not None else self.getAutodetectStrategies()
+		strategyYields = collections.Counter()
+		rejectReasons = collections.Counter()
+		processedReadPairs=0
+		if rejectHandle is None:
+			rejectMode = 'none'
+		lastCheckpoint = time.time()
+
+		if statistics is None:
+			statistics = StageStatistics()
+
+		chunks = self.readPairChunks(fastqfiles, maxReadPairs=maxReadPairs, chunkSize=chunkSize, decompressionThreads=decompressionThreads, prefetch=prefetch, startReadPair=startReadPair, interleaved=interleaved)
+		def readChunks():
+			# Reading contains decompression, or waiting for the decompression threads
+			while True:
+				with statistics.timer('reading'):
+					chunk = next(chunks, None)
+				if chunk is None:
+					return
+				statistics.count('reading', bytes=sum(map(len, chunk)))
+				yield chunk
+
+		# Demultiplexing is timed in the main process, when worker processes are used this is the time spent waiting for the workers
+		results = self.demultiplexChunks(readChunks(), useStrategies, library=library, rejectMode=rejectMode, processes=processes, sampleInterval=sampleInterval, profileChunk=profileChunk, profilePath=profilePath)
+		try:
+			while True:
+				with statistics.timer('demultiplexing'):
+					result = next(results, None)
+				if result is None:
+					break
+				chunkReadPairs, demultiplexedRecords, rejectedRecords, chunkYields, chunkRejectReasons, chunkCellStatistics, chunkStatistics = result
+				processedReadPairs += chunkReadPairs
+				strategyYields.update(chunkYields)
+				rejectReasons.update(chunkRejectReasons)
+				if cellStatistics is not None:
+					cellStatistics.add(chunkCellStatistics)
+				statistics.chunks += 1
+				statistics.count('demultiplexing', records=chunkReadPairs)
+				if chunkStatistics is not None:
+					statistics.add(chunkStatistics, sampled=True)
+				with statistics.timer('writing'):
+					if targetFile is not None:
+						for records in demultiplexedRecords:
+							targetFile.write( records )
+					if rejectHandle is not None:
+						for records in rejectedRecords:
+							rejectHandle.write( records )
+				statistics.count('writing', records=len(demultiplexedRecords)+(len(rejectedRecords) if rejectHandle is not None else 0),
+					bytes=sum( len(record) for records in demultiplexedRecords for record in records ) + (sum( len(record) for records in rejectedRecords for record in records ) if rejectHandle is not None else 0))
+				if onCheckpoint is not None and time.time()-lastCheckpoint>=checkpointInterval:
+					onCheckpoint(processedReadPairs, strategyYields, rejectReasons)
+					lastCheckpoint = time.time()
+		finally:
+			results.close()
+			chunks.close()
+		return processedReadPairs,strategyYields,rejectReasons
+
+
+
+	def getAutodetectSources(self, lanes, samplePositions=4, interleaved=False):
+		"""Obtain the read pair ranges to sample from for autodetection.
+
+		Returns a list of (mate files, first read pair), for every lane and file. When a random access index
+		of the files is available (see fastqIndex.py) up to samplePositions positions spread over the file are used.
+		"""
+		sources = []
+		for lane, readPairs in lanes.items():
+			if len(readPairs)==1:
+				mateFiles = [ (path,) for path in readPairs['R1'] ]
+			elif len(readPairs)==2:
+				mateFiles = list(zip(readPairs['R1'], readPairs['R2']))
+			else:
+				raise ValueError('Error: %s' % readPairs.keys())
+			for fastqfiles in mateFiles:
+				index = fastqIndex.getFastqIndex(fastqfiles[0], build=False)
+				if index is None:
+					sources.append( (fastqfiles, 0) )
+					continue
+				# Decompression can be started at the checkpoints of the index, interleaved files contain two records per read pair
+				checkpoints = [ checkpoint[0]//2 if interleaved else checkpoint[0] for checkpoint in index.checkpoints ]
+				for startReadPair in sorted(set( checkpoints[ (i*len(checkpoints))//samplePositions ] for i in range(min(samplePositions, len(checkpoints))) )):
+					sources.append( (fastqfiles, startReadPair) )
+		return sources
+
+	def isAutodetectSettled(self, processedReadPairs, strategyYields, strategies, maxAutoDetectMethods=1, minAutoDetectPct=5, z=3.0):
+		"""Check if the strategies selected based on the yields would not change when more read pairs are sampled.
+
+		The yield of the strategies which can be selected has to be significantly above or below minAutoDetectPct,
+		and the yield of the last selectable strategy has to be significantly different from the next strategy.
+		"""
+		threshold = minAutoDetectPct/100.0
+		ranked = sorted( (strategyYields[strategy.shortName] for strategy in strategies), reverse=True )
+		intervals = [ yieldConfidenceInterval(strategyYield, processedReadPairs, z=z) for strategyYield in ranked ]
+		for lower, upper in intervals[:maxAutoDetectMethods]:
+			if lower<threshold<=upper:
+				return False
+		if len(intervals)>maxAutoDetectMethods:
+			lower, upper = intervals[maxAutoDetectMethods-1]
+			if upper>=threshold and lower<=intervals[maxAutoDetectMethods][1]:
+				return False
+		return True
+
+	def detectLibYields(self, libraries, strategies=None, testReads=100000,maxAutoDetectMethods=1,minAutoDetectPct=5, sampleSize=500, interleaved=False):
+		"""Determine the yield of the strategies for every library.
+
+		The yields are determined using a BarcodePrefilterIndex of the strategies, strategies which can not be
+		prefiltered are demultiplexed. Read pairs are sampled in batches of sampleSize from all lanes (and positions in the files, see getAutodetectSources) in turn.
+		Sampling stops when every position was sampled and the selection of strategies is settled (see isAutodetectSettled),
+		or when testReads read pairs were sampled.
+		"""
+		useStrategies = strategies if strategies is not None else self.getAutodetectStrategies()
+		# The yields of the barcode based strategies are obtained from one combined barcode index
+		prefilter = BarcodePrefilterIndex(useStrategies)
 		libYields = dict()
+		processedReadPairs = 0
 
 		for lib, lanes in libraries.items():
-			for lane, readPairs in lanes.items():
-
-				for readPair in readPairs:
-					if len(readPairs)==1:
-						processedReadPairs, strategyYields = self.demultiplex( [readPairs['R1'][0]],maxReadPairs=testReads,strategies=strategies  )
-					elif len(readPairs)==2:
-						processedReadPairs, strategyYields  =  self.demultiplex( (readPairs['R1'][0], readPairs['R2'][0] ),maxReadPairs=testReads,strategies=strategies  )
-					else:
-						raise ValueError('Error: %s' % readPairs.keys())
-
-				print(f'Report for {lib}:')
-				self.strategyYieldsToFormattedReport( processedReadPairs, strategyYields,maxAutoDetectMethods=maxAutoDetectMethods,minAutoDetectPct=minAutoDetectPct)
-				libYields[lib]= {'processedReadPairs':processedReadPairs, 'strategyYields':strategyYields }
-				break
+			sources = self.getAutodetectSources(lanes, interleaved=interleaved)
+			chunkIterators = [ self.readPairChunks(fastqfiles, chunkSize=sampleSize, startReadPair=startReadPair, interleaved=interleaved) for fastqfiles, startReadPair in sources ]
+			processedReadPairs = 0
+			strategyYields = collections.Counter()
+			try:
+				active = list(chunkIterators)
+				while len(active)>0 and processedReadPairs<testReads:
+					for chunks in list(active):
+						chunk = next(chunks, None)
+						if chunk is None:
+							active.remove(chunks)
+							continue
+						chunkReadPairs, chunkYields = prefilter.scoreChunk(chunk)
+						if len(prefilter.unindexedStrategies)>0:
+							chunkYields.update( self.demultiplexChunk(chunk, prefilter.unindexedStrategies, rejectMode='none')[3] )
+						processedReadPairs += chunkReadPairs
+						strategyYields.update(chunkYields)
+						if processedReadPairs>=testReads:
+							break
+					# All positions have been sampled at least once now
+					if self.isAutodetectSettled(processedReadPairs, strategyYields, useStrategies, maxAutoDetectMethods=maxAutoDetectMethods, minAutoDetectPct=minAutoDetectPct):
+						break
+			finally:
+				for chunks in chunkIterators:
+					chunks.close()
+
+			print(f'Report for {lib}, sampled from {len(sources)} position(s) in {len(lanes)} lane(s):')
+			self.strategyYieldsToFormattedReport( processedReadPairs, strategyYields,maxAutoDetectMethods=maxAutoDetectMethods,minAutoDetectPct=minAutoDetectPct)
+			libYields[lib]= {'processedReadPairs':processedReadPairs, 'strategyYields':strategyYields }
 		return processedReadPairs, libYields
 
 	def strategyYieldsToFormattedReport(self, processedReadPairs, strategyYields, selectedStrategies=None,maxAutoDetectMethods=1,minAutoDetectPct=5):
@@ -315,7 +668,19 @@ if len(args.fastqfiles)==0:
 	exit()
 
 print(f"\n{Style.BRIGHT}Detected libraries:{Style.RESET_ALL}")
-libraries = sequencingLibraryListing.SequencingLibraryLister().detect(args.fastqfiles, args)
+if args.interleaved:
+	# Interleaved files do not follow the illumina naming, every file is a lane of its own library
+	libraries = {}
+	for path in args.fastqfiles:
+		library = args.slib if args.slib is not None else ( 'stdin' if path=='-' else os.path.basename(path).split('.')[0] )
+		lanes = libraries.setdefault(library, {})
+		lanes[str(len(lanes))] = {'R1':[path]}
+		print(f'{library}\t{path} {Style.DIM}(interleaved){Style.RESET_ALL}')
+else:
+	libraries = sequencingLibraryListing.SequencingLibraryLister().detect(args.fastqfiles, args)
+
+if args.use is None and any( fastqIterator.isStream(path) for path in args.fastqfiles ):
+	raise ValueError('The demultiplexing strategies can not be autodetected when reading from stdin or a named pipe, supply them using -use')
 
 # Detect the libraries:
 if args.use is None:
@@ -324,9 +689,273 @@ if args.use is None:
 
 	print(f"\n{Style.BRIGHT}Demultiplexing method Autodetect results{Style.RESET_ALL}")
 	# Run autodetect
-	processedReadPairs, strategyYieldsForAllLibraries = dmx.detectLibYields(libraries, testReads=args.dsize, maxAutoDetectMethods=args.maxAutoDetectMethods, minAutoDetectPct=args.minAutoDetectPct)
+	processedReadPairs, strategyYieldsForAllLibraries = dmx.detectLibYields(libraries, testReads=args.dsize, maxAutoDetectMethods=args.maxAutoDetectMethods, minAutoDetectPct=args.minAutoDetectPct, interleaved=args.interleaved)
+
+def getShardRanges(fastqfiles, shards):
+	"""Split the read pairs of the supplied mate files in at most shards ranges, returns a list of (first read pair, amount of read pairs).
+
+	The ranges start at checkpoints of the random access index of the files (see fastqIndex.py), every shard only decompresses
+	its own range. The indices are not built here, when not all files have an index with multiple checkpoints (a single member gzip file
+	only has a checkpoint at the first record) a warning is shown and one range with all read pairs is returned: (0, None)
+	"""
+	indices = [ fastqIndex.getFastqIndex(path, build=False) for path in fastqfiles ]
+	if any( index is None or len(index.checkpoints)<2 for index in indices ):
+		print(f'{Fore.YELLOW}{", ".join(fastqfiles)} can not be sharded, not all files have a random access index with multiple checkpoints. Build the index using fastqIndex.py, single member gzip files can not be indexed (use BGZF). The lane is demultiplexed as one shard{Style.RESET_ALL}')
+		return [ (0, None) ]
+	if len(set(index.records for index in indices))!=1:
+		raise ValueError(f'The mates are truncated, the files {", ".join(fastqfiles)} do not contain the same amount of records')
+	readPairCount = indices[0].records
+	checkpoints = sorted({ recordIndex for recordIndex, _, _ in indices[0].checkpoints if 0<recordIndex<readPairCount })
+	starts = [0]
+	for shard in range(1, shards):
+		# The checkpoint nearest to an equal split
+		start = min(checkpoints, key=lambda recordIndex: abs(recordIndex-shard*readPairCount/shards), default=0)
+		if start>starts[-1]:
+			starts.append(start)
+	return [ (start, end-start) for start, end in zip(starts, starts[1:]+[readPairCount]) ]
+
+# The estimated time and memory are multiplied by this factor when requesting resources from the cluster
+resourceMargin = 1.5
+
+def formatDuration(seconds):
+	if seconds<60:
+		return f'{seconds:.1f}s'
+	if seconds<3600:
+		return f'{seconds/60:.1f}m'
+	return f'{seconds/3600:.1f}h'
+
+def formatSize(size):
+	if size<1e9:
+		return f'{size/1e6:.1f}MB'
+	return f'{size/1e9:.2f}GB'
+
+def getLaneFiles(lanes):
+	"""Obtain the mate files of every lane of a library"""
+	laneFiles = []
+	for readPairs in lanes.values():
+		for readPair in readPairs:
+			pass
+		for readPairIdx,_ in enumerate(readPairs[readPair]):
+			laneFiles.append( [ readPairs[readPair][readPairIdx] for readPair in readPairs ] )
+	return laneFiles
+
+def getLibraryReadPairCount(laneFiles):
+	"""Obtain (amount of read pairs, exact) of the lanes, without reading the complete files (see fastqIndex.estimateRecordCount)"""
+	readPairCount = 0
+	exact = True
+	for files in laneFiles:
+		records, exactCount = fastqIndex.estimateRecordCount(files[0])
+		readPairCount += records//2 if args.interleaved else records
+		exact &= exactCount
+	return readPairCount, exact
+
+def estimateLibraryResources(library, lanes, selectedStrategies, sampleReadPairs=20000):
+	"""Estimate the resources required to demultiplex a library (when --y is not supplied).
+
+	A sample of read pairs of the first lane is demultiplexed into a temporary directory using the current settings,
+	the measured time, memory and output size are extrapolated to the amount of read pairs of the library.
+	Returns a dictionary with the estimates, or None when the input can not be sampled (streams)
+	"""
+	laneFiles = getLaneFiles(lanes)
+	if any( fastqIterator.isStream(path) for files in laneFiles for path in files ):
+		return None
+	readPairCount, exact = getLibraryReadPairCount(laneFiles)
+
+	directory = tempfile.mkdtemp(prefix='demux_estimate_')
+	try:
+		headerManifest = getHeaderManifest(library, laneFiles[0][0], selectedStrategies) if args.compactHeaders else None
+		handle = createOutputHandle(f'{directory}/', headerManifest=headerManifest)
+		rejectHandle = createRejectHandle(f'{directory}/rejects', rejectMode, sampleSize=args.rejectSample, headerManifest=headerManifest)
+		usageBefore = [ resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN) ]
+		startTime = time.time()
+		processedReadPairs, strategyYields, _ = dmx.demultiplex( laneFiles[0], strategies=selectedStrategies, targetFile=handle, rejectHandle=rejectHandle, rejectMode=rejectRecordMode,
+			library=library, maxReadPairs=sampleReadPairs, processes=args.t, chunkSize=args.chunkSize, decompressionThreads=args.it, prefetch=args.prefetch, interleaved=args.interleaved)
+		handle.close()
+		if rejectHandle is not None:
+			rejectHandle.close()
+		wallTime = time.time()-startTime
+		usageAfter = [ resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN) ]
+		outputSizes = collections.Counter()
+		for root, _, fileNames in os.walk(directory):
+			for fileName in fileNames:
+				outputSizes['rejects' if fileName.startswith('rejects') else 'demultiplexed'] += os.path.getsize(os.path.join(root, fileName))
+	finally:
+		shutil.rmtree(directory)
+	if processedReadPairs==0:
+		return None
+
+	scale = readPairCount/processedReadPairs
+	rejectedReadPairs = processedReadPairs-sum(strategyYields.values())
+	if rejectMode=='sample' and rejectedReadPairs>0:
+		# The size of the reject sample does not grow with the amount of read pairs
+		outputSizes['rejects'] *= min(args.rejectSample, rejectedReadPairs*scale)/min(args.rejectSample, rejectedReadPairs)
+	else:
+		outputSizes['rejects'] *= scale
+	outputSizes['demultiplexed'] *= scale
+	cpuTime = sum( after.ru_utime+after.ru_stime-before.ru_utime-before.ru_stime for before, after in zip(usageBefore, usageAfter) )
+
+	# The lanes (and shards) run at the same time when the scheduler is used
+	concurrentJobs = 1
+	if useScheduler:
+		concurrentJobs = max(1, min( len(laneFiles)*max(1,args.shards), cores//max(1,args.t) ))
+		if args.memory is not None:
+			concurrentJobs = max(1, min(concurrentJobs, int(args.memory//args.jobMemory)))
+	# ru_maxrss is in kilobytes, the peak memory of a job is the main process and its demultiplexing processes
+	jobMemory = usageAfter[0].ru_maxrss + (args.t*usageAfter[1].ru_maxrss if args.t>1 else 0)
+	if args.sepf:
+		jobMemory += 65536 # the cell buffers, see CellFastqHandle
+	return {'readPairs':readPairCount,
+		'exact':exact,
+		'sampleReadPairs':processedReadPairs,
+		'yield':sum(strategyYields.values())/processedReadPairs,
+		'cpuTime':cpuTime*scale,
+		'wallTime':wallTime*scale/concurrentJobs,
+		'cores':cores if useScheduler else max(1,args.t),
+		'memory':concurrentJobs*jobMemory/1048576,
+		'outputSizes':outputSizes}
+
+def readCheckpoint(path):
+	"""Read the checkpoint state stored at path, returns None when there is no checkpoint"""
+	if not os.path.exists(path):
+		return None
+	with open(path) as f:
+		state = json.load(f)
+	state['strategyYields'] = collections.Counter(state['strategyYields'])
+	state['rejectReasons'] = collections.Counter({ (strategy, reason):count for strategy, reason, count in state['rejectReasons'] })
+	state['cellStatistics'] = CellStatistics.fromDict(state['cellStatistics']) if state.get('cellStatistics') is not None else CellStatistics()
+	return state
+
+def writeCheckpoint(path, state):
+	"""Write the checkpoint state to path, the previous state is only replaced when the new state is completely written"""
+	state = dict(state)
+	state['rejectReasons'] = [ [strategy, reason, count] for (strategy, reason), count in state['rejectReasons'].items() ]
+	if state.get('cellStatistics') is not None:
+		state['cellStatistics'] = state['cellStatistics'].asDict()
+	with open(path+'.tmp', 'w') as f:
+		json.dump(state, f)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(path+'.tmp', path)
+
+def checkpointHandles(handle, rejectHandle):
+	"""Checkpoint the output handles, returns the state required to resume writing"""
+	return {'demultiplexed':handle.checkpoint(), 'rejects':rejectHandle.checkpoint() if rejectHandle is not None else None}
+
+def demultiplexLanePart(fastqfiles, outputPrefix, selectedStrategies, library, startReadPair=0, readPairCount=None, rejectSample=None, headerManifest=None, profilePath=None):
+	"""Demultiplex (a range of read pairs of) a lane into separate output files, executed in a separate process by the scheduler.
+
+	The progress is stored in a checkpoint file next to the output files, see --resume
+	profilePath: store the profile of chunk -profileChunk at this path
+	Returns the amount of processed read pairs, the yield per strategy, the amount of rejected read pairs per (strategy, reason), the StageStatistics and the CellStatistics
+	"""
+	statePath = f'{outputPrefix}checkpoint.json'
+	state = readCheckpoint(statePath) if args.resume else None
+	if state is not None and state['finished']:
+		return state['readPairs'], state['strategyYields'], state['rejectReasons'], StageStatistics(), state['cellStatistics']
+	if state is None:
+		state = {'readPairs':0, 'strategyYields':collections.Counter(), 'rejectReasons':collections.Counter(), 'cellStatistics':CellStatistics(), 'handles':{'demultiplexed':None, 'rejects':None}, 'finished':False}
+	# The cell statistics are accumulated by demultiplex, these contain the progress of the current run
+	cellStatistics = state['cellStatistics']
+
+	handle = createOutputHandle(outputPrefix, resumeState=state['handles']['demultiplexed'], headerManifest=headerManifest)
+	rejectHandle = createRejectHandle(f'{outputPrefix}rejects', rejectMode, sampleSize=rejectSample, resumeState=state['handles']['rejects'], headerManifest=headerManifest)
+
+	def saveCheckpoint(processedReadPairs, strategyYields, rejectReasons):
+		writeCheckpoint(statePath, {'readPairs':state['readPairs']+processedReadPairs,
+			'strategyYields':state['strategyYields']+strategyYields,
+			'rejectReasons':state['rejectReasons']+rejectReasons,
+			'cellStatistics':cellStatistics,
+			'handles':checkpointHandles(handle, rejectHandle),
+			'finished':False})
+
+	statistics = StageStatistics()
+	processedReadPairs, strategyYields, rejectReasons = dmx.demultiplex( fastqfiles , strategies=selectedStrategies, targetFile=handle, rejectHandle=rejectHandle, rejectMode=rejectRecordMode,
+		library=library, startReadPair=startReadPair+state['readPairs'], maxReadPairs=None if readPairCount is None else readPairCount-state['readPairs'],
+		processes=args.t, chunkSize=args.chunkSize, decompressionThreads=args.it, prefetch=args.prefetch, interleaved=args.interleaved,
+		checkpointInterval=args.checkpoint, onCheckpoint=saveCheckpoint if args.checkpoint else None,
+		statistics=statistics, sampleInterval=args.timingSample, profileChunk=args.profileChunk, profilePath=profilePath, cellStatistics=cellStatistics)
+	with statistics.timer('writing'):
+		handle.close()
+		if rejectHandle is not None:
+			rejectHandle.close()
+	result = (state['readPairs']+processedReadPairs, state['strategyYields']+strategyYields, state['rejectReasons']+rejectReasons)
+	writeCheckpoint(statePath, {'readPairs':result[0], 'strategyYields':result[1], 'rejectReasons':result[2], 'cellStatistics':cellStatistics, 'handles':None, 'finished':True})
+	return result + (statistics, cellStatistics)
+
+def printRejectReasons(library, processedReadPairs, rejectReasons):
+	if len(rejectReasons)==0:
+		return
+	print(f'Rejected read pairs of {library}:')
+	# Collisions are counted per set of colliding barcodes, only the most frequent reasons are shown
+	showReasons = 20
+	for (strategy, reason), count in sorted(rejectReasons.most_common(showReasons)):
+		print(f'\t{strategy} {Style.DIM}{reason}{Style.RESET_ALL}: {count} ({100.0*count/max(1,processedReadPairs):.2f}%)')
+	if len(rejectReasons)>showReasons:
+		print(f'\t{Style.DIM}{len(rejectReasons)-showReasons} more reasons, see report.json{Style.RESET_ALL}')
+
+def writeLibraryReport(targetDir, library, processedReadPairs, strategyYields, rejectReasons, statistics, wallSeconds):
+	"""Write report.json to the output directory of the library: the yields, reasons of rejection, settings and the timers and counters of the stages.
+
+	The stages of demultiplexing (demultiplexing.*) are timed for a sample of the chunks and extrapolated to all chunks, when multiple
+	demultiplexing processes are used their time is the sum over the processes
+	"""
+	writeRunReport(f'{targetDir}/report.json', {
+		'library':library,
+		'readPairs':processedReadPairs,
+		'wallSeconds':wallSeconds,
+		'strategyYields':dict(strategyYields),
+		'rejectReasons':[ [strategy, reason, count] for (strategy, reason), count in rejectReasons.items() ],
+		'chunks':statistics.chunks,
+		'sampledChunks':statistics.sampledChunks,
+		'stages':statistics.asReport(),
+		'settings':{'t':args.t, 'chunkSize':args.chunkSize, 'shards':args.shards, 'hd':args.hd, 'hdi':args.hdi, 'barcodeCorrection':args.barcodeCorrection, 'it':args.it, 'ot':args.ot, 'compressionLevel':args.compressionLevel,
+			'outputFormat':args.outputFormat, 'sepf':args.sepf, 'rejects':rejectMode, 'timingSample':args.timingSample},
+		# The barcode and index aliases which were loaded (looked up), see BarcodeParser.load
+		'loadedAliases':{'barcodes':barcodeParser.loadedAliases, 'indices':indexParser.loadedAliases},
+		# The aliases which were corrected at query time instead of expanded, see -barcodeCorrection
+		'correctionIndices':{'barcodes':list(barcodeParser.correctionIndices), 'indices':list(indexParser.correctionIndices)} })
+
+def concatenateFiles(sourcePaths, targetPath, removeSources=True, skipBamHeaders=False):
+	"""Concatenate the source files into the target file and remove the source files, gzip files can be concatenated without decompression.
+
+	The BGZF end of file markers of all but the last source file are left out.
+	skipBamHeaders: the source files are BAM files, only the header of the first file is kept
+	"""
+	sourcePaths = [ sourcePath for sourcePath in sourcePaths if os.path.exists(sourcePath) ]
+	if len(sourcePaths)==0:
+		return
+	with open(targetPath, 'wb') as target:
+		for i,sourcePath in enumerate(sourcePaths):
+			with open(sourcePath, 'rb') as source:
+				size = os.path.getsize(sourcePath)
+				if i<len(sourcePaths)-1 and size>=len(bgzf.bgzfEofMarker):
+					source.seek(size-len(bgzf.bgzfEofMarker))
+					if source.read()==bgzf.bgzfEofMarker:
+						size -= len(bgzf.bgzfEofMarker)
+					source.seek(0)
+				if skipBamHeaders and i>0:
+					unalignedBam.skipHeader(source)
+					size -= source.tell()
+				while size>0:
+					data = source.read(min(size, 4194304))
+					if len(data)==0:
+						break
+					target.write(data)
+					size -= len(data)
+			if removeSources:
+				os.remove(sourcePath)
 
 print(f"\n{Style.BRIGHT}Demultiplexing:{Style.RESET_ALL}")
+# Libraries are demultiplexed by the scheduler when multiple jobs can run at the same time or lanes are sharded.
+# When the amount of read pairs is limited (-n) the lanes are demultiplexed one after another
+cores = args.cores if args.cores is not None else args.shards*max(1,args.t)
+rejectMode = 'none' if args.norejects else args.rejects
+# The read pairs in the reject sample are stored as they were read
+rejectRecordMode = 'raw' if rejectMode=='sample' else rejectMode
+useScheduler = (cores>1 or args.shards>1) and args.n is None and args.o!='-'
+scheduler = libraryScheduler.JobScheduler(cores=cores, memory=args.memory)
+libraryParts = {} # library -> output prefixes of the parts, in the order of concatenation
+headerManifests = {} # library -> tags of the header manifest, None when the headers are not compact
 for library in libraries:
 	if args.use is None:
 		processedReadPairs = strategyYieldsForAllLibraries[library]['processedReadPairs']
@@ -352,18 +981,106 @@ for library in libraries:
 					filesForLib.append( p )
 		arguments = " ".join([x for x in sys.argv if x!='--dry' and not '--y' in x and not '-submit' in x and not '.fastq' in x and not '.fq' in x]) + " --y"
 
+		# The resources requested from the cluster, the defaults are used when the resources can not be estimated
+		requestedHours, requestedCores, requestedMemory = 50, 1, 8
+		estimate = estimateLibraryResources(library, libraries[library], selectedStrategies, args.estimateReads) if args.estimateReads>0 and len(selectedStrategies) else None
+		if estimate is not None:
+			print(f"\n{Style.BRIGHT}Estimated resources for {library}{Style.RESET_ALL} {Style.DIM}(extrapolated from {estimate['sampleReadPairs']} read pairs){Style.RESET_ALL}")
+			print(f"\t{'' if estimate['exact'] else '~'}{estimate['readPairs']} read pairs, {100*estimate['yield']:.1f}% demultiplexed")
+			print(f"\tWall time: {formatDuration(estimate['wallTime'])} using {estimate['cores']} cores, CPU time: {formatDuration(estimate['cpuTime'])}")
+			print(f"\tPeak memory: {estimate['memory']:.2f}GB")
+			print(f"\tOutput: {formatSize(estimate['outputSizes']['demultiplexed'])} demultiplexed, {formatSize(estimate['outputSizes']['rejects'])} rejects")
+			requestedHours = max(1, math.ceil(estimate['wallTime']*resourceMargin/3600))
+			requestedCores = estimate['cores']
+			requestedMemory = max(1, math.ceil(estimate['memory']*resourceMargin))
+		elif args.estimateReads>0:
+			print(f"{Fore.RED}The resources of {library} could not be estimated, the default resources are requested{Style.RESET_ALL}")
+		elif not any( fastqIterator.isStream(path) for path in filesForLib ):
+			readPairCount, exact = getLibraryReadPairCount(getLaneFiles(libraries[library]))
+			print(f"\n{Style.BRIGHT}{library}{Style.RESET_ALL}: {'' if exact else '~'}{readPairCount} read pairs {Style.DIM}(supply -estimateReads to estimate the resources required by demultiplexing {library}, the default resources are requested){Style.RESET_ALL}")
+
 		print(f"\n{Style.BRIGHT}--y not supplied, execute the command below to run demultiplexing on the cluster:{Style.RESET_ALL}")
-		print( os.path.dirname(os.path.abspath(__file__)) + '/../submission.py' + f' -y --nenv -time 50 -t 1 -m 8 -N NDMX%s "source /hpc/hub_oudenaarden/bdebarbanson/virtualEnvironments/py36/bin/activate; %s -use {",".join([x.shortName for x in selectedStrategies])}"\n' % (library, '%s %s'  % ( arguments, " ".join(filesForLib)) ))
+		print( os.path.dirname(os.path.abspath(__file__)) + '/../submission.py' + f' -y --nenv -time {requestedHours} -t {requestedCores} -m {requestedMemory} -N NDMX%s "source /hpc/hub_oudenaarden/bdebarbanson/virtualEnvironments/py36/bin/activate; %s -use {",".join([x.shortName for x in selectedStrategies])}"\n' % (library, '%s %s'  % ( arguments, " ".join(filesForLib)) ))
 
-	if args.y:
+	if args.y and args.o=='-':
+		# Stream the read pairs of the library to stdout, no checkpoints are made
+		handle = InterleavedStreamHandle(outputStream)
+		processedReadPairsForThisLib = 0
+		rejectReasonsForThisLib = collections.Counter()
+		for lane, readPairs in libraries[library].items():
+			for readPair in readPairs:
+				pass
+			for readPairIdx,_ in enumerate(readPairs[readPair]):
+				if args.n and processedReadPairsForThisLib>=args.n:
+					break
+				files = [ readPairs[readPair][readPairIdx] for readPair in readPairs ]
+				processedReadPairs,strategyYields,rejectReasons = dmx.demultiplex( files , strategies=selectedStrategies, targetFile=handle,
+				library=library, maxReadPairs=None if args.n is None else (args.n-processedReadPairsForThisLib), processes=args.t, chunkSize=args.chunkSize, decompressionThreads=args.it, prefetch=args.prefetch,
+				interleaved=args.interleaved)
+				processedReadPairsForThisLib += processedReadPairs
+				rejectReasonsForThisLib.update(rejectReasons)
+		handle.close()
+		printRejectReasons(library, processedReadPairsForThisLib, rejectReasonsForThisLib)
+
+	elif args.y:
 		targetDir = f'{args.o}/{library}'
 		if not os.path.exists(targetDir):
 			os.makedirs(targetDir)
-		handle = FastqHandle(f'{args.o}/{library}/demultiplexed' , True)
-
-		rejectHandle = FastqHandle(f'{args.o}/{library}/rejects' , True)
-
-		processedReadPairsForThisLib = 0
+		statePath = f'{targetDir}/checkpoint.json'
+		state = readCheckpoint(statePath) if args.resume else None
+		if state is not None and state['finished']:
+			print(f'{Fore.GREEN}{library} was already demultiplexed{Style.RESET_ALL}')
+			continue
+		headerManifests[library] = None
+		if args.compactHeaders:
+			firstLane = next(iter(libraries[library].values()))
+			headerManifests[library] = getHeaderManifest(library, next(iter(firstLane.values()))[0], selectedStrategies)
+
+		if useScheduler:
+			# The lanes (or shards of lanes) are demultiplexed into part files by the scheduler
+			partDir = f'{targetDir}/parts'
+			if not os.path.exists(partDir):
+				os.makedirs(partDir)
+			libraryParts[library] = []
+			libraryJobs = []
+			for lane, readPairs in libraries[library].items():
+				for readPair in readPairs:
+					pass
+				for readPairIdx,_ in enumerate(readPairs[readPair]):
+					files = [ readPairs[readPair][readPairIdx] for readPair in readPairs ]
+					inputSize = sum( os.path.getsize(path) for path in files )
+					ranges = [ (0, None) ]
+					if args.shards>1 and not args.interleaved:
+						ranges = getShardRanges(files, args.shards)
+					for shard, (startReadPair, readPairCount) in enumerate(ranges):
+						partPrefix = f'{partDir}/{lane}_{readPairIdx}_{shard}_'
+						libraryParts[library].append(partPrefix)
+						libraryJobs.append( (partPrefix, inputSize/len(ranges), (files, partPrefix, selectedStrategies, library, startReadPair, readPairCount)) )
+			dmx.loadBarcodes(selectedStrategies)
+			# The reject sample is divided over the parts by their size
+			libraryInputSize = sum( partSize for _, partSize, _ in libraryJobs )
+			for partIndex, (partPrefix, partSize, jobArgs) in enumerate(libraryJobs):
+				# Only a chunk of the first part is profiled
+				profilePath = f'{partPrefix}profile.prof' if args.profileChunk is not None and partIndex==0 else None
+				scheduler.add(partPrefix, demultiplexLanePart, jobArgs+(max(1, round(args.rejectSample*partSize/max(1,libraryInputSize))), headerManifests[library], profilePath),
+					size=partSize, cores=max(1,args.t), memory=args.jobMemory)
+			continue
+
+		# The progress is stored in the checkpoint file; the finished lanes, and the amount of read pairs written of the current lane
+		if state is None:
+			state = {'readPairs':0, 'strategyYields':collections.Counter(), 'rejectReasons':collections.Counter(), 'cellStatistics':CellStatistics(), 'finishedLanes':[], 'lane':None, 'laneReadPairs':0, 'handles':{'demultiplexed':None, 'rejects':None}, 'finished':False}
+		handle = createOutputHandle(f'{args.o}/{library}/', resumeState=state['handles']['demultiplexed'], headerManifest=headerManifests[library])
+
+		rejectHandle = createRejectHandle(f'{args.o}/{library}/rejects', rejectMode, sampleSize=args.rejectSample, resumeState=state['handles']['rejects'], headerManifest=headerManifests[library])
+
+		processedReadPairsForThisLib = state['readPairs']
+		strategyYieldsForThisLib = state['strategyYields']
+		rejectReasonsForThisLib = state['rejectReasons']
+		cellStatisticsForThisLib = state['cellStatistics']
+		statisticsForThisLib = StageStatistics()
+		libraryStart = time.time()
+		# Only a chunk of the first lane is profiled
+		profilePath = f'{targetDir}/profile.prof' if args.profileChunk is not None else None
 
 		for lane, readPairs in libraries[library].items():
 			if args.n and processedReadPairsForThisLib>=args.n:
@@ -371,9 +1088,90 @@ for library in libraries:
 			for readPair in readPairs:
 				pass
 			for readPairIdx,_ in enumerate(readPairs[readPair]):
+				laneKey = f'{lane}_{readPairIdx}'
+				if laneKey in state['finishedLanes']:
+					continue
+				startReadPair = state['laneReadPairs'] if state['lane']==laneKey else 0
 				files = [ readPairs[readPair][readPairIdx] for readPair in readPairs ]
-				processedReadPairs,strategyYields = dmx.demultiplex( files , strategies=selectedStrategies, targetFile=handle, rejectHandle=rejectHandle,
-				library=library, maxReadPairs=None if args.n is None else (args.n-processedReadPairsForThisLib))
+
+				def saveCheckpoint(processedReadPairs, strategyYields, rejectReasons):
+					writeCheckpoint(statePath, {'readPairs':processedReadPairsForThisLib+processedReadPairs,
+						'strategyYields':strategyYieldsForThisLib+strategyYields,
+						'rejectReasons':rejectReasonsForThisLib+rejectReasons,
+						'cellStatistics':cellStatisticsForThisLib,
+						'finishedLanes':state['finishedLanes'], 'lane':laneKey, 'laneReadPairs':startReadPair+processedReadPairs,
+						'handles':checkpointHandles(handle, rejectHandle),
+						'finished':False})
+
+				processedReadPairs,strategyYields,rejectReasons = dmx.demultiplex( files , strategies=selectedStrategies, targetFile=handle, rejectHandle=rejectHandle, rejectMode=rejectRecordMode,
+				library=library, maxReadPairs=None if args.n is None else (args.n-processedReadPairsForThisLib), processes=args.t, chunkSize=args.chunkSize, decompressionThreads=args.it, prefetch=args.prefetch,
+				startReadPair=startReadPair, interleaved=args.interleaved, checkpointInterval=args.checkpoint, onCheckpoint=saveCheckpoint if args.checkpoint else None,
+				statistics=statisticsForThisLib, sampleInterval=args.timingSample, profileChunk=args.profileChunk, profilePath=profilePath, cellStatistics=cellStatisticsForThisLib)
+				profilePath = None
 				processedReadPairsForThisLib += processedReadPairs
+				strategyYieldsForThisLib.update(strategyYields)
+				rejectReasonsForThisLib.update(rejectReasons)
+				state['finishedLanes'].append(laneKey)
 				if args.n and processedReadPairsForThisLib>=args.n:
 					break
+		with statisticsForThisLib.timer('writing'):
+			handle.close()
+			if rejectHandle is not None:
+				rejectHandle.close()
+		writeCheckpoint(statePath, {'readPairs':processedReadPairsForThisLib, 'strategyYields':strategyYieldsForThisLib, 'rejectReasons':rejectReasonsForThisLib, 'cellStatistics':cellStatisticsForThisLib,
+			'finishedLanes':state['finishedLanes'], 'lane':None, 'laneReadPairs':0, 'handles':None, 'finished':True})
+		writeLibraryReport(targetDir, library, processedReadPairsForThisLib, strategyYieldsForThisLib, rejectReasonsForThisLib, statisticsForThisLib, time.time()-libraryStart)
+		writeCellStatistics(targetDir, cellStatisticsForThisLib, strategyYieldsForThisLib, barcodeParser, indexParser)
+		printRejectReasons(library, processedReadPairsForThisLib, rejectReasonsForThisLib)
+
+if useScheduler:
+	remainingParts = { library:set(parts) for library, parts in libraryParts.items() }
+	processedReadPairsPerLibrary = collections.Counter()
+	strategyYieldsPerLibrary = collections.defaultdict(collections.Counter)
+	rejectReasonsPerLibrary = collections.defaultdict(collections.Counter)
+	statisticsPerLibrary = collections.defaultdict(StageStatistics)
+	cellStatisticsPerLibrary = collections.defaultdict(CellStatistics)
+	schedulerStart = time.time()
+	for partPrefix, (processedReadPairs, strategyYields, rejectReasons, statistics, cellStatistics) in scheduler.run():
+		library = next( library for library, parts in remainingParts.items() if partPrefix in parts )
+		remainingParts[library].remove(partPrefix)
+		processedReadPairsPerLibrary[library] += processedReadPairs
+		strategyYieldsPerLibrary[library].update(strategyYields)
+		rejectReasonsPerLibrary[library].update(rejectReasons)
+		statisticsPerLibrary[library].add(statistics)
+		cellStatisticsPerLibrary[library].add(cellStatistics)
+		if len(remainingParts[library])==0:
+			targetDir = f'{args.o}/{library}'
+			outputNames = ('demultiplexedR1.fastq.gz', 'demultiplexedR2.fastq.gz', 'demultiplexed.bam', 'rejectsR1.fastq.gz', 'rejectsR2.fastq.gz')
+			# The parts are only removed when the library is finished, this way the concatenation can be resumed
+			for outputName in outputNames:
+				concatenateFiles([ f'{prefix}{outputName}' for prefix in libraryParts[library] ], f'{targetDir}/{outputName}', removeSources=False, skipBamHeaders=outputName.endswith('.bam'))
+			if args.sepf:
+				if not os.path.exists(f'{targetDir}/cells'):
+					os.makedirs(f'{targetDir}/cells')
+				cellFileNames = set()
+				for prefix in libraryParts[library]:
+					cellFileNames.update( fileName for fileName in os.listdir(f'{prefix}cells') if fileName.endswith('.fastq.gz') )
+				for cellFileName in sorted(cellFileNames):
+					concatenateFiles([ f'{prefix}cells/{cellFileName}' for prefix in libraryParts[library] ], f'{targetDir}/cells/{cellFileName}', removeSources=False)
+			if headerManifests[library] is not None:
+				writeHeaderManifest(targetDir, headerManifests[library])
+				if args.sepf:
+					writeHeaderManifest(f'{targetDir}/cells', headerManifests[library])
+			writeCheckpoint(f'{targetDir}/checkpoint.json', {'readPairs':processedReadPairsPerLibrary[library], 'strategyYields':strategyYieldsPerLibrary[library], 'rejectReasons':rejectReasonsPerLibrary[library], 'cellStatistics':cellStatisticsPerLibrary[library], 'finished':True})
+			# The wall time of a library demultiplexed by the scheduler includes the time spent waiting for other jobs
+			writeLibraryReport(targetDir, library, processedReadPairsPerLibrary[library], strategyYieldsPerLibrary[library], rejectReasonsPerLibrary[library], statisticsPerLibrary[library], time.time()-schedulerStart)
+			writeCellStatistics(targetDir, cellStatisticsPerLibrary[library], strategyYieldsPerLibrary[library], barcodeParser, indexParser)
+			if os.path.exists(f'{libraryParts[library][0]}profile.prof'):
+				os.replace(f'{libraryParts[library][0]}profile.prof', f'{targetDir}/profile.prof')
+			for prefix in libraryParts[library]:
+				for outputName in outputNames+('checkpoint.json',):
+					if os.path.exists(f'{prefix}{outputName}'):
+						os.remove(f'{prefix}{outputName}')
+				if os.path.exists(f'{prefix}cells'):
+					shutil.rmtree(f'{prefix}cells')
+			if os.path.exists(f'{targetDir}/parts/{headerManifestName}'):
+				os.remove(f'{targetDir}/parts/{headerManifestName}')
+			os.rmdir(f'{targetDir}/parts')
+			print(f'{Fore.GREEN}Finished demultiplexing {library}{Style.RESET_ALL}')
+			printRejectReasons(library, processedReadPairsPerLibrary[library], rejectReasonsPerLibrary[library])
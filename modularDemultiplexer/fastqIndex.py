@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Random access index for (gzipped) fastq files, Buys de Barbanson
+import argparse
+import io
+import json
+import os
+import zlib
+
+# The index is stored next to the fastq file, with this extension:
+indexExtension = '.fqidx'
+
+class FastqIndex():
+	"""Checkpoints at record boundaries of a fastq file.
+
+	Every checkpoint is a list [recordIndex, memberOffset, uncompressedOffset]:
+	the record recordIndex starts uncompressedOffset bytes after the start of the gzip member
+	(or BGZF block) at byte memberOffset in the file. For uncompressed files memberOffset is
+	the byte offset of the record and uncompressedOffset is zero.
+
+	Decompression can only be started at the start of a gzip member, a single member gzip file
+	therefore only has a checkpoint at the first record. Multi member and BGZF files get a
+	checkpoint every checkpointInterval records.
+	"""
+
+	def __init__(self, path, records=0, checkpoints=None, checkpointInterval=1000000, size=None, mtime=None):
+		self.path = path
+		self.records = records
+		self.checkpoints = checkpoints if checkpoints is not None else [[0,0,0]]
+		self.checkpointInterval = checkpointInterval
+		self.size = size
+		self.mtime = mtime
+
+	def getCheckpoint(self, recordIndex):
+		"""Obtain the last checkpoint at or before recordIndex"""
+		selected = self.checkpoints[0]
+		for checkpoint in self.checkpoints:
+			if checkpoint[0]>recordIndex:
+				break
+			selected = checkpoint
+		return selected
+
+	def isValid(self):
+		"""Check if the indexed file was not changed after building the index"""
+		try:
+			stat = os.stat(self.path)
+		except OSError:
+			return False
+		return stat.st_size==self.size and int(stat.st_mtime)==self.mtime
+
+	def write(self, indexPath=None):
+		with open(indexPath if indexPath is not None else self.path+indexExtension, 'w') as f:
+			json.dump({
+				'records':self.records,
+				'checkpointInterval':self.checkpointInterval,
+				'size':self.size,
+				'mtime':self.mtime,
+				'checkpoints':self.checkpoints }, f)
+
+	@staticmethod
+	def read(path, indexPath=None):
+		with open(indexPath if indexPath is not None else path+indexExtension) as f:
+			index = json.load(f)
+		return FastqIndex(path, **index)
+
+
+def iterateGzipMembers(handle, blockSize=1048576):
+	"""Decompress all gzip members in handle.
+
+	Yields (byte offset of the member in the file, decompressed data) for every decompressed chunk
+	"""
+	memberOffset = 0
+	consumed = 0
+	decompressor = zlib.decompressobj(31)
+	memberStarted = False # False until data of the member at memberOffset was supplied to the decompressor
+	while True:
+		data = handle.read(blockSize)
+		if len(data)==0:
+			break
+		while len(data)>0:
+			if not memberStarted and len(data.strip(b'\x00'))==0:
+				# Padding after the last member
+				consumed += len(data)
+				memberOffset = None
+				break
+			memberStarted = True
+			decompressed = decompressor.decompress(data)
+			if len(decompressed):
+				yield memberOffset, decompressed
+			if not decompressor.eof:
+				consumed += len(data)
+				break
+			# The member ended, a new member starts after the unused data (or at the start of the next read)
+			unused = decompressor.unused_data
+			consumed += len(data)-len(unused)
+			data = unused
+			memberOffset = consumed
+			decompressor = zlib.decompressobj(31)
+			memberStarted = False
+
+
+def buildIndex(path, checkpointInterval=1000000, blockSize=1048576):
+	"""Build a FastqIndex by reading the complete fastq file at path"""
+	stat = os.stat(path)
+	index = FastqIndex(path, checkpointInterval=checkpointInterval, size=stat.st_size, mtime=int(stat.st_mtime))
+	isGzipped = os.path.splitext(path)[1]=='.gz'
+	lines = 0
+	atLineStart = True
+	currentMember = None
+	memberPosition = 0
+	checkpointDue = False
+	with open(path, 'rb') as handle:
+		if isGzipped:
+			chunks = iterateGzipMembers(handle, blockSize=blockSize)
+		else:
+			chunks = ( (0, data) for data in iter(lambda: handle.read(blockSize), b'') )
+
+		for memberOffset, data in chunks:
+			if memberOffset!=currentMember:
+				currentMember = memberOffset
+				memberPosition = 0
+				checkpointDue = (lines//4 - index.checkpoints[-1][0])>=checkpointInterval
+
+			if checkpointDue or not isGzipped:
+				# Find the first record boundary in this chunk
+				if atLineStart:
+					linesToBoundary = (4-lines%4)%4
+				else:
+					linesToBoundary = 4-lines%4
+				position = None
+				searchFrom = 0
+				for _ in range(linesToBoundary):
+					found = data.find(b'\n', searchFrom)
+					if found==-1:
+						break
+					searchFrom = found+1
+				else:
+					position = searchFrom
+				if position is not None and position<len(data):
+					recordIndex = (lines+linesToBoundary)//4
+					if recordIndex-index.checkpoints[-1][0]>=checkpointInterval:
+						if isGzipped:
+							index.checkpoints.append([recordIndex, memberOffset, memberPosition+position])
+						else:
+							index.checkpoints.append([recordIndex, memberPosition+position, 0])
+						checkpointDue = False
+			lines += data.count(b'\n')
+			memberPosition += len(data)
+			atLineStart = data.endswith(b'\n')
+		if not atLineStart:
+			# The last line is not terminated
+			lines += 1
+	index.records = lines//4
+	return index
+
+
+def getFastqIndex(path, checkpointInterval=1000000, build=True):
+	"""Obtain the index of the fastq file at path.
+
+	When no valid index is stored next to the file, the index is built (when build is True)
+	and stored next to the file when possible. Returns None when no index is available.
+	"""
+	try:
+		index = FastqIndex.read(path)
+		if index.isValid():
+			return index
+	except (OSError, ValueError, TypeError):
+		pass
+	if not build:
+		return None
+	index = buildIndex(path, checkpointInterval=checkpointInterval)
+	try:
+		index.write()
+	except OSError:
+		pass
+	return index
+
+
+def estimateRecordCount(path, sampleSize=4194304):
+	"""Obtain the amount of records in the fastq file at path.
+
+	Returns (amount of records, exact). The amount is read from the random access index when available,
+	otherwise it is extrapolated from the amount of records in the first sampleSize bytes of the file
+	"""
+	index = getFastqIndex(path, build=False)
+	if index is not None:
+		return index.records, True
+	size = os.path.getsize(path)
+	with open(path, 'rb') as handle:
+		data = handle.read(sampleSize)
+	if os.path.splitext(path)[1]=='.gz':
+		lines = sum( decompressed.count(b'\n') for _, decompressed in iterateGzipMembers(io.BytesIO(data)) )
+	else:
+		lines = data.count(b'\n')
+	if len(data)>=size:
+		return lines//4, True
+	return int(lines/4*size/max(1,len(data))), False
+
+
+if __name__ == '__main__':
+	argparser = argparse.ArgumentParser(
+	 formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+	 description='Build random access indices for fastq files, the index is stored next to every fastq file with the extension .fqidx')
+	argparser.add_argument('fastqfiles', type=str, nargs='*')
+	argparser.add_argument('-interval', type=int, default=1000000, help='Amount of records between checkpoints')
+	args = argparser.parse_args()
+	for path in args.fastqfiles:
+		index = buildIndex(path, checkpointInterval=args.interval)
+		index.write()
+		print(f'{path}: {index.records} records, {len(index.checkpoints)} checkpoints')
@@ -1,28 +1,261 @@
 # Fastq iterator class, Buys de Barbanson
 import collections
 import gzip
+import io
 import os
+import queue
+import shutil
+import stat
+import subprocess
+import sys
+import threading
+import bgzf
+import fastqIndex
 
 FastqRecord = collections.namedtuple('FastqRecord', 'header sequence plus qual')
 
+class BackgroundReader(io.RawIOBase):
+	"""Reads (and thereby decompresses) a handle in a background thread.
+
+	The thread is only started when the first data is read, it reads ahead at most queueSize blocks.
+	"""
+
+	def __init__(self, handle, blockSize=1048576, queueSize=8):
+		io.RawIOBase.__init__(self)
+		self.name = getattr(handle, 'name', None)
+		self.handle = handle
+		self.blockSize = blockSize
+		self.queue = queue.Queue(queueSize)
+		self.thread = None
+		self.stopped = False
+		self.buffer = memoryview(b'')
+		self.eof = False
+
+	def readable(self):
+		return True
+
+	def _readAhead(self):
+		try:
+			while not self.stopped:
+				data = self.handle.read(self.blockSize)
+				self.queue.put(data)
+				if len(data)==0:
+					break
+		except Exception as e:
+			self.queue.put(e)
+
+	def readinto(self, b):
+		if self.thread is None:
+			self.thread = threading.Thread(target=self._readAhead, daemon=True)
+			self.thread.start()
+		while len(self.buffer)==0:
+			if self.eof:
+				return 0
+			data = self.queue.get()
+			if isinstance(data, Exception):
+				raise data
+			if len(data)==0:
+				self.eof = True
+				return 0
+			self.buffer = memoryview(data)
+		n = min(len(b), len(self.buffer))
+		b[:n] = self.buffer[:n]
+		self.buffer = self.buffer[n:]
+		return n
+
+	def close(self):
+		self.stopped = True
+		if self.thread is not None:
+			# Unblock the reading thread when it is waiting for space in the queue
+			while self.thread.is_alive():
+				try:
+					self.queue.get(timeout=0.1)
+				except queue.Empty:
+					pass
+		self.handle.close()
+		io.RawIOBase.close(self)
+
+
+class PigzReader(io.RawIOBase):
+	"""Decompresses a gzip file using an external pigz process.
+
+	The process is only started when the first data is read.
+	Decompression starts at the gzip member at byte offset.
+	"""
+
+	def __init__(self, path, threads=2, offset=0):
+		io.RawIOBase.__init__(self)
+		self.name = path
+		self.threads = threads
+		self.offset = offset
+		self.process = None
+
+	def readable(self):
+		return True
+
+	def readinto(self, b):
+		if self.process is None:
+			with open(self.name, 'rb') as compressed:
+				compressed.seek(self.offset)
+				self.process = subprocess.Popen(['pigz', '-d', '-c', '-p', str(self.threads)], stdin=compressed, stdout=subprocess.PIPE)
+		n = self.process.stdout.readinto(b)
+		if n==0 and self.process.wait()!=0:
+			raise IOError(f'pigz failed to decompress {self.name}, exit code {self.process.returncode}')
+		return n
+
+	def close(self):
+		if self.process is not None:
+			if self.process.poll() is None:
+				self.process.terminate()
+			self.process.stdout.close()
+			self.process.wait()
+			self.process = None
+		io.RawIOBase.close(self)
+
+
+class Prefetcher():
+	"""Iterates over an iterable in a background thread, at most queueSize items are read ahead.
+
+	The thread is only started when the first item is requested.
+	"""
+
+	def __init__(self, iterable, queueSize=4):
+		self.iterable = iterable
+		self.queue = queue.Queue(queueSize)
+		self.thread = None
+		self.stopped = False
+		self.exhausted = False
+
+	def _prefetch(self):
+		try:
+			for item in self.iterable:
+				if self.stopped:
+					return
+				self.queue.put((item, None))
+		except Exception as e:
+			self.queue.put((None, e))
+			return
+		self.queue.put((StopIteration, None))
+
+	def __iter__(self):
+		return(self)
+
+	def __next__(self):
+		if self.exhausted:
+			raise StopIteration
+		if self.thread is None:
+			self.thread = threading.Thread(target=self._prefetch, daemon=True)
+			self.thread.start()
+		item, exception = self.queue.get()
+		if exception is not None:
+			self.exhausted = True
+			raise exception
+		if item is StopIteration:
+			self.exhausted = True
+			raise StopIteration
+		return(item)
+
+	def close(self):
+		self.stopped = True
+		if self.thread is not None:
+			# Unblock the prefetching thread when it is waiting for space in the queue
+			while self.thread.is_alive():
+				try:
+					self.queue.get(timeout=0.1)
+				except queue.Empty:
+					pass
+
+
+def isStream(path):
+	"""Check if path refers to stdin (-) or a named pipe, these can only be read once from start to end"""
+	return path=='-' or stat.S_ISFIFO(os.stat(path).st_mode)
+
+def openFastqStream(path, threads=1, blockSize=1048576):
+	"""Open stdin (-) or a named pipe for reading bytes, gzipped data is recognised by its magic bytes and decompressed"""
+	stream = sys.stdin.buffer if path=='-' else open(path, 'rb')
+	if stream.peek(2)[:2]!=b'\x1f\x8b':
+		return stream
+	handle = gzip.GzipFile(fileobj=stream, mode='rb')
+	if path!='-':
+		handle.myfileobj = stream
+	if threads<=1:
+		return handle
+	return io.BufferedReader(BackgroundReader(handle, blockSize=blockSize), buffer_size=blockSize)
+
+def openFastq(path, threads=1, blockSize=1048576, offset=0):
+	"""Open a fastq file for reading bytes, gzipped files are decompressed.
+
+	When threads is larger than one, BGZF files are decompressed on a thread pool of this size.
+	Other gzip files are decompressed by pigz when it is available, otherwise in a background thread.
+	Reading starts at byte offset, for gzipped files this has to be the start of a gzip member.
+	Stdin (-) and named pipes are supported, these can only be read from the start, see openFastqStream
+	"""
+	if isStream(path):
+		if offset>0:
+			raise ValueError(f'{path} is a stream, reading can only start at the first record')
+		return openFastqStream(path, threads=threads, blockSize=blockSize)
+	if os.path.splitext(path)[1] != '.gz':
+		handle = open(path, 'rb')
+		handle.seek(offset)
+		return handle
+	if threads<=1 or not ( bgzf.isBgzf(path) or shutil.which('pigz') is not None ):
+		compressed = open(path, 'rb')
+		compressed.seek(offset)
+		handle = gzip.GzipFile(fileobj=compressed, mode='rb')
+		# Close the underlying file together with the GzipFile
+		handle.myfileobj = compressed
+		if threads<=1:
+			return handle
+		return io.BufferedReader(BackgroundReader(handle, blockSize=blockSize), buffer_size=blockSize)
+	if bgzf.isBgzf(path):
+		return io.BufferedReader(bgzf.BgzfReader(path, threads=threads, offset=offset), buffer_size=blockSize)
+	return io.BufferedReader(PigzReader(path, threads=threads, offset=offset), buffer_size=blockSize)
+
+
+def openFastqAtRecord(path, recordIndex, threads=1, blockSize=1048576, index=None):
+	"""Open a fastq file for reading bytes, as close as possible before record recordIndex.
+
+	The random access index of the file (see fastqIndex) is used when available.
+	Returns the handle and the amount of records which have to be skipped to arrive at recordIndex
+	"""
+	if recordIndex>0 and index is None and not isStream(path):
+		index = fastqIndex.getFastqIndex(path, build=False)
+	if recordIndex==0 or index is None:
+		return openFastq(path, threads=threads, blockSize=blockSize), recordIndex
+	checkpointRecord, memberOffset, uncompressedOffset = index.getCheckpoint(recordIndex)
+	handle = openFastq(path, threads=threads, blockSize=blockSize, offset=memberOffset)
+	while uncompressedOffset>0:
+		skipped = len(handle.read(min(uncompressedOffset, blockSize)))
+		if skipped==0:
+			raise ValueError(f'The index of {path} does not match the file')
+		uncompressedOffset -= skipped
+	return handle, recordIndex-checkpointRecord
+
 class FastqIterator():
 	"""FastqIterator, iterates over one or more fastq files."""
 
-	def __init__(self, *args):
+	def __init__(self, *args, threads=1, prefetch=0, start=0, end=None):
 		"""Initialise  FastqIterator.
 
 		Argument(s):
 		path to fastq file, path to fastq file 2 , ...
+		threads: amount of decompression threads per file, see openFastq
+		prefetch: when larger than zero, every file is read in a background thread
+			which reads ahead this amount of batches of records, see FastqBatchIterator
+		start, end: only iterate over the records start up to end, the random access index of the files is used when available, see fastqIndex
 		example: for rec1, rec2 in FastqIterator('./R1.fastq', './R2.fastq'):
 		"""
-		
+
+		self.readIndex = 0
+		if prefetch>0 or start>0 or end is not None:
+			self.handles = None
+			self.batches = FastqBatchIterator(*args, batchSize=1000, threads=threads, prefetch=prefetch, start=start, maxRecords=None if end is None else end-start)
+			self.prefetchedRecords = iter(())
+			return
 		self.handles = tuple(
-			gzip.open(path, 'rt')
-			# Load as GZIP when the extension is .gz
-			if os.path.splitext(path)[1] == '.gz' else open(path, 'r')
+			io.TextIOWrapper(openFastq(path, threads=threads))
 			for path in args
 		)
-		self.readIndex = 0
 
 	def _readFastqRecord(self, handle):
 		# Read four lines and load them into a FastqRecord
@@ -37,8 +270,162 @@ class FastqIterator():
 	def __next__(self):
 		"""Obtain the next fastq record for all opened files."""
 		self.readIndex += 1  # Increment the current read counter
+		if self.handles is None:
+			records = next(self.prefetchedRecords, None)
+			if records is None:
+				self.prefetchedRecords = iter(blocksToReadPairs(next(self.batches)))
+				records = next(self.prefetchedRecords)
+			return(records)
 		records = tuple(self._readFastqRecord(handle) for handle in self.handles)
 		# Stop when empty records are being returned; the file end is reached
 		if any((len(rec.header) == 0 for rec in records)):
 			raise StopIteration
 		return(records)
+
+
+def readRecordBlocks(handle, batchSize=5000, blockSize=4194304, maxRecords=None, skipRecords=0):
+	"""Yield blocks of bytes which contain batchSize complete fastq records.
+
+	The handle is read blockSize bytes at a time, the records are split off without
+	reading line by line. The last block can contain less records.
+	The first skipRecords records are read but not yielded.
+	"""
+	buffer = b''
+	bufferedLines = 0
+	eof = False
+	recordsLeft = maxRecords
+	while recordsLeft is None or recordsLeft>0:
+		if skipRecords>0:
+			recordCount = min(batchSize, skipRecords)
+		else:
+			recordCount = batchSize if recordsLeft is None else min(batchSize, recordsLeft)
+		lineCount = 4*recordCount
+		while not eof and bufferedLines<lineCount:
+			data = handle.read(blockSize)
+			if len(data)==0:
+				eof = True
+				break
+			buffer += data
+			bufferedLines += data.count(b'\n')
+
+		if bufferedLines>=lineCount:
+			remainder = buffer.split(b'\n', lineCount)[-1]
+			block = buffer[:len(buffer)-len(remainder)]
+			buffer = remainder
+			bufferedLines -= lineCount
+		else:
+			# End of the file reached, the last line is not always terminated
+			if len(buffer.strip())==0:
+				return
+			block = buffer if buffer.endswith(b'\n') else buffer+b'\n'
+			buffer = b''
+			bufferedLines = 0
+			if block.count(b'\n')%4!=0:
+				raise ValueError(f'Truncated fastq record at the end of {getattr(handle, "name", handle)}')
+			recordCount = block.count(b'\n')//4
+
+		if not block.startswith(b'@'):
+			raise ValueError(f'Fastq record does not start with @ in {getattr(handle, "name", handle)}: {block[:80]}')
+		if skipRecords>0:
+			skipRecords -= recordCount
+			continue
+		if recordsLeft is not None:
+			recordsLeft -= recordCount
+		yield block
+
+
+def blocksToReadPairs(blocks):
+	"""Convert a tuple of record blocks (one for every mate) to a list of FastqRecord tuples"""
+	mates = []
+	for block in blocks:
+		text = block.decode()
+		if '\r' in text:
+			text = text.replace('\r', '')
+		lines = text.split('\n')
+		mates.append( list(map(FastqRecord, lines[0::4], lines[1::4], lines[2::4], lines[3::4])) )
+	return list(zip(*mates))
+
+
+class FastqBatchIterator():
+	"""FastqBatchIterator, iterates over one or more fastq files in batches of records.
+
+	Every iteration yields a tuple with one block of bytes per file, every block contains
+	the same amount of complete fastq records. Use blocksToReadPairs to obtain FastqRecords.
+	"""
+
+	def __init__(self, *args, batchSize=5000, blockSize=4194304, maxRecords=None, threads=1, prefetch=0, start=0):
+		"""Initialise FastqBatchIterator.
+
+		Argument(s):
+		path to fastq file, path to fastq file 2 , ...
+		batchSize: amount of records per batch
+		blockSize: amount of (decompressed) bytes read at once
+		maxRecords: stop after this amount of records
+		threads: amount of decompression threads per file, see openFastq
+		prefetch: when larger than zero, every file is read in its own background thread,
+			which reads ahead this amount of batches
+		start: index of the first record to read, the random access index of the files is used when available
+		example: for blockR1, blockR2 in FastqBatchIterator('./R1.fastq.gz', './R2.fastq.gz'):
+		"""
+		self.paths = args
+		handlesAndSkips = [ openFastqAtRecord(path, start, threads=threads) for path in args ]
+		self.handles = tuple( handle for handle, skipRecords in handlesAndSkips )
+		self.mateBlocks = tuple(
+			readRecordBlocks(handle, batchSize=batchSize, blockSize=blockSize, maxRecords=maxRecords, skipRecords=skipRecords)
+			for handle, skipRecords in handlesAndSkips )
+		if prefetch>0:
+			self.mateBlocks = tuple( Prefetcher(mateBlocks, queueSize=prefetch) for mateBlocks in self.mateBlocks )
+		self.readIndex = start
+
+	def __iter__(self):
+		return(self)
+
+	def __next__(self):
+		"""Obtain the next block of records for all opened files."""
+		blocks = tuple( next(mateBlocks, None) for mateBlocks in self.mateBlocks )
+		if all( block is None for block in blocks ):
+			raise StopIteration
+		recordCounts = [ None if block is None else block.count(b'\n')//4 for block in blocks ]
+		if len(set(recordCounts))!=1:
+			raise ValueError(f'The mates are truncated, the files {", ".join(self.paths)} do not contain the same amount of records after record {self.readIndex}')
+		self.readIndex += recordCounts[0]
+		return(blocks)
+
+	def close(self):
+		for mateBlocks in self.mateBlocks:
+			if isinstance(mateBlocks, Prefetcher):
+				mateBlocks.close()
+		for handle in self.handles:
+			handle.close()
+
+
+class InterleavedBatchIterator(FastqBatchIterator):
+	"""InterleavedBatchIterator, iterates over an interleaved fastq file in batches of read pairs.
+
+	In an interleaved file the records of mate 1 and mate 2 alternate. Every iteration yields a tuple
+	with a block of mate 1 records and a block of mate 2 records, like FastqBatchIterator does for two files.
+	The arguments are the same as the arguments of FastqBatchIterator, but count read pairs instead of records.
+	example: for blockR1, blockR2 in InterleavedBatchIterator('-'):
+	"""
+
+	def __init__(self, path, batchSize=5000, blockSize=4194304, maxRecords=None, threads=1, prefetch=0, start=0):
+		self.paths = (path,)
+		handle, skipRecords = openFastqAtRecord(path, 2*start, threads=threads)
+		self.handles = (handle,)
+		self.mateBlocks = (
+			readRecordBlocks(handle, batchSize=2*batchSize, blockSize=blockSize, maxRecords=None if maxRecords is None else 2*maxRecords, skipRecords=skipRecords), )
+		if prefetch>0:
+			self.mateBlocks = tuple( Prefetcher(mateBlocks, queueSize=prefetch) for mateBlocks in self.mateBlocks )
+		self.readIndex = start
+
+	def __next__(self):
+		"""Obtain the next blocks of mate 1 and mate 2 records."""
+		block = next(self.mateBlocks[0], None)
+		if block is None:
+			raise StopIteration
+		lines = block.split(b'\n')
+		records = [ b'\n'.join(lines[i:i+4]) for i in range(0, len(lines)-1, 4) ]
+		if len(records)%2!=0:
+			raise ValueError(f'The interleaved file {self.paths[0]} contains a record without mate after read pair {self.readIndex}')
+		self.readIndex += len(records)//2
+		return( b'\n'.join(records[0::2])+b'\n', b'\n'.join(records[1::2])+b'\n' )
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Runs jobs in separate processes under a core and memory budget, Buys de Barbanson
+import multiprocessing
+import queue
+
+class Job():
+	def __init__(self, name, target, args=(), size=0, cores=1, memory=0):
+		"""Initialise Job.
+
+		Argument(s):
+		name: unique name of the job
+		target, args: the function executed by the job and its arguments, the return value of the function is the result of the job
+		size: used to order the jobs, larger jobs are started first (for example the size of the input files)
+		cores: amount of cores used by the job
+		memory: amount of memory used by the job (in GB)
+		"""
+		self.name = name
+		self.target = target
+		self.args = args
+		self.size = size
+		self.cores = cores
+		self.memory = memory
+		self.process = None
+
+	def __repr__(self):
+		return f'{self.name} ({self.cores} cores, {self.memory}GB)'
+
+
+def runJob(target, args, name, results):
+	results.put( (name, target(*args)) )
+
+
+class JobScheduler():
+	"""Runs jobs in forked processes, the running jobs use at most cores cores and memory GB of memory.
+
+	The jobs are started largest first, smaller jobs are started when a larger job does not fit in the budget.
+	A job which does not fit in the budget on its own is started when no other jobs are running.
+	"""
+
+	def __init__(self, cores=1, memory=None):
+		self.cores = cores
+		self.memory = memory
+		self.jobs = []
+
+	def add(self, name, target, args=(), size=0, cores=1, memory=0):
+		self.jobs.append( Job(name, target, args, size=size, cores=cores, memory=memory) )
+
+	def fits(self, job, running):
+		if sum(runningJob.cores for runningJob in running)+job.cores>self.cores:
+			return False
+		if self.memory is not None and sum(runningJob.memory for runningJob in running)+job.memory>self.memory:
+			return False
+		return True
+
+	def run(self):
+		"""Run all added jobs, yields (name, result) for every job when it is finished"""
+		context = multiprocessing.get_context('fork')
+		results = context.Queue()
+		waiting = sorted(self.jobs, key=lambda job: job.size, reverse=True)
+		self.jobs = []
+		running = {}
+		try:
+			while len(waiting)>0 or len(running)>0:
+				for job in list(waiting):
+					if len(running)==0 or self.fits(job, running.values()):
+						job.process = context.Process(target=runJob, args=(job.target, job.args, job.name, results))
+						job.process.start()
+						running[job.name] = job
+						waiting.remove(job)
+				try:
+					name, result = results.get(timeout=1)
+				except queue.Empty:
+					for job in running.values():
+						if job.process.exitcode not in (None,0):
+							raise RuntimeError(f'Job {job.name} failed')
+					continue
+				running.pop(name).process.join()
+				yield name, result
+		finally:
+			for job in running.values():
+				job.process.terminate()
+				job.process.join()
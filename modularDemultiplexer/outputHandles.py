@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Handles which store the demultiplexed and rejected read pairs, Buys de Barbanson
+import collections
+import concurrent.futures
+import os
+import random
+import bgzf
+import unalignedBam
+from baseDemultiplexMethods import HeaderCompactor,writeHeaderManifest
+
+class FastqHandle:
+	"""Writes records to a (pair of) BGZF compressed fastq file(s), the files can be read by samtools and other htslib based tools"""
+
+	def __init__(self, path, pairedEnd=False, resumeState=None, compressionLevel=6, threads=2, headerManifest=None ):
+		"""Initialise FastqHandle.
+
+		resumeState: state returned by checkpoint, the files are truncated to the checkpoint and writing continues from there
+		compressionLevel: gzip compression level
+		threads: amount of threads used to compress the blocks of all files, 1 compresses in the calling thread
+		headerManifest: tags stored in the header manifest next to the files, the records are written with compact headers (see --compactHeaders)
+		"""
+		self.pe = pairedEnd
+		if pairedEnd:
+			self.paths = [ path+'R1.fastq.gz', path+'R2.fastq.gz' ]
+		else:
+			self.paths = [ path+'reads.fastq.gz' ]
+		if resumeState is None:
+			self.rawHandles = [ open(path, 'wb') for path in self.paths ]
+		else:
+			self.rawHandles = []
+			for path, offset in zip(self.paths, resumeState['offsets']):
+				rawHandle = open(path, 'r+b')
+				rawHandle.truncate(offset)
+				rawHandle.seek(offset)
+				self.rawHandles.append(rawHandle)
+		# The files share one pool of compression threads
+		self.pool = concurrent.futures.ThreadPoolExecutor(threads) if threads>1 else None
+		self.handles = [ bgzf.BgzfWriter(rawHandle, level=compressionLevel, threads=threads, pool=self.pool) for rawHandle in self.rawHandles ]
+		self.headerCompactor = None
+		if headerManifest is not None:
+			writeHeaderManifest(os.path.dirname(path) or '.', headerManifest)
+			self.headerCompactor = HeaderCompactor(headerManifest)
+
+	def write(self, records ):
+		if self.headerCompactor is not None:
+			records = [ self.headerCompactor.compact(record) for record in records ]
+		for handle, record in zip(self.handles, records):
+			handle.write(record.encode())
+
+	def checkpoint(self):
+		"""Write all buffered records as complete BGZF blocks and flush them to disk.
+
+		Returns the state required to resume writing after the records written so far, see resumeState
+		"""
+		offsets = []
+		for handle, rawHandle in zip(self.handles, self.rawHandles):
+			handle.flush()
+			os.fsync(rawHandle.fileno())
+			offsets.append(rawHandle.tell())
+		return {'offsets':offsets}
+
+	def close(self):
+		for handle in self.handles:
+			handle.close()
+		for rawHandle in self.rawHandles:
+			rawHandle.close()
+		if self.pool is not None:
+			self.pool.shutdown()
+
+
+class RejectSampleHandle(FastqHandle):
+	"""Stores a uniform random sample of sampleSize of the written records (reservoir sampling), the sample is written when closing"""
+
+	def __init__(self, path, pairedEnd=False, sampleSize=10000, seed=0, resumeState=None, compressionLevel=6, threads=2):
+		FastqHandle.__init__(self, path, pairedEnd, compressionLevel=compressionLevel, threads=threads)
+		self.sampleSize = sampleSize
+		self.sample = []
+		self.seen = 0
+		self.random = random.Random(seed)
+		if resumeState is not None:
+			self.sample = resumeState['sample']
+			self.seen = resumeState['seen']
+			self.random.setstate( tuple( tuple(value) if type(value)==list else value for value in resumeState['random'] ) )
+
+	def write(self, records ):
+		self.seen += 1
+		if len(self.sample)<self.sampleSize:
+			self.sample.append(records)
+		else:
+			replace = self.random.randrange(self.seen)
+			if replace<self.sampleSize:
+				self.sample[replace] = records
+
+	def checkpoint(self):
+		# Nothing is written to the files before closing, the sample is part of the state
+		return {'sample':self.sample, 'seen':self.seen, 'random':self.random.getstate()}
+
+	def close(self):
+		for records in self.sample:
+			FastqHandle.write(self, records)
+		FastqHandle.close(self)
+
+
+class UnalignedBamHandle(FastqHandle):
+	"""Writes read pairs to a BGZF compressed unaligned BAM file, the tags are stored as typed BAM tags"""
+
+	def __init__(self, path, resumeState=None, compressionLevel=6, threads=2):
+		self.paths = [ path+'.bam' ]
+		if resumeState is None:
+			self.rawHandles = [ open(self.paths[0], 'wb') ]
+		else:
+			rawHandle = open(self.paths[0], 'r+b')
+			rawHandle.truncate(resumeState['offsets'][0])
+			rawHandle.seek(resumeState['offsets'][0])
+			self.rawHandles = [ rawHandle ]
+		self.pool = concurrent.futures.ThreadPoolExecutor(threads) if threads>1 else None
+		self.handles = [ bgzf.BgzfWriter(self.rawHandles[0], level=compressionLevel, threads=threads, pool=self.pool) ]
+		if resumeState is None:
+			# The header is stored in separate blocks, this way the header can be skipped when concatenating files
+			self.handles[0].write( unalignedBam.encodeHeader('@HD\tVN:1.6\tSO:unsorted\n@PG\tID:demux\tPN:demux.py\n') )
+			self.handles[0].flush()
+
+	def write(self, records ):
+		self.handles[0].write( unalignedBam.encodeReadPair(records) )
+
+
+class CellFastqHandle:
+	"""Writes the records of every cell to a separate (pair of) BGZF compressed fastq file(s) in directory.
+
+	The records are buffered per cell, at most maxHandles files are opened at the same time (one file per mate of a cell),
+	at least the files of one cell are opened.
+	When a closed file is written to again the new blocks are appended to it.
+	"""
+
+	def __init__(self, directory, pairedEnd=False, maxHandles=32, cellBufferSize=262144, maxBufferedBytes=67108864, resumeState=None, compressionLevel=6, threads=2, headerManifest=None):
+		"""Initialise CellFastqHandle.
+
+		cellBufferSize: the records of a cell are written when this amount of bytes is buffered for the cell
+		maxBufferedBytes: the largest buffers are written when more than this amount of bytes is buffered in total
+		resumeState: state returned by checkpoint, the cell files are truncated to the checkpoint and writing continues from there
+		headerManifest: tags stored in the header manifest in directory, the records are written with compact headers (see --compactHeaders)
+		"""
+		self.directory = directory
+		self.mates = ['R1', 'R2'] if pairedEnd else ['reads']
+		self.maxHandles = maxHandles
+		self.cellBufferSize = cellBufferSize
+		self.maxBufferedBytes = maxBufferedBytes
+		self.compressionLevel = compressionLevel
+		self.threads = threads
+		# All cell files share one pool of compression threads
+		self.pool = concurrent.futures.ThreadPoolExecutor(threads) if threads>1 else None
+		self.handles = collections.OrderedDict() # cell -> opened BGZF writers, in order of use
+		self.buffers = collections.defaultdict(lambda: [ [] for mate in self.mates ]) # cell -> buffered records per mate
+		self.bufferedBytes = collections.Counter()
+		self.totalBufferedBytes = 0 # sum of bufferedBytes
+		self.offsets = {} # cell -> size of the files when they were closed for the last time
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		self.headerCompactor = None
+		if headerManifest is not None:
+			writeHeaderManifest(directory, headerManifest)
+			self.headerCompactor = HeaderCompactor(headerManifest)
+		if resumeState is not None:
+			self.offsets = resumeState['offsets']
+		# Remove the records written after the checkpoint, or all records of a previous run
+		for fileName in os.listdir(directory):
+			if not fileName.endswith('.fastq.gz'):
+				continue
+			cell, mate = fileName[:-len('.fastq.gz')].rsplit('_', 1)
+			if cell in self.offsets:
+				with open(f'{directory}{fileName}', 'r+b') as f:
+					f.truncate( self.offsets[cell][self.mates.index(mate)] )
+			else:
+				os.remove(f'{directory}{fileName}')
+
+	def getCell(self, record):
+		"""Obtain the cell name of a tagged record: strategy (MX) and cell index (BI), or sample name (SM)"""
+		tags = dict( keyValue.split(':', 1) for keyValue in record[1:record.index('\n')].split(';') )
+		return f"{tags.get('MX', 'unknown')}_{tags.get('BI', tags.get('SM', 'bulk'))}"
+
+	def write(self, records ):
+		cell = self.getCell(records[0])
+		if self.headerCompactor is not None:
+			records = [ self.headerCompactor.compact(record) for record in records ]
+		buffers = self.buffers[cell]
+		for buffer, record in zip(buffers, records):
+			buffer.append(record)
+			self.bufferedBytes[cell] += len(record)
+			self.totalBufferedBytes += len(record)
+		if self.bufferedBytes[cell]>=self.cellBufferSize:
+			self.writeCell(cell)
+		if self.totalBufferedBytes>self.maxBufferedBytes:
+			for cell, _ in self.bufferedBytes.most_common(len(self.bufferedBytes)//2+1):
+				self.writeCell(cell)
+
+	def getCellHandles(self, cell):
+		if cell in self.handles:
+			self.handles.move_to_end(cell)
+			return self.handles[cell]
+		while len(self.handles) and (len(self.handles)+1)*len(self.mates)>self.maxHandles:
+			self.closeCell( next(iter(self.handles)) )
+		# New files are created, files which were closed before get new blocks appended
+		paths = [ f'{self.directory}{cell}_{mate}.fastq.gz' for mate in self.mates ]
+		rawHandles = [ bgzf.openBgzfForAppending(path) if cell in self.offsets else open(path, 'wb') for path in paths ]
+		self.handles[cell] = [ bgzf.BgzfWriter(rawHandle, level=self.compressionLevel, threads=self.threads, pool=self.pool) for rawHandle in rawHandles ]
+		return self.handles[cell]
+
+	def writeCell(self, cell):
+		if self.bufferedBytes[cell]==0:
+			return
+		for handle, buffer in zip(self.getCellHandles(cell), self.buffers[cell]):
+			handle.write( ''.join(buffer).encode() )
+			buffer.clear()
+		self.totalBufferedBytes -= self.bufferedBytes[cell]
+		del self.bufferedBytes[cell]
+
+	def closeCell(self, cell):
+		for handle in self.handles.pop(cell):
+			handle.close()
+			handle.handle.close()
+		self.offsets[cell] = [ os.path.getsize(f'{self.directory}{cell}_{mate}.fastq.gz') for mate in self.mates ]
+
+	def checkpoint(self):
+		"""Write all buffered records and close all files, returns the state required to resume writing, see resumeState"""
+		for cell in list(self.bufferedBytes):
+			self.writeCell(cell)
+		for cell in list(self.handles):
+			self.closeCell(cell)
+		return {'offsets':dict(self.offsets)}
+
+	def close(self):
+		self.checkpoint()
+		if self.pool is not None:
+			self.pool.shutdown()
+
+
+class InterleavedStreamHandle:
+	"""Writes the records of all mates, one after another, uncompressed to a stream"""
+
+	def __init__(self, stream):
+		self.stream = stream
+
+	def write(self, records ):
+		self.stream.write(''.join(records))
+
+	def close(self):
+		self.stream.flush()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# End-to-end scaling and memory benchmark of demux.py on synthetic multi-library, multi-lane runs, Buys de Barbanson
+import argparse
+import concurrent.futures
+import gzip
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from colorama import Fore
+from colorama import Style
+import barcodeFileParser
+import benchmark
+
+demuxPath = os.path.join( os.path.dirname(os.path.realpath(__file__)), 'demux.py')
+
+def getInputPaths(directory, libraries, lanes):
+	"""Paths of the synthetic fastq files, named like the files written by bcl2fastq: {library: {lane: (R1, R2)}}"""
+	return { f'SynLib{libraryIndex}':{ lane:tuple( f'{directory}/SynLib{libraryIndex}_S{libraryIndex+1}_L00{lane}_R{mate+1}_001.fastq.gz' for mate in range(2) ) for lane in range(1, lanes+1) } for libraryIndex in range(libraries) }
+
+
+def writeSyntheticFastq(path, mate, strategyName, libraryIndex, lane, readPairs, poolSize=100000, seed=0):
+	"""Write mate of readPairs synthetic read pairs of a lane to path.
+
+	The read pairs are drawn from a pool of poolSize read pairs generated for the strategy, the read names are unique
+	"""
+	barcodeParser = barcodeFileParser.BarcodeParser(hammingDistanceExpansion=0)
+	indexParser = barcodeFileParser.BarcodeParser(hammingDistanceExpansion=0, barcodeDirectory='indices')
+	strategy = next( strategy for strategy in benchmark.loadStrategies(barcodeParser, indexParser, ignoreMethods=('restriction-bisulfite','scarsMiSeq')) if strategy.shortName==strategyName )
+	pool = [ readPair[mate] for readPair in benchmark.generateReadPairs(strategy, min(poolSize, readPairs), barcodeParser, indexParser, seed=seed+libraryIndex) ]
+	with gzip.open(path+'.tmp', 'wt', compresslevel=1) as f:
+		for start in range(0, readPairs, len(pool)):
+			f.write(''.join(
+				f'@NS500413:32:H14TKBGXX:{lane}:{11101+readPairIndex//25000000}:{1+readPairIndex%5000}:{1+(readPairIndex//5000)%5000} {record.header.split(" ",1)[1]}\n{record.sequence}\n+\n{record.qual}\n'
+				for readPairIndex, record in zip(range(start, min(start+len(pool), readPairs)), pool) ))
+	os.rename(path+'.tmp', path)
+	return path
+
+
+def generateInput(directory, readPairs, libraries, lanes, strategies, poolSize=100000, seed=0, processes=1):
+	"""Generate the fastq files of a synthetic run of readPairs read pairs, divided over the libraries and lanes.
+
+	The libraries are generated for the strategies in turn. Files which already exist are kept
+	"""
+	os.makedirs(directory, exist_ok=True)
+	inputPaths = getInputPaths(directory, libraries, lanes)
+	laneReadPairs = readPairs//(libraries*lanes)
+	with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+		futures = []
+		for libraryIndex, (library, libraryLanes) in enumerate(inputPaths.items()):
+			for lane, paths in libraryLanes.items():
+				for mate, path in enumerate(paths):
+					if not os.path.exists(path):
+						futures.append( pool.submit(writeSyntheticFastq, path, mate, strategies[libraryIndex%len(strategies)], libraryIndex, lane, laneReadPairs, poolSize, seed) )
+		for future in concurrent.futures.as_completed(futures):
+			future.result()
+	return [ path for libraryLanes in inputPaths.values() for paths in libraryLanes.values() for path in paths ]
+
+
+def getProcessTreeRss(pid):
+	"""Sum of the resident set sizes (bytes) of the process pid and all its descendants, None when /proc is not available"""
+	children = {}
+	try:
+		for entry in os.listdir('/proc'):
+			if entry.isdigit():
+				try:
+					with open(f'/proc/{entry}/stat') as f:
+						# The process name can contain spaces, the fields after it are separated by spaces
+						parentPid = int(f.read().rsplit(')',1)[1].split()[1])
+				except (OSError, IndexError, ValueError):
+					continue
+				children.setdefault(parentPid, []).append(int(entry))
+	except OSError:
+		return None
+	rss = 0
+	pageSize = os.sysconf('SC_PAGE_SIZE')
+	pending = [pid]
+	while pending:
+		processPid = pending.pop()
+		try:
+			with open(f'/proc/{processPid}/statm') as f:
+				rss += int(f.read().split()[1])*pageSize
+		except (OSError, IndexError, ValueError):
+			pass
+		pending += children.get(processPid, [])
+	return rss
+
+
+def getDirectorySize(directory):
+	return sum( os.path.getsize(os.path.join(root, fileName)) for root, directories, fileNames in os.walk(directory) for fileName in fileNames )
+
+
+def runDemux(arguments, logPath, sampleInterval=0.25):
+	"""Run demux.py with arguments, the output is written to logPath.
+
+	Returns the duration, the peak RSS of the largest process, the RSS of the process tree over time [(seconds, bytes)] and the exit code
+	"""
+	samples = []
+	with open(logPath, 'w') as log:
+		start = time.perf_counter()
+		process = subprocess.Popen([sys.executable, demuxPath] + arguments, cwd=os.path.dirname(demuxPath), stdout=log, stderr=subprocess.STDOUT)
+		finished = threading.Event()
+		def sampleRss():
+			while not finished.wait(sampleInterval):
+				rss = getProcessTreeRss(process.pid)
+				if rss:
+					samples.append( (time.perf_counter()-start, rss) )
+		sampler = threading.Thread(target=sampleRss, daemon=True)
+		sampler.start()
+		# The resource usage returned by wait4 contains the peak RSS of the process and its descendants
+		_, status, usage = os.wait4(process.pid, 0)
+		duration = time.perf_counter()-start
+		finished.set()
+		sampler.join()
+		process.returncode = os.waitstatus_to_exitcode(status)
+	return duration, usage.ru_maxrss*1024, samples, process.returncode
+
+
+def summariseRss(samples):
+	"""Peak RSS of the process tree and the growth of the RSS from the first to the last quarter of the run, which indicates leaks"""
+	if not samples:
+		return None, None
+	quarter = max(1, len(samples)//4)
+	first = sum( rss for _, rss in samples[:quarter] )/quarter
+	last = sum( rss for _, rss in samples[-quarter:] )/quarter
+	return max( rss for _, rss in samples ), last-first
+
+
+def formatSize(size):
+	for unit in ('B','KB','MB','GB'):
+		if abs(size)<1024:
+			break
+		size/=1024
+	return f'{size:.1f}{unit}'
+
+
+if __name__ == '__main__':
+	argparser = argparse.ArgumentParser(
+	 formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+	 description='Measure the throughput, peak memory and output size of demux.py on synthetic runs of increasing size. Every run is demultiplexed for all combinations of -hd and -hdi: first without --y (library listing and autodetection) then with --y (the complete pipeline). The results can be stored as JSON and compared to the results of another commit')
+	argparser.add_argument('-sizes', help="Amount of read pairs of the synthetic runs (comma separated, scientific notation is accepted)", type=str, default='1e6,1e7,1e8')
+	argparser.add_argument('-libraries', help="Amount of libraries of every run", type=int, default=2)
+	argparser.add_argument('-lanes', help="Amount of lanes of every library", type=int, default=4)
+	argparser.add_argument('-strategies', help="The libraries are generated for these strategies in turn (comma separated short names), the strategies are autodetected by demux.py", type=str, default='CS2C8U6,NLAIII384C8U3')
+	argparser.add_argument('-hd', help="Barcode hamming distances to benchmark (comma separated), see demux.py", type=str, default='0,1')
+	argparser.add_argument('-hdi', help="Index hamming distances to benchmark (comma separated), see demux.py", type=str, default='1')
+	argparser.add_argument('-pool', help="Amount of distinct read pairs generated for every library, the runs are built by repeating these", type=int, default=100000)
+	argparser.add_argument('-seed', help="Seed of the synthetic read pair generator", type=int, default=0)
+	argparser.add_argument('-workDir', help="Directory in which the synthetic runs are generated and demultiplexed. When supplied the runs are kept and reused by later benchmarks, otherwise a temporary directory is used", type=str, default=None)
+	argparser.add_argument('-gp', help="Amount of processes used to generate the synthetic fastq files", type=int, default=4)
+	argparser.add_argument('-demuxArguments', help="Other arguments passed to demux.py, for example \"-t 4 -cores 8\"", type=str, default='')
+	argparser.add_argument('-o', help="Store the results as JSON at this path", type=str, default=None)
+	argparser.add_argument('-compare', help="Compare the results to results stored using -o", type=str, default=None)
+	args = argparser.parse_args()
+
+	sizes = [ int(float(size)) for size in args.sizes.split(',') ]
+	hammingDistances = [ (hd, hdi) for hd in map(int, args.hd.split(',')) for hdi in map(int, args.hdi.split(',')) ]
+	demuxArguments = shlex.split(args.demuxArguments)
+	workDir = os.path.abspath(args.workDir) if args.workDir is not None else tempfile.mkdtemp(prefix='demux_scaling_')
+
+	previous = None
+	if args.compare is not None:
+		with open(args.compare) as f:
+			previous = { (run['readPairs'], run['hd'], run['hdi']):run for run in json.load(f)['runs'] }
+
+	runs = []
+	print(f'{Style.BRIGHT}{"Read pairs":>12}{"hd":>4}{"hdi":>4}{"detect":>10}{"total":>10}{"pairs/s":>12}{"peak RSS":>12}{"tree RSS":>12}{"RSS growth":>12}{"output":>12}{Style.RESET_ALL}')
+	try:
+		for size in sizes:
+			start = time.perf_counter()
+			inputPaths = generateInput(f'{workDir}/input_{size}', size, args.libraries, args.lanes, args.strategies.split(','), poolSize=args.pool, seed=args.seed, processes=args.gp)
+			print(f'{Style.DIM}Generated {size} read pairs in {time.perf_counter()-start:.1f}s{Style.RESET_ALL}')
+			for hd, hdi in hammingDistances:
+				outputDirectory = f'{workDir}/output_{size}_{hd}_{hdi}'
+				shutil.rmtree(outputDirectory, ignore_errors=True)
+				arguments = inputPaths + ['-o', outputDirectory, '-hd', str(hd), '-hdi', str(hdi)] + demuxArguments
+				detectSeconds, _, _, detectCode = runDemux(arguments + ['-estimateReads', '0'], f'{outputDirectory}.detect.log')
+				seconds, peakRss, samples, code = runDemux(arguments + ['--y'], f'{outputDirectory}.log')
+				treeRss, rssGrowth = summariseRss(samples)
+				run = { 'readPairs':size, 'hd':hd, 'hdi':hdi, 'detectSeconds':detectSeconds, 'seconds':seconds, 'readPairsPerSecond':size/seconds,
+					'peakRss':peakRss, 'peakTreeRss':treeRss, 'rssGrowth':rssGrowth, 'outputBytes':getDirectorySize(outputDirectory),
+					'inputBytes':sum(map(os.path.getsize, inputPaths)), 'exitCode':code if code!=0 else detectCode }
+				runs.append(run)
+
+				change = ''
+				if previous is not None and (size, hd, hdi) in previous:
+					earlier = previous[(size, hd, hdi)]
+					ratio = run['readPairsPerSecond']/earlier['readPairsPerSecond']
+					change = f'{Fore.GREEN if ratio>=1 else Fore.RED}{100*(ratio-1):+.1f}%{Style.RESET_ALL} {Style.DIM}RSS{Style.RESET_ALL} {100*(run["peakRss"]/earlier["peakRss"]-1):+.1f}%'
+				status = '' if run['exitCode']==0 else f'{Fore.RED}failed, see {outputDirectory}.log{Style.RESET_ALL}'
+				print(f'{size:>12}{hd:>4}{hdi:>4}{detectSeconds:>9.1f}s{seconds:>9.1f}s{run["readPairsPerSecond"]:>12.0f}{formatSize(peakRss):>12}{formatSize(treeRss) if treeRss else "-":>12}{formatSize(rssGrowth) if rssGrowth is not None else "-":>12}{formatSize(run["outputBytes"]):>12} {change}{status}')
+				if args.workDir is None:
+					shutil.rmtree(outputDirectory, ignore_errors=True)
+	finally:
+		if args.workDir is None:
+			shutil.rmtree(workDir)
+
+	# Scaling: the throughput of every run relative to the smallest run with the same hamming distances
+	for run in runs:
+		smallest = next( other for other in runs if (other['hd'], other['hdi'])==(run['hd'], run['hdi']) )
+		run['relativeThroughput'] = run['readPairsPerSecond']/smallest['readPairsPerSecond']
+
+	if args.o is not None:
+		with open(args.o, 'w') as f:
+			json.dump({
+				'commit':benchmark.getCommit(),
+				'python':platform.python_version(),
+				'settings':{ 'libraries':args.libraries, 'lanes':args.lanes, 'strategies':args.strategies, 'pool':args.pool, 'seed':args.seed, 'demuxArguments':demuxArguments },
+				'runs':runs }, f, indent=1)
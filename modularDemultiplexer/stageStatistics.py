@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Timers and counters of the stages of demultiplexing, Buys de Barbanson
+import collections
+import contextlib
+import json
+import os
+import time
+
+class StageStatistics():
+	"""Timers, record and byte counters of the stages of demultiplexing.
+
+	The timers are exclusive: the time of a stage does not include the time of the stages timed within it.
+	Stages which are only timed for a sample of the chunks (see add) are extrapolated to all chunks in the report.
+	The statistics are picklable, they are sent from the worker processes to the main process.
+	"""
+	def __init__(self):
+		self.seconds = collections.Counter()
+		self.calls = collections.Counter()
+		self.records = collections.Counter()
+		self.bytes = collections.Counter()
+		self.sampledStages = set()
+		self.chunks = 0
+		self.sampledChunks = 0
+		self.nestedSeconds = 0.0
+
+	def time(self, stage, function, *args, **kwargs):
+		"""Execute function, the duration is added to stage"""
+		start = time.perf_counter()
+		outerNestedSeconds = self.nestedSeconds
+		self.nestedSeconds = 0.0
+		try:
+			return function(*args, **kwargs)
+		finally:
+			duration = time.perf_counter()-start
+			self.seconds[stage] += duration-self.nestedSeconds
+			self.calls[stage] += 1
+			self.nestedSeconds = outerNestedSeconds+duration
+
+	@contextlib.contextmanager
+	def timer(self, stage):
+		"""Add the duration of the context to stage"""
+		start = time.perf_counter()
+		outerNestedSeconds = self.nestedSeconds
+		self.nestedSeconds = 0.0
+		try:
+			yield
+		finally:
+			duration = time.perf_counter()-start
+			self.seconds[stage] += duration-self.nestedSeconds
+			self.calls[stage] += 1
+			self.nestedSeconds = outerNestedSeconds+duration
+
+	@contextlib.contextmanager
+	def instrument(self, methods):
+		"""Time the calls of methods in the context, methods: [(class, method name, stage)]
+
+		The methods are replaced by timed versions and restored when leaving the context
+		"""
+		originals = [ (owner, name, owner.__dict__[name]) for owner, name, stage in methods ]
+		try:
+			for owner, name, stage in methods:
+				function = owner.__dict__[name]
+				setattr(owner, name, lambda *args, function=function, stage=stage, **kwargs: self.time(stage, function, *args, **kwargs) )
+			yield self
+		finally:
+			for owner, name, original in originals:
+				setattr(owner, name, original)
+
+	def count(self, stage, records=0, bytes=0):
+		self.records[stage] += records
+		self.bytes[stage] += bytes
+
+	def add(self, other, sampled=False):
+		"""Add the statistics of other, sampled: other contains the statistics of one sampled chunk"""
+		self.seconds.update(other.seconds)
+		self.calls.update(other.calls)
+		self.records.update(other.records)
+		self.bytes.update(other.bytes)
+		self.sampledStages.update(other.sampledStages)
+		self.chunks += other.chunks
+		self.sampledChunks += other.sampledChunks
+		if sampled:
+			self.sampledStages.update(other.seconds)
+			self.sampledChunks += 1
+
+	def asReport(self):
+		"""Obtain the statistics of every stage, the time of the sampled stages is extrapolated to all chunks"""
+		extrapolation = self.chunks/self.sampledChunks if self.sampledChunks else 0
+		return { stage:{
+			'seconds':self.seconds[stage]*extrapolation if stage in self.sampledStages else self.seconds[stage],
+			'sampled':stage in self.sampledStages,
+			'sampledSeconds':self.seconds[stage] if stage in self.sampledStages else None,
+			'calls':self.calls[stage],
+			'records':self.records[stage],
+			'bytes':self.bytes[stage] }
+			for stage in sorted(set(self.seconds).union(self.records)) }
+
+
+def writeRunReport(path, report):
+	"""Write the run report (a dictionary) as JSON to path, the file is replaced atomically"""
+	with open(f'{path}.{os.getpid()}.tmp', 'w') as f:
+		json.dump(report, f, indent=1)
+	os.replace(f'{path}.{os.getpid()}.tmp', path)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import functools
+import random
+import pytest
+import barcodeFileParser
+
+def test_unknownAlias():
+    parser = barcodeFileParser.BarcodeParser(hammingDistanceExpansion=1)
+    with pytest.raises(KeyError):
+        parser.barcodes['doesNotExist']
+    with pytest.raises(KeyError):
+        parser.getIndexCorrectedBarcodeAndHammingDistance('ACGTACGT', 'doesNotExist')
+    assert not 'doesNotExist' in parser.loadedAliases
+    assert not 'doesNotExist' in parser.barcodes
+
+
+def test_aliasIsLoadedWhenLookedUp():
+    parser = barcodeFileParser.BarcodeParser(hammingDistanceExpansion=1)
+    assert parser.loadedAliases==[]
+    barcode, index = next(iter(parser.barcodes['celseq1'].items()))
+    assert parser.loadedAliases==['celseq1']
+    assert parser.getIndexCorrectedBarcodeAndHammingDistance(barcode, 'celseq1')==(index, barcode, 0)
+
+
+def getQueries(parser, alias, hammingDistance, amount=20000):
+    """Barcodes, all sequences within hammingDistance found by expand (including the collisions) and random mutations of the barcodes"""
+    random.seed(hammingDistance)
+    barcodes = list(parser.barcodes[alias])
+    queries = set(barcodes).union(parser.extendedBarcodes[alias], parser.barcodeCollisions[alias])
+    for _ in range(amount):
+        query = list(random.choice(barcodes))
+        for _ in range(random.randint(1, hammingDistance+2)):
+            query[random.randrange(len(query))] = random.choice('ACGTNX')
+        queries.add(''.join(query))
+    return sorted(queries)
+
+
+@pytest.mark.parametrize('alias,hammingDistance', [('celseq2', 1), ('celseq2', 2), ('illumina_merged_ThruPlex48S_RP', 2)])
+def test_correctionIndexEqualsExpansion(alias, hammingDistance):
+    barcodeDirectory = 'indices' if alias.startswith('illumina') else 'barcodes'
+    expanded = barcodeFileParser.BarcodeParser(barcodeDirectory=barcodeDirectory, hammingDistanceExpansion=hammingDistance, correction='expand')
+    indexed = barcodeFileParser.BarcodeParser(barcodeDirectory=barcodeDirectory, hammingDistanceExpansion=hammingDistance, correction='index')
+    expanded.expand = functools.partial(expanded.expand, reportCollisions=False)
+    assert not expanded.usesCorrectionIndex(alias)
+    assert indexed.usesCorrectionIndex(alias)
+    assert len(expanded.barcodeCollisions[alias])>0
+
+    for query in getQueries(expanded, alias, hammingDistance):
+        assert indexed.getIndexCorrectedBarcodeAndHammingDistance(query, alias)==expanded.getIndexCorrectedBarcodeAndHammingDistance(query, alias), query
+        assert indexed.isCollision(query, alias)==expanded.isCollision(query, alias), query
+        assert indexed.getCollidingBarcodes(query, alias)==expanded.getCollidingBarcodes(query, alias), query
+
+
+def test_automaticCorrection():
+    parser = barcodeFileParser.BarcodeParser(hammingDistanceExpansion=1, maxExpandedBarcodes=100000)
+    # celseq1: 96 barcodes of 8 bases, 96*8*4 sequences at distance 1
+    assert parser.getCorrection('celseq1')=='expand'
+    parser = barcodeFileParser.BarcodeParser(hammingDistanceExpansion=1, maxExpandedBarcodes=1000)
+    assert parser.getCorrection('celseq1')=='index'
+
+
+def test_collidingBarcodes():
+    parser = barcodeFileParser.BarcodeParser(hammingDistanceExpansion=1)
+    parser.expand = functools.partial(parser.expand, reportCollisions=False)
+    collision = next(iter(parser.barcodeCollisions['celseq2']))
+    hammingDistance, collidingBarcodes = parser.getCollidingBarcodes(collision, 'celseq2')
+    assert hammingDistance==1
+    assert len({ index for index, barcode in collidingBarcodes })>1
+    assert all( parser.barcodes['celseq2'][barcode]==index and sum(map(str.__ne__, collision, barcode))==1 for index, barcode in collidingBarcodes )
+    barcode = next(iter(parser.barcodes['celseq2']))
+    assert parser.getCollidingBarcodes(barcode, 'celseq2')==(None, [])
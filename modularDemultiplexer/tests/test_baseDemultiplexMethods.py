@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import collections
+import functools
+import random
+import pytest
+import barcodeFileParser
+import fastqIterator
+from baseDemultiplexMethods import NonMultiplexable,ReadPairContext,BarcodePrefilterIndex,TaggedRecord,TagDefinitions,HeaderCompactor,compactHeaderTags,writeHeaderManifest,readHeaderManifest
+from demultiplexModules.CELSeq1 import CELSeq1_c8_u4
+from demultiplexModules.CELSeq2 import CELSeq2_c8_u6,CELSeq2_c8_u8
+from demultiplexModules.NLAIII import NLAIII_384w_c8_u3
+from demultiplexModules.scartrace import ScartraceR1,ScartraceR2
+
+def createChunk(strategy, amount, seed=0):
+    """Create a chunk of fastq record blocks (one block per mate) in the layout of the strategy.
+
+    The barcodes are exact, contain substitutions (also by N), are random or are (partially) missing because the read is short
+    """
+    rng = random.Random(seed)
+    barcodes = sorted(strategy.barcodeFileParser.barcodes[strategy.barcodeFileAlias])
+    blocks = [ [], [] ]
+    for readPairIndex in range(amount):
+        barcode = list(rng.choice(barcodes))
+        for _ in range(rng.choice([0, 0, 1, 1, 2, 3])):
+            barcode[rng.randrange(len(barcode))] = rng.choice('ACGTN')
+        if rng.random()<0.1:
+            barcode = rng.choices('ACGTN', k=len(barcode))
+        sequences = [ ''.join(rng.choices('ACGT', k=40)) for mate in range(2) ]
+        sequence = sequences[strategy.barcodeRead]
+        sequences[strategy.barcodeRead] = sequence[:strategy.barcodeStart] + ''.join(barcode) + sequence[strategy.barcodeStart+len(barcode):]
+        if rng.random()<0.05:
+            # Too short to contain the (complete) barcode
+            sequences[strategy.barcodeRead] = sequences[strategy.barcodeRead][:rng.randrange(strategy.barcodeStart+strategy.barcodeLength)]
+        header = f'@NS500413:32:H14TKBGXX:1:11101:{readPairIndex}:{rng.randint(1,25000)}'
+        for mate, sequence in enumerate(sequences):
+            blocks[mate].append( f'{header} {mate+1}:N:0:ACGTACGT\n{sequence}\n+\n{"F"*len(sequence)}\n' )
+    return tuple( ''.join(block).encode('ascii') for block in blocks )
+
+
+@pytest.mark.parametrize('strategyClass', [CELSeq2_c8_u6, ScartraceR2])
+@pytest.mark.parametrize('hammingDistance,correction', [(0, 'expand'), (1, 'expand'), (1, 'index'), (2, 'index')])
+def test_batchEqualsPerReadDemultiplexing(strategyClass, hammingDistance, correction):
+    parser = barcodeFileParser.BarcodeParser(hammingDistanceExpansion=hammingDistance, correction=correction)
+    parser.expand = functools.partial(parser.expand, reportCollisions=False)
+    indexParser = barcodeFileParser.BarcodeParser(hammingDistanceExpansion=1, barcodeDirectory='indices')
+    strategy = strategyClass(barcodeFileParser=parser, indexFileParser=indexParser)
+    chunk = createChunk(strategy, 3000, seed=hammingDistance)
+
+    mask, cellIndices = strategy.demultiplexBatch(chunk)
+    barcodeEntries = strategy.getBatchBarcodeTable()[1]
+    readPairs = fastqIterator.blocksToReadPairs(chunk)
+    assert len(mask)==len(cellIndices)==len(readPairs)
+    accepted = 0
+    for readPairIndex, reads in enumerate(readPairs):
+        context = ReadPairContext(reads)
+        try:
+            records = strategy.demultiplex(reads, context=context)
+        except NonMultiplexable as e:
+            assert not mask[readPairIndex]
+            assert cellIndices[readPairIndex]==-1
+            assert strategy.getRejectReason(reads)==str(e)
+            continue
+        accepted += 1
+        assert mask[readPairIndex]
+        barcodeEntry = barcodeEntries[cellIndices[readPairIndex]]
+        assert barcodeEntry==parser.getIndexCorrectedBarcodeAndHammingDistance(reads[strategy.barcodeRead].sequence[strategy.barcodeStart:strategy.barcodeStart+strategy.barcodeLength], strategy.barcodeFileAlias)
+        assert (barcodeEntry[0], barcodeEntry[2])==context.cellBarcodes[strategy.shortName]
+        assert strategy.demultiplex(reads, context=ReadPairContext(reads), batchBarcode=barcodeEntry)==records
+    # Both accepted and rejected read pairs, at every hamming distance
+    assert 0<accepted<len(readPairs)
+    assert { barcodeEntries[cellIndex][2] for cellIndex in cellIndices if cellIndex>=0 }==set(range(hammingDistance+1))
+
+
+@pytest.mark.parametrize('hammingDistance,correction', [(0, 'expand'), (1, 'expand'), (2, 'expand'), (2, 'index')])
+def test_prefilterYieldsEqualDemultiplexing(hammingDistance, correction):
+    parser = barcodeFileParser.BarcodeParser(hammingDistanceExpansion=hammingDistance, correction=correction)
+    parser.expand = functools.partial(parser.expand, reportCollisions=False)
+    indexParser = barcodeFileParser.BarcodeParser(hammingDistanceExpansion=1, barcodeDirectory='indices')
+    strategies = [ strategyClass(barcodeFileParser=parser, indexFileParser=indexParser) for strategyClass in
+        (CELSeq1_c8_u4, CELSeq2_c8_u6, CELSeq2_c8_u8, NLAIII_384w_c8_u3, ScartraceR1, ScartraceR2) ]
+    # Read pairs in the layouts of all strategies
+    chunks = [ createChunk(strategy, 500, seed=seed) for seed, strategy in enumerate(strategies) ]
+    chunk = tuple( b''.join(blocks) for blocks in zip(*chunks) )
+
+    prefilter = BarcodePrefilterIndex(strategies)
+    readPairCount, prefilterYields = prefilter.scoreChunk(chunk)
+    readPairs = fastqIterator.blocksToReadPairs(chunk)
+    assert readPairCount==len(readPairs)
+    strategyYields = collections.Counter()
+    for reads in readPairs:
+        for strategy in strategies:
+            try:
+                strategy.demultiplex(reads, context=ReadPairContext(reads))
+            except NonMultiplexable:
+                continue
+            if strategy in prefilter.unindexedStrategies:
+                prefilterYields[strategy.shortName] += 1
+            strategyYields[strategy.shortName] += 1
+    assert prefilterYields==strategyYields
+    assert len(strategyYields)==len(strategies)
+    if correction=='index':
+        assert prefilter.unindexedStrategies==strategies
+
+
+def test_compactHeaderRoundTrip(tmp_path):
+    parser = barcodeFileParser.BarcodeParser()
+    indexParser = barcodeFileParser.BarcodeParser(hammingDistanceExpansion=1, barcodeDirectory='indices')
+    strategy = CELSeq2_c8_u6(barcodeFileParser=parser, indexFileParser=indexParser)
+    records = []
+    for reads in fastqIterator.blocksToReadPairs(createChunk(strategy, 500)):
+        try:
+            records.append( strategy.demultiplex(reads, library='LIB', context=ReadPairContext(reads))[0] )
+        except NonMultiplexable:
+            continue
+    # Records which differ from the manifest: another lane and a record without the strategy tag
+    records.append( records[0].replace(';La:1;', ';La:2;') )
+    records.append( records[1].replace(f';MX:{strategy.shortName}', '') )
+    assert records[-2]!=records[0] and records[-1]!=records[1]
+    taggedRecord = TaggedRecord(TagDefinitions, library='LIB')
+    taggedRecord.fromRawFastq(fastqIterator.blocksToReadPairs(createChunk(strategy, 1))[0][0])
+    taggedRecord.addTagByTag('MX', strategy.shortName)
+    manifest = { tag:taggedRecord.tags[tag] for tag in compactHeaderTags if tag in taggedRecord.tags }
+
+    writeHeaderManifest(str(tmp_path), manifest)
+    compactor = HeaderCompactor(manifest)
+    with open(tmp_path/'demultiplexedR1.fastq', 'w') as f:
+        for record in records:
+            f.write(compactor.compact(record))
+    readManifest = readHeaderManifest(str(tmp_path/'demultiplexedR1.fastq'))
+    assert readManifest==manifest
+    assert readHeaderManifest(str(tmp_path/'other'/'demultiplexedR1.fastq')) is None
+
+    compactRecords = list(fastqIterator.FastqIterator(str(tmp_path/'demultiplexedR1.fastq')))
+    assert len(compactRecords)==len(records)
+    for record, (compactRecord,) in zip(records, compactRecords):
+        assert len(compactRecord.header)<len(record.split('\n')[0])
+        expected = TaggedRecord(TagDefinitions)
+        expected.fromTaggedFastq(fastqIterator.FastqRecord(*record.split('\n')[:4]))
+        restored = TaggedRecord(TagDefinitions)
+        restored.fromTaggedFastq(compactRecord, manifest=readManifest)
+        assert restored.tags==expected.tags
+        assert (compactRecord.sequence, compactRecord.qual)==tuple(record.split('\n')[1:4:2])
+    assert restored.tags.get('MX') is None
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import gzip
+import bgzf
+import fastqIndex
+import fastqIterator
+
+def createRecords(amount):
+	return [ f'@read{i}\n{"ACGT"[i%4]*(20+i%7)}\n+\n{"F"*(20+i%7)}\n'.encode('ascii') for i in range(amount) ]
+
+
+def writeMultiMemberGzip(path, records, recordsPerMember):
+	"""Write every recordsPerMember records as a separate gzip member, returns the byte offsets of the members"""
+	offsets = []
+	with open(path, 'wb') as f:
+		for start in range(0, len(records), recordsPerMember):
+			offsets.append(f.tell())
+			f.write(gzip.compress(b''.join(records[start:start+recordsPerMember])))
+	return offsets
+
+
+def readRecordAt(path, recordIndex, index):
+	"""Obtain the record at recordIndex using openFastqAtRecord"""
+	handle, skip = fastqIterator.openFastqAtRecord(path, recordIndex, index=index)
+	with handle:
+		lines = handle.read().split(b'\n')
+	return b'\n'.join(lines[skip*4:skip*4+4])+b'\n'
+
+
+def checkRoundTrip(path, records, checkpointInterval):
+	index = fastqIndex.getFastqIndex(path, checkpointInterval=checkpointInterval)
+	assert index.records==len(records)
+	assert len(index.checkpoints)>1
+	assert all( memberOffset is not None for recordIndex, memberOffset, uncompressedOffset in index.checkpoints )
+	# The index was stored next to the file
+	assert fastqIndex.FastqIndex.read(path).checkpoints==index.checkpoints
+	assert fastqIndex.estimateRecordCount(path)==(len(records), True)
+	for recordIndex in range(len(records)):
+		assert readRecordAt(path, recordIndex, index)==records[recordIndex]
+
+
+def test_bgzfRoundTrip(tmp_path):
+	records = createRecords(5000)
+	path = str(tmp_path/'reads_R1.fastq.gz')
+	with open(path, 'wb') as f:
+		with bgzf.BgzfWriter(f, threads=1) as writer:
+			writer.write(b''.join(records))
+	assert bgzf.isBgzf(path)
+	checkRoundTrip(path, records, checkpointInterval=700)
+
+
+def test_multiMemberGzipRoundTrip(tmp_path):
+	records = createRecords(1000)
+	path = str(tmp_path/'reads_R1.fastq.gz')
+	writeMultiMemberGzip(path, records, recordsPerMember=37)
+	checkRoundTrip(path, records, checkpointInterval=100)
+
+
+def test_memberEndsAtBlockBoundary(tmp_path):
+	records = createRecords(60)
+	path = str(tmp_path/'reads_R1.fastq.gz')
+	offsets = writeMultiMemberGzip(path, records, recordsPerMember=10)
+	# The first read of blockSize ends exactly at the end of the first member
+	blockSize = offsets[1]
+	with open(path, 'rb') as f:
+		chunks = list(fastqIndex.iterateGzipMembers(f, blockSize=blockSize))
+	assert b''.join( decompressed for memberOffset, decompressed in chunks )==b''.join(records)
+	assert sorted(set( memberOffset for memberOffset, decompressed in chunks ))==offsets
+
+	index = fastqIndex.buildIndex(path, checkpointInterval=10, blockSize=blockSize)
+	assert index.checkpoints==[ [recordIndex, offset, 0] for recordIndex, offset in zip(range(0, 60, 10), offsets) ]
+	for recordIndex in range(len(records)):
+		assert readRecordAt(path, recordIndex, index)==records[recordIndex]
+
+
+def test_trailingPadding(tmp_path):
+	records = createRecords(100)
+	path = str(tmp_path/'reads_R1.fastq.gz')
+	offsets = writeMultiMemberGzip(path, records, recordsPerMember=25)
+	with open(path, 'ab') as f:
+		f.write(b'\x00'*100)
+	with open(path, 'rb') as f:
+		chunks = list(fastqIndex.iterateGzipMembers(f, blockSize=64))
+	assert b''.join( decompressed for memberOffset, decompressed in chunks )==b''.join(records)
+	assert sorted(set( memberOffset for memberOffset, decompressed in chunks ))==offsets
+
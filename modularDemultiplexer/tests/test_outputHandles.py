@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import collections
+import gzip
+import os
+import random
+import pytest
+import bgzf
+from outputHandles import CellFastqHandle
+
+def getOpenFileCount():
+	return len(os.listdir('/proc/self/fd'))
+
+
+@pytest.mark.parametrize('maxHandles', [1, 2, 5])
+def test_cellFilesWithFewHandles(tmp_path, maxHandles):
+	rng = random.Random(maxHandles)
+	directory = f'{tmp_path}/cells/'
+	openFilesBefore = getOpenFileCount()
+	handle = CellFastqHandle(directory, True, maxHandles=maxHandles, cellBufferSize=300, threads=1)
+	expected = collections.defaultdict(lambda: [ [], [] ])
+	for readPair in range(3000):
+		cell = rng.randrange(20)
+		sequence = ''.join(rng.choices('ACGT', k=rng.randint(10, 40)))
+		records = [ f'@MX:CS2C8U6;BI:{cell};RP:{readPair};R:{mate+1}\n{sequence}\n+\n{"F"*len(sequence)}\n' for mate in range(2) ]
+		handle.write(records)
+		for mate, record in enumerate(records):
+			expected[f'CS2C8U6_{cell}'][mate].append(record)
+		# Every cell has a file per mate, the files of at least one cell are opened
+		assert len(handle.handles)*len(handle.mates)<=max(maxHandles, len(handle.mates))
+		assert getOpenFileCount()-openFilesBefore<=max(maxHandles, len(handle.mates))
+	# Closed cell files were opened again to append records
+	assert len(handle.offsets)>0
+	handle.close()
+	assert getOpenFileCount()==openFilesBefore
+
+	assert sorted(os.listdir(directory))==sorted( f'{cell}_{mate}.fastq.gz' for cell in expected for mate in ('R1', 'R2') )
+	for cell, mateRecords in expected.items():
+		for mate, records in zip(('R1', 'R2'), mateRecords):
+			path = f'{directory}{cell}_{mate}.fastq.gz'
+			assert bgzf.isBgzf(path)
+			with open(path, 'rb') as f:
+				data = f.read()
+			# Appending removes the end of file marker of the closed file, only the final marker remains
+			assert data.count(bgzf.bgzfEofMarker)==1 and data.endswith(bgzf.bgzfEofMarker)
+			assert gzip.decompress(data).decode()==''.join(records)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import glob
+import gzip
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+import pytest
+import bgzf
+import fastqIndex
+
+demultiplexerDirectory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+def writeLane(prefix, amount, seed, useBgzf=False):
+	"""Write a lane of CELSeq2 read pairs, some with substitutions in (or without) a barcode, returns the paths of the mates"""
+	rng = random.Random(seed)
+	with open(f'{demultiplexerDirectory}/barcodes/celseq2.bc') as f:
+		barcodes = [ line.split()[1] for line in f if line.strip() ]
+	mates = [ [], [] ]
+	for readPairIndex in range(amount):
+		barcode = rng.choice(barcodes) if rng.random()<0.8 else ''.join(rng.choices('ACGT', k=8))
+		if rng.random()<0.2:
+			position = rng.randrange(len(barcode))
+			barcode = barcode[:position] + rng.choice('ACGTN') + barcode[position+1:]
+		sequences = [ ''.join(rng.choices('ACGT', k=6)) + barcode + ''.join(rng.choices('ACGT', k=30)), ''.join(rng.choices('ACGT', k=50)) ]
+		header = f'@NS500413:32:H14TKBGXX:1:11101:{readPairIndex}:{rng.randint(1,20000)}'
+		for mate, sequence in enumerate(sequences):
+			mates[mate].append( f'{header} {mate+1}:N:0:ACGTACGT\n{sequence}\n+\n{"".join(rng.choices("#AEF<", k=len(sequence)))}\n' )
+	paths = []
+	for mate, records in enumerate(mates):
+		path = f'{prefix}_R{mate+1}_001.fastq.gz'
+		data = ''.join(records).encode('ascii')
+		with open(path, 'wb') as f:
+			if useBgzf:
+				with bgzf.BgzfWriter(f, threads=1) as writer:
+					writer.write(data)
+			else:
+				f.write(gzip.compress(data))
+		paths.append(path)
+	return paths
+
+
+def runDemultiplexer(arguments):
+	return subprocess.Popen([sys.executable, 'demux.py'] + arguments, cwd=demultiplexerDirectory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+		start_new_session=True)
+
+
+def isWrittenAfterCheckpoint(checkpointPath):
+	"""Check whether demultiplexed records were written after the checkpoint stored at checkpointPath, these are removed when the run is resumed"""
+	try:
+		with open(checkpointPath) as f:
+			state = json.load(f)
+	except FileNotFoundError:
+		return False
+	if state['handles'] is None:
+		return False
+	prefix = checkpointPath[:-len('checkpoint.json')]
+	paths = [ f'{prefix}demultiplexedR1.fastq.gz', f'{prefix}demultiplexedR2.fastq.gz' ]
+	return any( os.path.getsize(path)>offset for path, offset in zip(paths, state['handles']['demultiplexed']['offsets']) )
+
+
+def killAfterCheckpoint(arguments, checkpointPattern, timeout=120):
+	"""Run the demultiplexer and kill it (and the processes it started) when records were written after a checkpoint"""
+	process = runDemultiplexer(arguments)
+	start = time.time()
+	while not any( isWrittenAfterCheckpoint(path) for path in glob.glob(checkpointPattern) ):
+		assert process.poll() is None, 'The demultiplexer finished before records were written after a checkpoint'
+		assert time.time()-start<timeout
+		time.sleep(0.01)
+	os.killpg(process.pid, signal.SIGKILL)
+	process.wait()
+	assert process.returncode==-signal.SIGKILL
+	# The run was interrupted before it was finished
+	for path in glob.glob(checkpointPattern):
+		with open(path) as f:
+			assert not json.load(f)['finished']
+
+
+def readOutput(directory):
+	"""Obtain the decompressed contents of the demultiplexed and rejected read pairs stored in directory"""
+	output = {}
+	for path in sorted(glob.glob(f'{directory}/**/*.fastq.gz', recursive=True)):
+		with gzip.open(path) as f:
+			output[os.path.relpath(path, directory)] = f.read()
+	return output
+
+
+@pytest.mark.parametrize('shards', [1, 2])
+def test_resumeEqualsUninterruptedRun(tmp_path, shards):
+	paths = writeLane(str(tmp_path/'libA_L001'), 30000, seed=shards, useBgzf=shards>1)
+	if shards>1:
+		for path in paths:
+			index = fastqIndex.getFastqIndex(path, checkpointInterval=2000)
+			assert len(index.checkpoints)>1
+	arguments = paths + ['-use', 'CS2C8U6', '-chunkSize', '200', '-shards', str(shards), '--y']
+
+	assert runDemultiplexer(arguments + ['-o', str(tmp_path/'uninterrupted'), '-checkpoint', '0']).wait()==0
+	expected = readOutput(tmp_path/'uninterrupted')
+	assert { 'libA/demultiplexedR1.fastq.gz', 'libA/demultiplexedR2.fastq.gz', 'libA/rejectsR1.fastq.gz', 'libA/rejectsR2.fastq.gz' }<=set(expected)
+	assert all( len(contents)>0 for contents in expected.values() )
+
+	interruptedArguments = arguments + ['-o', str(tmp_path/'interrupted'), '-checkpoint', '0.5']
+	checkpointPattern = str(tmp_path/'interrupted'/'libA'/('parts/*checkpoint.json' if shards>1 else 'checkpoint.json'))
+	killAfterCheckpoint(interruptedArguments, checkpointPattern)
+	assert runDemultiplexer(interruptedArguments + ['--resume']).wait()==0
+	assert readOutput(tmp_path/'interrupted')==expected
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import struct
+import unalignedBam
+
+def test_encodeIntegerTag():
+	for value, typeCode, structFormat in [
+		(0, b'C', '<B'), (255, b'C', '<B'), (-1, b'c', '<b'), (-128, b'c', '<b'),
+		(256, b'S', '<H'), (65535, b'S', '<H'), (-129, b's', '<h'), (-32768, b's', '<h'),
+		(65536, b'i', '<i'), (2**31-1, b'i', '<i'), (-32769, b'i', '<i'), (-2**31, b'i', '<i'),
+		(2**31, b'I', '<I'), (2**32-1, b'I', '<I') ]:
+		assert unalignedBam.encodeTag('XX', value)==b'XX' + typeCode + struct.pack(structFormat, value)
+
+
+def test_encodeLargeIntegerTagAsString():
+	assert unalignedBam.encodeTag('XX', 2**32)==b'XXZ4294967296\x00'
+	assert unalignedBam.encodeTag('XX', -2**31-1)==b'XXZ-2147483649\x00'
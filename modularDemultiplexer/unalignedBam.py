@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Unaligned BAM encoding of demultiplexed read pairs, Buys de Barbanson
+import string
+import struct
+import bgzf
+from baseDemultiplexMethods import TagDefinitions
+
+# Flags of unmapped reads, for single end reads, the first and the second mate
+unpairedFlag = 0x4
+mateFlags = (0x1|0x4|0x8|0x40, 0x1|0x4|0x8|0x80)
+
+# 4 bit code of every base, unknown characters are encoded as N. The codes of the bases
+# at even positions are shifted to the high nibble, the pairs are combined by addition
+baseCodes = [15]*256
+for code, base in enumerate('=ACMGRSVTWYHKDBN'):
+	baseCodes[ord(base)] = baseCodes[ord(base.lower())] = code
+highBaseCodeTable = bytes( code<<4 for code in baseCodes )
+lowBaseCodeTable = bytes( baseCodes )
+
+def packSequence(sequence):
+	"""Pack the sequence (bytes) into 4 bits per base"""
+	if len(sequence)%2:
+		sequence += b'='
+	high = int.from_bytes(sequence[0::2].translate(highBaseCodeTable), 'big')
+	low = int.from_bytes(sequence[1::2].translate(lowBaseCodeTable), 'big')
+	return (high+low).to_bytes(len(sequence)//2, 'big')
+
+phredOffsetTable = bytes( max(0,i-33) for i in range(256) )
+# Conversion of the fastq header safe qualities back to phred scores, see phredToFastqHeaderSafeQualities
+headerSafeQualityTable = str.maketrans(string.ascii_letters, ''.join( chr(i+33) for i in range(len(string.ascii_letters)) ))
+
+def encodeHeader(headerText):
+	"""Encode the BAM header, without reference sequences"""
+	text = headerText.encode()
+	return b'BAM\x01' + struct.pack('<i', len(text)) + text + struct.pack('<i', 0)
+
+
+# BAM integer types: (type, struct format, smallest value, largest value), the first type the value fits in is used
+integerTagTypes = [
+	(b'C', '<B', 0, 2**8-1),
+	(b'c', '<b', -2**7, 2**7-1),
+	(b'S', '<H', 0, 2**16-1),
+	(b's', '<h', -2**15, 2**15-1),
+	(b'i', '<i', -2**31, 2**31-1),
+	(b'I', '<I', 0, 2**32-1)
+]
+
+def encodeTag(tag, value):
+	if type(value)==int:
+		for typeCode, structFormat, smallest, largest in integerTagTypes:
+			if smallest<=value<=largest:
+				return tag.encode() + typeCode + struct.pack(structFormat, value)
+		# Does not fit in a BAM integer
+		value = str(value)
+	return tag.encode() + b'Z' + value.encode() + b'\x00'
+
+
+def encodeRecord(name, sequence, qualities, tags, flag):
+	"""Encode an unmapped BAM record.
+
+	tags: encoded tags, see encodeTag
+	"""
+	encodedName = name.encode() + b'\x00'
+	sequence = sequence.encode()
+	data = struct.pack('<iiBBHHHiiii', -1, -1, len(encodedName), 0, 4680, 0, flag, len(sequence), -1, -1, 0) \
+		+ encodedName + packSequence(sequence) + qualities.encode().translate(phredOffsetTable) + tags
+	return struct.pack('<i', len(data)) + data
+
+
+def parseTaggedFastq(record):
+	"""Obtain (read name, sequence, qualities, encoded tags) from a demultiplexed fastq record (a string of four lines).
+
+	The tags are typed: numbers are integers, the quality tags are converted back to phred scores.
+	The read name is the illumina read name, mates have the same name
+	"""
+	header, sequence, _, qualities = record.split('\n', 4)[:4]
+	tags = []
+	values = {}
+	for keyValue in header[1:].split(';'):
+		tag, value = keyValue.split(':', 1)
+		if TagDefinitions[tag].isPhred:
+			value = value.translate(headerSafeQualityTable)
+		elif value.isdigit() and (value=='0' or value[0]!='0'):
+			value = int(value)
+		tags.append( encodeTag(tag, value) )
+		values[tag] = value
+	# The sample tag is set the same way as when tagging aligned reads, see TaggedRecord.tagPysamRead
+	if not 'SM' in values and 'LY' in values:
+		tags.append( encodeTag('SM', f'{values["LY"]}_{values["BI"]}' if 'BI' in values else f'{values["LY"]}_BULK') )
+	try:
+		name = ':'.join( str(values[tag]) for tag in ('Is','RN','Fc','La','Ti','CX','CY') )
+	except KeyError:
+		name = header[1:]
+	return name, sequence, qualities, b''.join(tags)
+
+
+def encodeReadPair(records):
+	"""Encode the demultiplexed fastq records of the mates of a read pair into BAM records, with pairing flags"""
+	flags = mateFlags if len(records)==2 else (unpairedFlag,)
+	return b''.join( encodeRecord(*parseTaggedFastq(record), flag=flag) for record, flag in zip(records, flags) )
+
+
+def skipHeader(handle):
+	"""Move handle (an opened BGZF BAM file) past the blocks containing the BAM header, the header has to end at a block boundary"""
+	data = b''
+	while len(data)<8 or len(data)<12+struct.unpack('<i', data[4:8])[0]:
+		block = bgzf.readBgzfBlock(handle)
+		if block is None:
+			break
+		data += bgzf.inflateBgzfBlock(*block)